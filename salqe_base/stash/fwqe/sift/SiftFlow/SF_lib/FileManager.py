@@ -1,10 +1,14 @@
 #!/usr/bin/python -d
  
+from __future__ import with_statement
 import sys, os, re, glob, subprocess
-import datetime, time, threading
+import datetime, time, threading, Queue
 from PyQt4 import QtCore, QtGui
 from SFLibManager import *
 
+WORD_REGEX = re.compile('\w+')
+REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+
 class FileManager():
     def __init__(self, libMgr):
         self.libMgr = libMgr
@@ -12,6 +16,16 @@ class FileManager():
         self.fileDirs = None
         self.regexs = self.initRegexs()
         self.ignoreFileChanged = {} #key/value is explained in ignoreFileChanged
+
+        #Word index of the loaded files so finds don't have to read every file. Files are
+        #(re)indexed on a background thread whenever they are loaded, saved or changed, and
+        #finds read the files that aren't indexed yet themselves rather than wait.
+        self.words = {}             #key=lower case word, value=set of File objects containing it
+        self.indexLock = threading.Lock()
+        self.indexQueue = Queue.Queue()
+        indexThread = threading.Thread(target=self.__indexFiles, name="SiftFlow index")
+        indexThread.setDaemon(True)
+        indexThread.start()
         
         #Setup the file watcher related stuff
         self.rTimer = QtCore.QObject()
@@ -38,6 +52,12 @@ class FileManager():
         #Repopulate internal filelist object
         self.fileList = self.__createFileList()
 
+        #Index the new files
+        with self.indexLock:
+            self.words = {}
+        for fl in self.fileList:
+            self.indexQueue.put(fl)
+
         #If fileList is empty then project wasn't loaded successfully
         if(self.fileList == [] or self.fileList == None):
             return False
@@ -65,6 +85,7 @@ class FileManager():
             #add file to the fileMgr
             newFile = File(fp, self.regexs, self.libMgr)
             self.fileList.append(newFile)
+            self.__index(newFile)
             
         return filesNotAdded
 
@@ -108,6 +129,12 @@ class FileManager():
         #Make sure its actually None since getFileProj will only return strings
         if(fileProj == "None"):
             fileProj = None
+
+        #Index the file's new text (if it's still loaded)
+        try:
+            self.__index(self.fileList[self.getFileIndex(fileName, fileProj or filePath)])
+        except Exception:
+            pass
         
         #Reload the file if its being displayed and the treeview
         self.libMgr.reloadFile(fileName, fileProj or filePath)
@@ -331,12 +358,17 @@ class FileManager():
         if(flags['cs']):
             flag = 0
 
-        for fl in self.fileList:
-            result = fl.findInFile(reg, flag)
+        regex = re.compile(reg, flag)
+        with self.indexLock:
+            for fl, lineNumbers in self.__findCandidates(text, flags):
+                if(lineNumbers == None):
+                    result = fl.findInFile(reg, flag)
+                else:
+                    result = fl.findInLines(regex, lineNumbers)
 
-            #If the tab already exists, don't look in the file (optimization)
-            if(result and not self.libMgr.tabAlreadyExists(result[0])):
-                foundList.append(result)
+                #If the tab already exists, don't look in the file (optimization)
+                if(result and not self.libMgr.tabAlreadyExists(result[0])):
+                    foundList.append(result)
 
         return foundList
 
@@ -354,11 +386,85 @@ class FileManager():
         if(flags['cs']):
             flag = 0
 
-        for fl in self.fileList:
-            refs.extend(fl.getReferences(reg, flag))
+        regex = re.compile(reg, flag)
+        with self.indexLock:
+            for fl, lineNumbers in self.__findCandidates(text, flags):
+                if(lineNumbers == None):
+                    refs.extend(fl.getReferences(reg, flag))
+                else:
+                    refs.extend(fl.getReferencesInLines(regex, lineNumbers))
 
         return refs
 
+    #--- Word index ---#
+
+    # - - - - - - - - - - - - - - - - 
+    # - Name: findCandidates()
+    # - Parameters: text - text being searched for, flags - search flags
+    # - Description: Returns [file, line numbers] for each file, in order, where the line numbers
+    # - are the only lines of the file that could match. Line numbers are None when the file isn't
+    # - indexed; files that can't match are left out. Text without regex special chars has a word
+    # - in it that matching lines must contain. Caller holds indexLock.
+    def __findCandidates(self, text, flags):
+        text = str(text)
+        keys = WORD_REGEX.findall(text.lower())
+        if(REGEX_SPECIAL_CHARS.intersection(text) or not keys):
+            return [[fl, fl.allLines()] for fl in self.fileList]
+
+        #Whole words are surrounded by white space so must be a word of the line
+        key = max(keys, key=len)
+        if(flags['wo'] and key == text.lower()):
+            matchingWords = [key]
+        else:
+            matchingWords = [word for word in self.words if key in word]
+
+        lineNumbers = {}
+        for word in matchingWords:
+            for fl in self.words.get(word, ()):
+                lineNumbers.setdefault(fl, set()).update(fl.words[word])
+
+        candidates = []
+        for fl in self.fileList:
+            if(fl.lines == None):
+                candidates.append([fl, None])
+            elif(fl in lineNumbers):
+                candidates.append([fl, sorted(lineNumbers[fl])])
+        return candidates
+
+    # - - - - - - - - - - - - - - - - 
+    # - Name: index()
+    # - Parameters: fl - File object
+    # - Description: Drops the file's index, so finds read the file until it's indexed again,
+    # - and queues it to be indexed
+    def __index(self, fl):
+        with self.indexLock:
+            for word in fl.words:
+                if(word in self.words):
+                    self.words[word].discard(fl)
+            fl.setIndex(None, None, {})
+        self.indexQueue.put(fl)
+
+    # - - - - - - - - - - - - - - - - 
+    # - Name: indexFiles()
+    # - Description: Background thread, indexes the files put on indexQueue
+    def __indexFiles(self):
+        while True:
+            fl = self.indexQueue.get()
+            try:
+                lines, lineFlows, words = fl.readIndex()
+                with self.indexLock:
+                    for word in fl.words:
+                        if(word in self.words):
+                            self.words[word].discard(fl)
+                    fl.setIndex(lines, lineFlows, words)
+                    for word in words:
+                        self.words.setdefault(word, set()).add(fl)
+            except:
+                #Leave it unindexed, finds will read the file themselves
+                with self.indexLock:
+                    fl.setIndex(None, None, {})
+            self.indexQueue.task_done()
+
     #--- Saving ---#
     def save(self, text, fileName, pathOrProj, funcName, startingLineNum):
         #Get Text ready to save to file
@@ -397,7 +503,9 @@ class FileManager():
         self.fileList[self.getFileIndex(fileName, pathOrProj)].refreshFunctions()
 
         #Save to file
-        return self.fileList[self.getFileIndex(fileName, pathOrProj)].save(toSave)
+        saved = self.fileList[self.getFileIndex(fileName, pathOrProj)].save(toSave)
+        self.__index(self.fileList[self.getFileIndex(fileName, pathOrProj)])
+        return saved
 
     def getLineNumberOffset(self, fileName, pathOrProj, flowName, duplicateIndex=None):
         return self.getFlowText(fileName, pathOrProj, flowName, duplicateIndex)[1]
@@ -564,6 +672,11 @@ class File():
 
         self.functions = self.getFunctionNamesFromFile()
 
+        #Set by the FileManager's index thread, see readIndex()
+        self.lines = None
+        self.lineFlows = None
+        self.words = {}
+
     def getFileTextString(self):
         text = '' 
 
@@ -740,6 +853,80 @@ class File():
         file.close()
         return refs
 
+    # - - - - - - - - - - - - - - - - 
+    # - Name: readIndex()
+    # - Description: Reads the file once for the FileManager's index. Returns the lines of the file,
+    # - the flow (as getReferences() names it) each line is in, and a dictionary of the lower case
+    # - words in the file with the line numbers they are on.
+    def readIndex(self):
+        file = open(self.fullPath, 'r')
+        lines = file.readlines()
+        file.close()
+
+        #Count each flow so duplicates get numbered
+        counts = {}
+        for line in lines:
+            if(self.regexs["functionLine"].search(line)):
+                func = self.regexs["functionName"].search(line).group(1)
+                counts[func] = counts.get(func, 0) + 1
+
+        lineFlows = []
+        words = {}
+        currentFunc = 'n/a'
+        duplicate = {}
+        dupString = ''
+        for x, line in enumerate(lines):
+            if(self.regexs["functionLine"].search(line)):
+                currentFunc = self.regexs["functionName"].search(line).group(1)
+                if(counts[currentFunc] > 1):
+                    duplicate[currentFunc] = duplicate.get(currentFunc, 0) + 1
+                    dupString = "(" + str(duplicate[currentFunc]) + ")"
+                else:
+                    dupString = ""
+
+            if(currentFunc == "n/a"):
+                dupString = ""
+            lineFlows.append(currentFunc + dupString)
+
+            if(self.regexs["functionEnd"].search(line)):
+                currentFunc = "n/a"
+
+            for word in set(WORD_REGEX.findall(line.lower())):
+                words.setdefault(word, []).append(x)
+
+        return lines, lineFlows, words
+
+    def setIndex(self, lines, lineFlows, words):
+        self.lines = lines
+        self.lineFlows = lineFlows
+        self.words = words
+
+    def allLines(self):
+        if(self.lines == None):
+            return None
+        return xrange(len(self.lines))
+
+    # - - - - - - - - - - - - - - - - 
+    # - Name: getReferencesInLines()
+    # - Parameters: regex - compiled regex, lineNumbers - the lines to look at
+    # - Description: getReferences() for the given lines of the indexed text
+    def getReferencesInLines(self, regex, lineNumbers):
+        refs = []
+        for x in lineNumbers:
+            line = self.lines[x]
+            if(regex.search(line)):
+                refs.append([str(x + 1), self.lineFlows[x], self.name, str(line[:-1]).strip('\n '), self.getPathOrProj()])
+        return refs
+
+    # - - - - - - - - - - - - - - - - 
+    # - Name: findInLines()
+    # - Parameters: regex - compiled regex, lineNumbers - the lines to look at
+    # - Description: findInFile() for the given lines of the indexed text
+    def findInLines(self, regex, lineNumbers):
+        for x in lineNumbers:
+            if(regex.search(self.lines[x])):
+                return [self.name, self.getPathOrProj()]
+
     # - - - - - - - - - - - - - - - - 
     # - Name: findInFile()
     # - Parameters: reg - regex to search for, flag - search flag, typical case sensitive
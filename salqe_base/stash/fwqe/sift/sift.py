@@ -49,8 +49,17 @@ import select
 import socket
 import SocketServer
 import shutil
+import gzip
+import zlib
 import shelve
 import struct
+import bisect
+import marshal
+import operator
+import array
+import mmap
+import gc
+import hashlib
 import datetime
 import platform
 try:                    # Optional if you don't use serial
@@ -107,8 +116,33 @@ DEFAULT_LOGFILE              = "trace.sift"             # Human readable trace
 DEFAULT_HTML_FILE            = "trace.html"             # Browser readable trace
 BACKUP_DEFAULT_LOGFILE       = "trace.bak"              # Backup of last "trace.sift"
 RAW_OUTPUT_FILE              = "trace.raw"              # Original raw trace file
+SPILL_FILE                   = "trace.spill"            # Raw lines the input fifo had no room for
 DEFAULT_OUTPUT_FILE_SIZE     = 209715200                # Limit trace file size
+DEFAULT_LOG_FLUSH_TIME       = 0.5                      # Most seconds output waits to be written to files
+LOG_BATCH_SIZE               = 1048576                  # Write to files early once this much is waiting
 MAX_HTML_SIZE                = 10000000                 # Limit HTML to this size
+HTML_PAGE_LINES              = 5000                     # Lines in each page of HTML (--htmlpages)
+HTML_INDEX_PAGES             = 20                       # Pages of HTML written between updates of the index
+HTML_PAGES_EXT               = ".pages"                 # Directory of the HTML pages, next to the HTML file
+FILE_OUTPUT_LINES            = 256                      # Lines decoded from a file per write
+MAPPED_BLOCK_SIZE            = 4194304                  # Bytes of a mapped file handled at a time
+LINE_SEARCH_SIZE             = 4096                     # Bytes looked through at a time for a line end
+PARALLEL_CHUNKS_PER_JOB      = 4                        # Pieces of a file handed to each decoding process
+PARALLEL_MIN_CHUNK_SIZE      = 262144                   # Smaller files are decoded serially
+PARALLEL_WARMUP_LINES        = 1000                     # Lines decoded ahead of a piece to pick up its state
+PROFILE_FOLD_TIME            = 1.0                      # Seconds between adding up profiled flow records
+PROFILE_REPORT_LINES         = 20                       # Flows and call paths shown by "profile"
+SYMBOL_PUBLISH_TIME          = 0.5                      # Seconds between showing the symbols loaded so far
+SYMBOL_HELD_LINES            = 100000                   # Trace lines decoded again once the symbols are loaded
+FLASH_BLOCK_SIZE             = 65536                    # Bytes of a flash file read and sent at a time
+FLASH_REPORT_TIME            = 2.0                      # Seconds between flash progress reports
+ARCHIVE_BLOCK_RECORDS        = 4096                     # Trace records in each indexed block of an archive
+ARCHIVE_QUERY_LIMIT          = 1000                     # Most records shown by "query"
+DEFAULT_FIFO_MAX_LINES       = 1000000                  # Limit lines waiting to be processed
+DEFAULT_FIFO_MAX_BYTES       = 104857600                # Limit bytes waiting to be processed
+FIFO_POLICIES                = ['block', 'spill', 'drop']   # What to do when the limit is reached
+PCS_DEVICE_TTL               = 30                       # Seconds a PCS device's id is used before asking again
+PCS_QUERY_SOCKETS            = 8                        # Most PCS sockets asking for device ids at once
 
 # Config files in user's $HOME/.sift directory
 SIFT_CONFIG_DIR              = os.path.expanduser(os.path.join('~',".sift"))
@@ -125,6 +159,7 @@ LAST_FILE                    = "sift.lastfile"          # last file used
 ALL_DIRECTORY                = "compile"                #
 SHELF_FILE                   = "sift.persist"           # persistent things to remember
 SETTINGS_FILE                = "sift.settings"          # persistent settings
+SYMBOL_CACHE_DIR             = "symbols"                # parsed .i and .hlg files
 USAGE_FILE                   = "sift.usage"             # usage transmissions
 SIFT_SERVER                  = "http://sift.vcd.hp.com/"
 USAGE_SCRIPT                 = "postusage.php"
@@ -144,6 +179,7 @@ PORT_NAMES_TO_NUMBER         = {"pcs":PCS_PORT, "shell":SHELL_PORT, "udw":UDW_PO
 ERROR_PREFIX                 = "\nSIFT: "
 PROJ_DIR_INFO                = "proj_dir_info.spd"
 PROMPT                       = "-> "
+SYMBOLS_LOADED               = "\0symbols loaded"       # Fifo item: decode the lines held while loading
 ECHO_PROMPT                  = ';udw.echo "' + PROMPT + '";'
 TAB_COMPLETION_ASK_USER      = 10
 # EOLN                         = "\r\n"
@@ -153,6 +189,9 @@ GOODBYE                      = "Press <ENTER> to quit"
 PJL_ENTER_UDW                = "@PJL ENTER LANGUAGE=UDW\n"
 PJL_EXIT_UDW                 = "exit;\x1B%-12345X"
 PJL_UDW_TIMEOUT              = 60*5
+UPLOAD_WINDOW                = 8                        # underware lines sent ahead of the printer's prompts
+UPLOAD_STALL_TIME            = 1.0                      # seconds without a prompt before pacing the lines
+UPLOAD_PACE_TIME             = 0.2                      # seconds between lines while the printer isn't prompting
 SYNC_STRING                  = "sync"
 FLOWC                        = "flowc"
 FLOWCEXE                     = "flowc.exe"
@@ -174,11 +213,11 @@ SIFT_COMMANDS = ["pwd","b","break","port","trace","level","tick","tock",
                  "sdv","browse","sweep","nosweep","depth","door","power","tap",
                  "vtap","serial_number","dot4","flash","lp","compile","download","cad",
                  "rev","exit","assert","crash","print","info","exec","save","reload",
-                 "ok","options","watch","help","quit","q", "edit"]
+                 "profile","query","session","ok","options","watch","help","quit","q", "edit"]
                 
 # Array of internal sift commands used for unpausing
 internal_cmd = ["pwd", "calls", "bt", "backtrace", "where", "w", "l", "l+",
-    "l-", "l.", "print", "help"]
+    "l-", "l.", "print", "help", "profile", "query", "session"]
 
 # Trace command bitfield
 TRACE_FLUSH     = 0x01
@@ -249,6 +288,19 @@ err_codes["PYSERIAL_ERROR"]      = ErrCode(19, False, "Install pySerial to user
 err_codes["RESET_EXIT"]          = ErrCode(20, True,  "Settings reset. Restart Sift.")
 err_codes["USER_EXIT"]           = ErrCode(99, False, "User exit.")
 
+# Write out the output the log files have queued (their writer threads die with the process)
+def flush_log_files():
+    log_files = [globals().get(name) for name in ("output_file", "html_output_file", "raw_output_file")]
+    if globals().get("process_fifo_thread"):
+        log_files.append(process_fifo_thread.fifo.spill_file)
+    for session in sessions.values():
+        log_files += [session.output_file, session.raw_file, session.fifo.spill_file]
+    for log_file in log_files:
+        if log_file:
+            try:
+                log_file.flush()
+            except: pass
+
 # Call when one of the above errors, call this:
 def exit(error):
     global gui
@@ -258,8 +310,10 @@ def exit(error):
             if (os.name == "nt"): raw_input(GOODBYE)
             quit_event.set()
             if error in err_codes:
+                flush_log_files()
                 sys.exit(err_codes[error].code)
     else:
+        flush_log_files()
         sys.exit(0)
 
 # List the error codes for Sift Launch Pad
@@ -415,7 +469,6 @@ def init_arrays_and_dictionaries():
     global flows
     global flows_by_id
     global flows_by_name
-    global frames
     global keywords
     global keywords_by_id
     global keywords_by_name
@@ -430,7 +483,7 @@ def init_arrays_and_dictionaries():
     global statement_by_file_line
     global filenames
     global everything
-    global everything_dictionary
+    global completion_index
     global fml_path_by_file_name
     global underware
     global lua_file
@@ -438,22 +491,21 @@ def init_arrays_and_dictionaries():
     flows                  = []
     flows_by_id            = {}    # Flows by id
     flows_by_name          = {}    # Flows by name
-    frames                 = {}    # Keeps track of flows for break point backtrace print out
     keywords               = []
     keywords_by_id         = {}
     keywords_by_name       = {}    # Keyword objects by ID
-    global_ids             = {}    # key=ID, value=name
+    global_ids             = {}    # key=ID (int), value=name
     global_names           = {}    # key=name, value=ID
     constant_ids           = {}    # key=id, value=name
     constant_names         = {}    # key=name, value=id
     constant_values        = {}    # key=value, value=(list of names)
     constant_name2value    = {}    # key=name, value=value
     values_for             = {}
-    statement_by_offset    = {}     # key=offset, value=statement
+    statement_by_offset    = OffsetTable()  # key=offset (int), value=statement
     statement_by_file_line = {}     # key=filename,line, value=statement
     filenames              = []     # list of filenames
     everything             = []     # list of everything (for keyword completion)
-    everything_dictionary  = {}     # alphabetized dictionary of everything used for tab completion
+    completion_index       = CompletionIndex()  # sorted everything used for tab completion
     fml_path_by_file_name  = {}     # Keeps track or fml file locations
     underware              = []     # list of underware commands
     lua_file               = {}     # lua trace file names, indexed by "indent" field
@@ -461,6 +513,8 @@ def init_arrays_and_dictionaries():
     for i in range(8):
         lua_file[i] = {'file':"", 'func':""}  # set some defaults for first "indent" level
 
+    file_sections.clear()                   # error decoders re-read the new .hlg and .i files
+
     # If in a Sirius build directory append XM lua directories to our search path for getline().
     try:
         f = open(os.getcwd() + "/subdirs_xm", 'r')
@@ -471,7 +525,6 @@ def init_arrays_and_dictionaries():
 
 
 # Runtime data
-flow_stack             = {}    # key=indent, value=flow
 conn2color             = {}    # key=socket connection, value = clue to which color code to use
 
 
@@ -740,6 +793,10 @@ class SerialPort(BasePort):
 #
 ##############################################################################################
 
+SOCKET_POLL_TIME = .3                       # how often a waiting read checks the port is still open
+SOCKET_RECEIVE_SIZE = 65536                 # most we take from the socket at a time
+SOCKET_WRITE_TIMEOUT = 3                    # reads wait in select, this only limits writes
+
 class SocketPort(BasePort):
     def __init__(self, printer_is_open_event):
         """Create our socket"""
@@ -747,6 +804,7 @@ class SocketPort(BasePort):
         super(SocketPort, self).__init__(printer_is_open_event)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket_port_open = False
+        self.received = ""                  # received but not yet read
 
     def open(self, hostname=None, port=None, mark_printer_open=True):
         """Open our socket"""
@@ -796,6 +854,8 @@ class SocketPort(BasePort):
             if num_sent != 1:
                 debug("SocketPort RAISE NoService(Printer closed connection)", self.socket_port_open)
                 raise NoService("Printer closed connection")
+        self.socket.settimeout(SOCKET_WRITE_TIMEOUT)
+        self.received = ""
         self.socket_port_open = True
         self.running_shell = True
         self.name = self.hostname
@@ -819,84 +879,76 @@ class SocketPort(BasePort):
         debug("SocketPort.return", self.socket_port_open)
 
     def read(self, size=None):
-        """Read a block of characters"""
+        """Read a block of characters. With a size, wait for exactly size characters,
+           otherwise return whatever has arrived as soon as anything has."""
         if options.debug: debug("SocketPort.read", size, self.socket_port_open)
-        if not self.socket_port_open:
-            raise LostService("Socket closed")
-
-        begin = 0 
-        last = 0 
-        total_data=[]
-        self.socket.settimeout(.3)
         try:
-            while self.socket_port_open and (size==None or size>0):
-                # If no size, read a max of .3s or until idle for .05s 
-                now = time.time()
-                #                                gather data for     max quiet time 
-                if not size and total_data and (now-begin > 0.05 or now-last > 0.02):
-                    if options.debug: debug("SocketPort.read got data")
-                    break
-
-                # otherwise keep trying to read data
-                try:
-                    if size:
-                        data = self.socket.recv(size)
-                    else:
-                        data = self.socket.recv(8192)
-                    if data:
-                        if size: 
-                            size -= len(data)
-                        else:
-                            now = time.time()
-                            last = now
-                            if len(total_data) == 0:    # data has begin arriving
-                                begin = now
-                                self.socket.settimeout(.02)
-                            if options.debug: debug("SocketPort.read data", len(data), now-last, now-begin) 
-                        total_data.append(data)
-                    else:
-                        if options.debug: debug("SocketPort.read RAISE LostService(Host disconnected)")
-                        raise LostService("Host disconnected")
-
-                # Socket timeout occured, okay, loop around again 
-                except socket.timeout:
-                    now = time.time()
-                    if options.debug: debug("SocketPort.read timeout", now-last, now-begin)
-                    pass
-                
-                # Some other failure
-                except socket.error, message:
-                    raise LostService("Connection reset")
-
-                # During shutdown, we might loose our socket
-                except AttributeError:
-                    raise LostService("Socket went bad")
-
-            if not self.socket_port_open:
-                raise LostService("Socket port closed")
-
+            if size:
+                while len(self.received) < size:
+                    self.receive()
+                data_received = self.received[:size]
+                self.received = self.received[size:]
+            else:
+                while not self.received:
+                    self.receive()
+                data_received = self.received
+                self.received = ""
         except LostService:
             debug("SocketPort.read RAISE LostService")
             self.close(loss_expected=False)
             raise
 
-        data_received = "".join(total_data)
         self.data_seen_event.set()
-        if options.debug: 
-            debug("SocketPort.read returns", len(total_data), "blocks as", len(data_received), "bytes")
+        if options.debug: debug("SocketPort.read returns", len(data_received), "bytes")
         return data_received
 
     def readline(self, size=-1):
         """Read until a LF"""
-        line = ""
-        while size != 0:
-            ch = self.read(1)
-            line += ch
-            if ch == '\n':
-                break
-            size -= 1
+        try:
+            while True:
+                end = self.received.find('\n') + 1
+                if end:
+                    break
+                if size >= 0 and len(self.received) >= size:
+                    end = size
+                    break
+                self.receive()
+        except LostService:
+            debug("SocketPort.readline RAISE LostService")
+            self.close(loss_expected=False)
+            raise
+        if size >= 0:
+            end = min(end, size)
+        line = self.received[:end]
+        self.received = self.received[end:]
+        self.data_seen_event.set()
         return line
 
+    def receive(self):
+        """Wait until the socket is readable, then add what is waiting on it to self.received.
+           Wakes every SOCKET_POLL_TIME to notice the port being closed."""
+        while True:
+            if not self.socket_port_open:
+                raise LostService("Socket port closed")
+            try:
+                if not select.select([self.socket], [], [], SOCKET_POLL_TIME)[0]:
+                    continue
+                data = self.socket.recv(SOCKET_RECEIVE_SIZE)
+            # Some other failure
+            except (socket.error, select.error), message:
+                if not self.socket_port_open:
+                    raise LostService("Socket port closed")
+                raise LostService("Connection reset")
+            # During shutdown, we might loose our socket
+            except (AttributeError, ValueError):
+                raise LostService("Socket went bad")
+            if not data:
+                if options.debug: debug("SocketPort.receive RAISE LostService(Host disconnected)")
+                raise LostService("Host disconnected")
+            if options.debug: debug("SocketPort.receive data", len(data))
+            self.received += data
+            return
+
     def write(self, data):
         """Write data to the socket"""
         if options.debug: debug("SocketPort.write", len(data), self.socket_port_open)
@@ -937,7 +989,7 @@ class PCSPort(SocketPort):
         self.start_pcs = start_pcs
         self.pcs_socket_open = False
         self.pcs_port_open = False
-        self.last_write_time = 0
+        self.last_write_time = 0                # each connection is a new PJL job
 
     def open_pcs_socket_if_needed(self, hostname=None):
         """If not already open, open underlying socket to printer"""
@@ -999,21 +1051,21 @@ class PCSPort(SocketPort):
         self.terminator = ';'
         return result
 
-    def printers(self, specifier=None, hostname=None):
+    def printers(self, specifier=None, hostname=None, refresh=False):
         """Get a list of all the printers available, filtering by an optional specifier.
-           Doesn't require socket to have been opened yet so that we can query printers
-           before opening a connection."""
+           The devices come from pcs_registry, which keeps its own socket to PCS and
+           the device ids for a while (refresh asks for them all again)."""
         debug("PCSPort.printers", specifier)
-        we_opened_socket = self.open_pcs_socket_if_needed(hostname)
-        result = []
-        for device in self.list():
-            device_id, model, serial = self.device_id(device)
-            debug("PCSPort.printers", device_id, model, serial)
-            if not specifier or ((specifier in device) or (specifier in device_id)):
-                output_str(" Found printer: "+model+" "+serial+EOLN)
-                result.append((device, model, serial))
-        if we_opened_socket:               # If socket wasn't open, close it 
-            self.close_socket()
+        while True:
+            result = []
+            for device, device_id, model, serial in pcs_registry.devices(hostname, self.start_pcs, refresh):
+                debug("PCSPort.printers", device_id, model, serial)
+                if not specifier or ((specifier in device) or (specifier in device_id)):
+                    output_str(" Found printer: "+model+" "+serial+EOLN)
+                    result.append((device, model, serial))
+            if result or refresh or not specifier:
+                break
+            refresh = True                  # a cached id may be out of date (e.g. now in reflash)
         debug("PCSPort.printers =", result)
         return result 
 
@@ -1024,9 +1076,11 @@ class PCSPort(SocketPort):
         global quit_event
         debug("PCSPort.open", specifier, channel, hostname)
         try:
-            self.open_pcs_socket_if_needed(hostname)
+            refresh = False
             while not quit_event.isSet():
-                printers = self.printers(specifier)
+                printers = self.printers(specifier, hostname, refresh)
+                refresh = False
+                chosen = None
                 if len(printers) == 0:
                     if specifier:
                         output_str("  Waiting for PCS "+specifier+EOLN, "info")
@@ -1034,8 +1088,7 @@ class PCSPort(SocketPort):
                     else:
                         raise NoService("Printer not found")
                 elif gui or len(printers) == 1:
-                    device, self.model, self.serial = printers[0]
-                    break
+                    chosen = printers[0]
                 else:
                     choice = 0
                     output_str("Printers found:"+EOLN, "info")
@@ -1050,11 +1103,20 @@ class PCSPort(SocketPort):
                         pass
                     else:
                         if user_choice >= 0 and user_choice < len(printers):
-                            device, model, serial = printers[user_choice]
-                            break
+                            chosen = printers[user_choice]
+
+                # The ids are kept a while, check the device is still the printer chosen
+                if chosen:
+                    self.open_pcs_socket_if_needed(hostname)
+                    if self.device_id(chosen[0])[1:] == chosen[1:]:
+                        device, self.model, self.serial = chosen
+                        break
+                    debug("PCSPort.open", chosen[0], "is another printer now")
+                    refresh = True
             if quit_event.isSet():
                 raise NoService("User quitting")
 
+            self.last_write_time = 0                    # a new connection needs ENTER LANGUAGE=UDW
             if channel == "shell":                      # Remove when shell channel implemented
                 self.connect(device, "debug")
             else:
@@ -1113,6 +1175,93 @@ class PCSPort(SocketPort):
           raise NoService("Couldn't start PCS")
 
 
+##############################################################################################
+#
+# PCS Registry  --  The devices each PCS server has
+#
+# Listing printers used to open a socket to PCS and ask for the device id of every device,
+# every time. The registry keeps a socket open to each PCS server for listing, keeps the
+# device ids for PCS_DEVICE_TTL seconds, and asks for the ids it needs over several sockets
+# at once. Connecting to a printer still uses a socket of its own (PCSPort), since PCS
+# hands the socket over to the printer.
+#
+##############################################################################################
+
+class PCSRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.control = {}                   # hostname: PCSPort kept open for listing devices
+        self.ids = {}                       # (hostname, device): (time, (device_id, model, serial))
+
+    def devices(self, hostname=None, start_pcs=False, refresh=False):
+        """[(device, device_id, model, serial)] for the devices PCS has now"""
+        hostname = hostname or "localhost"
+        with self.lock:
+            try:
+                devices = self.control_port(hostname, start_pcs).list()
+            except (NoService, LostService, socket.error):
+                self.close_control(hostname)        # PCS may have restarted, try again once
+                devices = self.control_port(hostname, start_pcs).list()
+
+            now = time.time()
+            stale = [device for device in devices if refresh or
+                        now - self.ids.get((hostname, device), (0, None))[0] > PCS_DEVICE_TTL]
+            for device, info in self.query_ids(hostname, stale).items():
+                self.ids[(hostname, device)] = (now, info)
+            return [(device,) + self.ids[(hostname, device)][1] for device in devices
+                        if (hostname, device) in self.ids]
+
+    def control_port(self, hostname, start_pcs):
+        port = self.control.get(hostname)
+        if not port:
+            port = PCSPort(start_pcs=start_pcs)
+            port.open_pcs_socket_if_needed(hostname)
+            self.control[hostname] = port
+        return port
+
+    def close_control(self, hostname):
+        port = self.control.pop(hostname, None)
+        if port:
+            port.close_socket()
+
+    def query_ids(self, hostname, devices):
+        """Ask PCS for the ids of devices, on up to PCS_QUERY_SOCKETS sockets at once"""
+        if len(devices) <= 1:
+            port = self.control[hostname]
+            return dict((device, port.device_id(device)) for device in devices)
+
+        results = {}
+        def query(devices):
+            port = PCSPort()
+            try:
+                port.open_pcs_socket_if_needed(hostname)
+                for device in devices:
+                    results[device] = port.device_id(device)
+            except (NoService, LostService, socket.error), e:
+                debug("PCSRegistry.query_ids", hostname, e)
+            port.close_socket()
+        sockets = min(len(devices), PCS_QUERY_SOCKETS)
+        threads = [threading.Thread(target=query, args=(devices[i::sockets],)) for i in xrange(sockets)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Anything the other sockets couldn't get is asked for here
+        port = self.control[hostname]
+        for device in devices:
+            if device not in results:
+                results[device] = port.device_id(device)
+        return results
+
+    def close(self):
+        with self.lock:
+            for hostname in self.control.keys():
+                self.close_control(hostname)
+
+pcs_registry = PCSRegistry()
+
+
 ##############################################################################################
 #
 # Connection Class  --  Establish connections to various ports. (Port Factory) 
@@ -1198,16 +1347,16 @@ class Connection():
 
                 self.pcs_specifier = m.group("specifier")
 
-    def open(self, port_str=None, start_server=False):
+    def open(self, port_str=None, start_server=False, remember=True):
         """Open a connection to the printer. port_str is the exact same
-           format as the --port argument."""
+           format as the --port argument. remember saves it as the last port used."""
         output_str(' '+'-'*80+EOLN)
         if port_str:                                    # Otherwise assume already opened before
             self.__init__(self.is_open_event)           # Re-init our instance variables
             self.port_str = port_str                    # Save for next time
             self.parse_port_str(port_str)               # Parse out the constituents
             try:                                        # Save in LASTPORT_FILE
-                if r"#reflash" not in self.port_str:
+                if remember and (r"#reflash" not in self.port_str):
                     with open(os.path.join(SIFT_CONFIG_DIR, LASTPORT_FILE), 'w') as f:
                         f.write(self.port_str+'\n')
             except IOError: pass
@@ -1257,13 +1406,15 @@ class Printer():
     def __init__(self):
         self.is_open_event = threading.Event()              # event if printer open/closed
         self.port = NoConnectionPort(self.is_open_event)    # default no connection
+        self.prompts = threading.Condition()                # notified for each prompt read
+        self.prompt_count = 0
 
-    def open(self, port_str=None):
+    def open(self, port_str=None, remember=True):
         if port_str:                            # if no new port_str, keep old
             self.port_str = port_str
         if self.is_open_event:
             self.close()
-        self.port = Connection(self.is_open_event).open(self.port_str)
+        self.port = Connection(self.is_open_event).open(self.port_str, remember=remember)
         debug("Printer.open return", self.is_open_event.isSet(), self.is_open_event)
         if gui: gui.io_ready()
 
@@ -1284,6 +1435,78 @@ class Printer():
             output_str(line + EOLN, "comment")
         self.port.write(line + "\n")
 
+    def prompted(self):
+        """The printer has sent a prompt (called by PortToFifoThread)"""
+        with self.prompts:
+            self.prompt_count += 1
+            self.prompts.notifyAll()
+
+    def upload(self, lines):
+        """Send underware commands as fast as the printer takes them. Up to UPLOAD_WINDOW
+        are sent ahead of the prompts answering them; when the prompts stop the rest are
+        paced UPLOAD_PACE_TIME apart until they come again. Returns the number sent."""
+        echo = self.port.running_udw        # a udw connection only prompts when asked to
+        with self.prompts:
+            first_prompt = self.prompt_count
+        sent = 0
+        paced = 0                           # lines taken as answered without a prompt, until
+        paced_at = first_prompt             # the prompts after paced_at come in for them
+        wait_time = UPLOAD_STALL_TIME
+
+        def unpaid():                       # paced lines no prompt has come in for yet
+            return max(0, paced - (self.prompt_count - paced_at))
+
+        def waiting():                      # lines not answered yet (caller holds prompts)
+            return max(0, sent - (self.prompt_count - first_prompt) - unpaid())
+
+        for line in lines:
+            with self.prompts:
+                while waiting() >= UPLOAD_WINDOW:
+                    count = self.prompt_count
+                    self.prompts.wait(wait_time)
+                    if self.prompt_count != count:
+                        wait_time = UPLOAD_STALL_TIME
+                    else:                   # stalled, pace the lines until it prompts again
+                        (paced, paced_at) = (unpaid() + 1, self.prompt_count)
+                        wait_time = UPLOAD_PACE_TIME
+            if not self.is_open_event.isSet():
+                break
+            if echo:
+                line = line.strip() + ECHO_PROMPT
+            self.udw(line)
+            sent += 1
+
+        # Let the last lines be taken before anything else is sent
+        with self.prompts:
+            while waiting() > 0:
+                count = self.prompt_count
+                self.prompts.wait(UPLOAD_STALL_TIME)
+                if self.prompt_count == count:
+                    break
+        return sent
+
+    def send_flash_file(self, flash_file, flash_device):
+        """Send the flash file FLASH_BLOCK_SIZE at a time, reporting the progress"""
+        size = os.fstat(flash_file.fileno()).st_size
+        sent = 0
+        start = last_report = time.time()
+        while True:
+            block = flash_file.read(FLASH_BLOCK_SIZE)
+            if not block:
+                break
+            flash_device.write(block)
+            sent += len(block)
+            now = time.time()
+            if now - last_report >= FLASH_REPORT_TIME:
+                last_report = now
+                rate = sent / (now - start)
+                output_str("  %d of %d KB (%d%%), %d KB/s, %d seconds left%s" % (sent/1024, size/1024,
+                    100*sent/max(size, 1), rate/1024, (size - sent)/max(rate, 1), EOLN), "info")
+        if hasattr(flash_device, "flush"):
+            flash_device.flush()
+        elapsed = max(time.time() - start, 0.001)
+        output_str("  %d KB in %.1f seconds, %d KB/s%s" % (sent/1024, elapsed, sent/elapsed/1024, EOLN), "info")
+
     def flash(self, file):
         """Flash the given file to the printer"""
 
@@ -1421,7 +1644,7 @@ class Printer():
             else:
                 # save_debug = options.debug; options.debug = False
                 debug("Writing flash file")
-                flash_device.write(flash_file.read())
+                self.send_flash_file(flash_file, flash_device)
                 # options.debug = save_debug
         except IOError:
             output_str("IOError: Flash file couldn't be sent !!"+EOLN, "error")
@@ -1430,15 +1653,18 @@ class Printer():
             time.sleep(2)
 
         output_str("Finishing up flash process."+EOLN, "info")
-        init_arrays_and_dictionaries()
-        init_arrays_and_dict_for_hlg()
         if gui: gui.process_events()
         if flash_file: flash_file.close()
         if flash_device: flash_device.close()
 
-        # Reprocess .i and .hlg files
-        output_str("Reprocessing symbols."+EOLN, "info")
-        find_and_process_i_and_hlg_files()
+        # Reprocess .i and .hlg files (if they've been rebuilt, or others would be picked now)
+        if symbol_files(*choose_symbol_files()) != symbol_files_loaded:
+            output_str("Reprocessing symbols."+EOLN, "info")
+            init_arrays_and_dictionaries()
+            init_arrays_and_dict_for_hlg()
+            find_and_process_i_and_hlg_files()
+        else:
+            output_str("Symbols unchanged."+EOLN, "info")
 
         # Track
         UsageThread("flash").start()
@@ -1493,6 +1719,10 @@ hostname_re = \
 # LF to CRLF
 eoln_re = re.compile("\r?\n")
 
+# Tags (and the times) in HTML output, and the words in what's left (lower case)
+html_tag_re  = re.compile("<span class=time>[^<]*|<[^>]*>")
+html_word_re = re.compile("[a-z_][a-z0-9_]+")
+
 # Timestamp of a standard DEBUG_printf() serial line
 timestamp_re = re.compile("^\w+ +(?P<time>[0-9]+\.[0-9]{2})[0-9] \(")
 
@@ -1592,18 +1822,23 @@ assert(m.group("specifier") == "sam")
 # The Flow class. This data structure holds information about each flow. It is
 # created when we parse the .i file.
 class Flow(object):
-  def __init__(self, id=None, name=None, numArgs=None, argList=None, locals=None, value_for=None):
+  __slots__ = ("id", "name", "numArgs", "argList", "locals", "value_for", "filename", "lineNum")
+
+  def __init__(self, id=None, name=None, numArgs=None, argList=None, locals=None, value_for=None,
+               filename=None, lineNum=None):
     self.id   = id
     self.name = name
     self.numArgs = numArgs
     self.argList = argList
     self.locals = locals
     self.value_for = value_for
-    self.filename = None
-    self.lineNum = None
+    self.filename = filename
+    self.lineNum = lineNum
 
 # The Frame class. This data structure holds information about each frame
 class Frame(object):
+  __slots__ = ("flow_call", "locals", "flow", "time_highorder", "time")
+
   def __init__(self, flow_call=None, time_highorder = 0, time = 0):
       self.flow_call = flow_call
       self.locals = {}
@@ -1613,6 +1848,8 @@ class Frame(object):
 
 # The Keyword class. This data structure holds information about each keyword.
 class Keyword(object):
+  __slots__ = ("id", "name", "numArgs", "argList")
+
   def __init__(self, id=None, name=None, numArgs=None, argList=None):
     self.id   = id
     self.name = name
@@ -1621,6 +1858,8 @@ class Keyword(object):
 
 # The Statement class. This data structure holds information about each statement.
 class Statement(object):
+  __slots__ = ("offset", "flow", "line_number", "file_name")
+
   def __init__(self, offset=None, flow=None, line_number=None, file_name=None):
     self.offset      = offset
     self.flow        = flow
@@ -1629,43 +1868,217 @@ class Statement(object):
 
 # The Header class. This data structure holds information about each header.
 class Header(object):
+  __slots__ = ("id", "name", "numArgs", "argList")
+
   def __init__(self, id=None, name=None, numArgs=None, argList=None):
     self.id   = id
     self.name = name
     self.numArgs = numArgs
     self.argList = argList
 
-# Class that implements a fifo which blocks waiting for data
+# Statements by offset. A big .i file has hundreds of thousands of statements, so rather
+# than a dictionary the offsets are kept as a sorted array of ints with the statements in
+# a list alongside, and looked up by bisection. Reads like a dictionary keyed by offset.
+class OffsetTable(object):
+  __slots__ = ("offsets", "statements", "in_order")
+
+  def __init__(self, items=()):
+    self.offsets = array.array('l')
+    self.statements = []
+    self.in_order = True
+    self.update(items)
+
+  def __setitem__(self, offset, statement):
+    offset = int(offset)
+    if self.offsets and (offset <= self.offsets[-1]):
+      self.in_order = False
+    self.offsets.append(offset)
+    self.statements.append(statement)
+
+  def update(self, items):
+    if hasattr(items, "iteritems"):
+      items = items.iteritems()
+    items = list(items)
+    if items:
+      (offsets, statements) = zip(*items)
+      offsets = map(int, offsets)
+      if ((self.offsets and (offsets[0] <= self.offsets[-1])) or (offsets != sorted(offsets))
+          or (len(set(offsets)) != len(offsets))):
+        self.in_order = False
+      self.offsets.extend(offsets)
+      self.statements.extend(statements)
+
+  def sort(self):
+    """Put the offsets in order (done once after adding them), the last one added wins"""
+    if self.in_order:
+      return
+    offsets = self.offsets
+    order = sorted(xrange(len(offsets)), key=offsets.__getitem__)
+    order = [i for (n, i) in enumerate(order)
+             if (n + 1 == len(order)) or (offsets[order[n+1]] != offsets[i])]
+    self.offsets = array.array('l', [offsets[i] for i in order])
+    self.statements = [self.statements[i] for i in order]
+    self.in_order = True
+
+  def index(self, offset):
+    """Position of offset in the table, -1 if it isn't there"""
+    self.sort()
+    i = bisect.bisect_left(self.offsets, offset)
+    if (i < len(self.offsets)) and (self.offsets[i] == offset):
+      return i
+    return -1
+
+  def __getitem__(self, offset):
+    i = self.index(int(offset))
+    if i < 0:
+      raise KeyError(offset)
+    return self.statements[i]
+
+  def get(self, offset, default=None):
+    i = self.index(int(offset))
+    if i < 0:
+      return default
+    return self.statements[i]
+
+  def __contains__(self, offset):
+    return self.index(int(offset)) >= 0
+
+  def __len__(self):
+    self.sort()
+    return len(self.offsets)
+
+  def keys(self):
+    self.sort()
+    return self.offsets.tolist()
+
+  def values(self):
+    self.sort()
+    return list(self.statements)
+
+  def iteritems(self):
+    self.sort()
+    return iter(zip(self.offsets, self.statements))
+
+# Class that implements a fifo which blocks waiting for data.
+# Lines are added and removed a batch at a time with one lock operation per batch.
+# When the fifo grows past max_lines or max_bytes (0 means no limit), the policy decides
+# what happens to newly arriving batches:
+#    'block' - the adding thread waits until the reading thread has caught up
+#    'spill' - lines bypass the fifo and are written straight to a spill file (not the raw
+#              file, which has the lines in the order they're processed)
+#    'drop'  - lines are discarded
+# For 'spill' and 'drop' a marker line with the number of lines lost is queued once
+# there is room again.
 class Fifo():
-    def __init__(self):
+    def __init__(self, max_lines=0, max_bytes=0, policy='block', spill_name=None):
         self.fifo = collections.deque()
-        self.semaphore = threading.Semaphore(0)
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
         self.lines_appended = 0
+        self.bytes_queued = 0
+        self.lines_dropped = 0
+        self.lines_spilled = 0
+        self.lines_missing = 0              # dropped or spilled lines not yet reported
+        self.spill_name = spill_name        # name of the spill file (made from the options if None)
+        self.spill_file = None              # LogFile opened at the first spill
         self.open = True
+        self.set_limits(max_lines, max_bytes, policy)
+
+    def set_limits(self, max_lines=0, max_bytes=0, policy='block'):
+        with self.lock:
+            self.max_lines = max_lines
+            self.max_bytes = max_bytes
+            self.policy = policy
+            self.not_full.notifyAll()
 
     def __len__(self):
         return len(self.fifo)
 
+    def full(self):
+        return ((self.max_lines and len(self.fifo) >= self.max_lines) or 
+                (self.max_bytes and self.bytes_queued >= self.max_bytes))
+
     def append(self,item):
-        self.fifo.appendleft(item)
-        self.semaphore.release()
-        self.lines_appended += 1
-        if gui:
-            gui.pace = len(self.fifo) 
+        self.extend([item])
+
+    def extend(self, items):
+        """Append a list of items"""
+        if not items:
+            return
+        size = sum(map(len, items))
+        with self.lock:
+            if self.full() and self.policy == 'block':
+                while self.open and self.full() and self.policy == 'block':
+                    self.not_full.wait(1)
+            if self.full():
+                # over the high-water mark; lose this batch
+                self.lines_missing += len(items)
+                if self.policy == 'spill' and self.open_spill_file():
+                    self.lines_spilled += len(items)
+                else:
+                    self.lines_dropped += len(items)
+                    items = None
+            else:
+                if self.lines_missing:
+                    if self.spill_file and self.spill_file.file:
+                        lost = "written only to " + self.spill_file.name
+                    else:
+                        lost = "dropped"
+                    marker = "<<< Sift input fifo full: %d lines %s >>>%s" % (self.lines_missing, lost, EOLN)
+                    self.fifo.append(marker)
+                    self.bytes_queued += len(marker)
+                    self.lines_missing = 0
+                self.fifo.extend(items)
+                self.bytes_queued += size
+                self.lines_appended += len(items)
+                self.not_empty.notify()
+                items = None
+            if gui:
+                gui.pace = len(self.fifo) 
+
+        if items:
+            self.spill_file.write("".join([item.rstrip() + '\n' for item in items]))
+
+    def open_spill_file(self):
+        """Open the spill file if it isn't yet, return whether lines can be spilled to it"""
+        if not self.spill_file:
+            self.spill_file = LogFile(SPILL_FILE, max_size=max_output_file_size, name=self.spill_name)
+        return self.spill_file.file is not None
+
+    def close_spill_file(self):
+        if self.spill_file:
+            self.spill_file.close()
 
     def pop(self, blocking=True):
-        if self.open:
-            if self.semaphore.acquire(blocking):
-                if self.open:
-                    if gui:
-                        gui.pace = len(self.fifo)
-                    return self.fifo.pop()
-        raise RuntimeError
+        items = self.pop_batch(1, blocking)
+        return items[0]
+
+    def pop_batch(self, max_items=1000, blocking=True):
+        """Remove and return a list of up to max_items items, waiting for at least one"""
+        with self.lock:
+            while self.open and not self.fifo and blocking:
+                self.not_empty.wait()
+            if not self.open or not self.fifo:
+                raise RuntimeError
+            fifo = self.fifo
+            if len(fifo) <= max_items:
+                items = list(fifo)
+                fifo.clear()
+            else:
+                items = [fifo.popleft() for i in xrange(max_items)]
+            self.bytes_queued -= sum(map(len, items))
+            self.not_full.notify()
+            if gui:
+                gui.pace = len(fifo)
+            return items
 
     def close(self):
-        self.open = False
-        self.append("")
-
+        with self.lock:
+            self.open = False
+            self.not_empty.notifyAll()
+            self.not_full.notifyAll()
+        self.close_spill_file()
 
 #
 # When we output results, we need to format the output as per the
@@ -1673,8 +2086,7 @@ class Fifo():
 # a terminal, HTML for a browser, etc.
 #
 def process_color(color_dictionary, new_text_type, text_type):
-    global line_class
-    global line_indent
+    rb = render_buffer
 
     # If this is a pop format and the terminal supports , use the pop string
     if ("pop" in new_text_type):
@@ -1691,16 +2103,52 @@ def process_color(color_dictionary, new_text_type, text_type):
         replaced_template = (text_template) % (text_type)
     except TypeError:
         try:
-            replaced_template = (text_template) % (line_indent)
+            replaced_template = (text_template) % (rb.line_indent)
         except TypeError:
-            if line_class == None:  line_class = "text"
-            if line_indent == None: line_indent = 99
+            if rb.line_class == None:  rb.line_class = "text"
+            if rb.line_indent == None: rb.line_indent = 99
             try:
-                replaced_template = (text_template) % (line_class, line_indent)
+                replaced_template = (text_template) % (rb.line_class, rb.line_indent)
             except TypeError:
                 replaced_template = text_template
     return(replaced_template)
 
+#
+# process_color() for one color dictionary, remembering what each text type comes out
+# as instead of working it out (through TypeErrors) every time.
+#
+class ColorTable(object):
+    def __init__(self, color_dictionary):
+        self.color_dictionary = color_dictionary
+        self.results = {}       # key=(new_text_type, text_type), value=(result, template has no arguments)
+
+    def color(self, new_text_type, text_type):
+        try:
+            (result, static) = self.results[new_text_type, text_type]
+        except KeyError:
+            name = new_text_type
+            if ("pop" in name) and (name not in self.color_dictionary):
+                name = "popdefault"
+            template = self.color_dictionary.get(name, self.color_dictionary["default"])
+            static = ('%' not in template)
+            if static:
+                result = template
+            else:
+                try:
+                    result = template % (text_type)
+                except TypeError:   # depends on the line being output, so can't be remembered
+                    return process_color(self.color_dictionary, new_text_type, text_type)
+            self.results[new_text_type, text_type] = (result, static)
+
+        if static:              # process_color() sets these when it falls through to a plain template
+            rb = render_buffer
+            if rb.line_class == None:  rb.line_class = "text"
+            if rb.line_indent == None: rb.line_indent = 99
+        return result
+
+html_colors = ColorTable(html_color_dictionary)
+qt_colors   = ColorTable(qt_color_dictionary)
+
 
 #################################################################################################
 #
@@ -1934,6 +2382,27 @@ class _GetchWindows:
         return ch
 
 
+#
+# Everything that can be tab completed, sorted so all the names starting with a
+# prefix are found by bisection. Built once per load of the .i and .hlg files and
+# shared by the command line and the GUI's completers.
+#
+class CompletionIndex(object):
+    def __init__(self, names=()):
+        self.names = sorted(names)
+        self.qt_model = None                # made by the GUI when first needed
+
+    def matches(self, prefix):
+        """All names starting with prefix, in order"""
+        start = bisect.bisect_left(self.names, prefix)
+        if prefix and prefix[-1] < chr(255):
+            end = bisect.bisect_left(self.names, prefix[:-1] + chr(ord(prefix[-1])+1), start)
+        else:
+            end = start
+            while end < len(self.names) and self.names[end].startswith(prefix):
+                end += 1
+        return self.names[start:end]
+
 def tab_completion(line, double_tab):
     opts        = []                             # options - possibilities of what the user could want
     wholeLine   = line                           # Everything the user has typed
@@ -1944,21 +2413,13 @@ def tab_completion(line, double_tab):
         line = line.lower()
 
     try:
-        # Look up lines first ch in everything_dictionary and pull out all possiblities
-        for i in everything_dictionary[line[0].lower()]:
-            if i.startswith(line):
-                opts.append(i)
-                next_chrs = i.replace(line,"",1)
-                if len(opts) == 1:
-                    common_chrs = next_chrs
-                elif len(opts):
-                    for x in range(0,len(common_chrs)):
-                        if not next_chrs[x] == common_chrs[x]:
-                            common_chrs = common_chrs[0:x]
-                            break
+        if line:
+            opts = completion_index.matches(line)
+        if opts:
+            common_chrs = os.path.commonprefix([opts[0], opts[-1]])[len(line):]
         if len(opts) == 1:
             # If only one match complete the word
-            temp = opts.pop()
+            temp = opts[0]
             sys.stdout.write(temp[len(line):])
             return wholeLine[0:(len(wholeLine)-len(line))]+temp
         elif len(opts) and double_tab:
@@ -2264,14 +2725,63 @@ class KeyboardThread(threading.Thread):
 #
 ########################################################################################
 
+# Characters dropped from printer data (control characters other than newline and tab)
+UNPRINTABLE_CHARS = "".join([chr(c) for c in range(32) if chr(c) not in "\n\t"])
+SAME_CHARS = string.maketrans("", "")  # translate() table changing nothing (None needs 2.6)
+
+# Splits blocks of printer data into complete lines.
+# Unprintable characters are removed, "-> " prompts are stripped out of the lines and
+# reported as a separate PROMPT item, and a partial line is carried over to the next block.
+class LineFramer():
+    def __init__(self):
+        self.partial = ""
+        self.split_re = {}
+
+    def feed(self, data, terminator='\n'):
+        """Add a block of data, return list of complete lines and PROMPTs in arrival order"""
+        items = []
+        data = data.translate(SAME_CHARS, UNPRINTABLE_CHARS)
+        if not data:
+            return items
+
+        if terminator == '\n':
+            pieces = data.split('\n')
+            for piece in pieces[:-1]:
+                self.add_text(piece + '\n', items)
+                items.append(self.partial)
+                self.partial = ""
+            self.add_text(pieces[-1], items)
+        else:
+            if terminator not in self.split_re:
+                self.split_re[terminator] = re.compile("([\n%s])" % re.escape(terminator))
+            pieces = self.split_re[terminator].split(data)     # text, eoln, text, eoln, ..., text
+            for i in xrange(0, len(pieces)-1, 2):
+                self.add_text(pieces[i] + pieces[i+1], items)
+                items.append(self.partial)
+                self.partial = ""
+            self.add_text(pieces[-1], items)
+        return items
+
+    def add_text(self, text, items):
+        """Append text to the partial line, stripping prompts the same way the char-by-char reader did"""
+        line = self.partial
+        if '> ' not in line[-1:] + text:
+            self.partial = line + text
+            return
+        for c in text:
+            line += c
+            if c == ' ' and line[-3:] == PROMPT:
+                line = line[:-3]
+                items.append(PROMPT)
+        self.partial = line
+
+
 # Thread to read the printer and dump all received data into a Fifo.
 # Assumes printer is running the shell with a -> prompt.
 class PortToFifoThread(threading.Thread):
     '''Thread to read from serial and fill a fifo.'''
-    quitted_event = threading.Event() 
-    quitted_event.clear()
 
-    def __init__(self, printer, fifo, prompt_seen, thread_name, startup_seen, quit_event):
+    def __init__(self, printer, fifo, prompt_seen, thread_name, startup_seen, quit_event, restarted=None):
         threading.Thread.__init__(self, name=thread_name)
         self.printer = printer
         self.fifo = fifo
@@ -2280,13 +2790,15 @@ class PortToFifoThread(threading.Thread):
         self.prompt_seen = prompt_seen
         self.quit_event = quit_event
         self.startup_seen = startup_seen
+        self.restarted = restarted          # called when the mech restarts (startup_trace if None)
+        self.framer = LineFramer()
+        self.quitted_event = threading.Event()  # set when this reader has stopped
 
     def run(self):
         """Read raw data from the printer, compose lines, and put in fifo"""
         debug("PortToFifoThread.run start")
         global options
 
-        line = ""
         while not self.quit_event.isSet():
 
             self.printer.is_open_event.wait(1)
@@ -2314,42 +2826,41 @@ class PortToFifoThread(threading.Thread):
                 if options.debug: 
                     # debug("PortToFifoThread.run read", len(data), "bytes")
                     if len(data) > 0:
-                        sys.stderr.write("[ ")
-                        for c in data:
-                            sys.stderr.write("%02X " % (ord(c)))
-                        sys.stderr.write(" ]"+EOLN)
-
-                for c in data:
-                    # accept only printables
-                    if (c >= ' ') or (c == '\n') or (c == '\t'):
-                        line += c
-
-                        # detect prompt
-                        if c==' ':
-                            if len(line)>=3 and line[-3]=='-' and line[-2]=='>':
-                                self.prompt_seen.set()
-                                line = line[:-3]
-                                if gui: 
-                                    self.fifo.append("-> ")
-
-                        # detect end of line
-                        if (c == '\n' or c == terminator):
-
-                            # detect mech rebooted
-                            if mech_started_re.match(line):
-                                # Mech restarted
-                                self.startup_seen.set()
-                                startup_trace(self.printer)
-
-                            # detect ready for flash (REVISIT: move to ProcessFifoThread?)
-                            elif "Waiting for SREC" in line:
-                                ready_for_flash_file.set()
-    
-                            # send line to ProcessFifoThread
-                            self.fifo.append(line)
-                            line = ""
+                        sys.stderr.write("[ " + "".join(["%02X " % (ord(c)) for c in data]) + " ]"+EOLN)
+
+                # split into lines and hand them to ProcessFifoThread a batch at a time
+                batch = []
+                for line in self.framer.feed(data, terminator):
+
+                    # detect prompt
+                    if line == PROMPT:
+                        self.fifo.extend(batch)
+                        batch = []
+                        self.prompt_seen.set()
+                        self.printer.prompted()
+                        if gui: 
+                            batch.append(PROMPT)
+
+                    # detect mech rebooted
+                    elif mech_started_re.match(line):
+                        # Mech restarted
+                        self.fifo.extend(batch)
+                        batch = [line]
+                        self.startup_seen.set()
+                        (self.restarted or startup_trace)(self.printer)
+
+                    # detect ready for flash (REVISIT: move to ProcessFifoThread?)
+                    elif "Waiting for SREC" in line:
+                        self.fifo.extend(batch)
+                        batch = [line]
+                        ready_for_flash_file.set()
+
+                    else:
+                        batch.append(line)
+
+                self.fifo.extend(batch)
 
-        PortToFifoThread.quitted_event.set()
+        self.quitted_event.set()
 
 
 # Thread to read the Fifo we have been filling with printer data and process
@@ -2374,26 +2885,166 @@ class ProcessFifoThread(threading.Thread):
         global raw_output_file
         while not self.quit_event.isSet():
 
-            line = self.fifo.pop()              # wait and take a line out of Fifo
-            if options.debug:
-                debug("ProcessFifoThread.run read", len(line), "bytes")
+            lines = self.fifo.pop_batch()       # wait and take the waiting lines out of Fifo
+            for line in lines:
+                if options.debug:
+                    debug("ProcessFifoThread.run read", len(line), "bytes")
 
-            if (sync_re.search(line)):          # is the sync string here?
-                self.sync_seen.set()
+                if (sync_re.search(line)):          # is the sync string here?
+                    self.sync_seen.set()
         
-            self.processing_allowed.wait()      # wait if IO is paused
-
-            if line == PROMPT:
-                output_str(PROMPT)
-            else:
-                process_line(line)              # decode the line and display
+                if not self.processing_allowed.isSet():
+                    self.processing_allowed.wait()      # wait if IO is paused
 
-            last_lines_output_time  = time.time()
-            last_lines_output_count = last_lines_output_count + 1
-            if (raw_output_file):
-                raw_output_file.write(line.rstrip() + '\n')
+                if line == PROMPT:
+                    output_str(PROMPT)
+                elif line == SYMBOLS_LOADED:
+                    symbol_loader.decode_held()
+                    continue
+                else:
+                    if symbol_loader.loading:
+                        symbol_loader.hold(line)    # decoded again once the symbols are loaded
+                    process_line(line)              # decode the line and display
+
+                last_lines_output_time  = time.time()
+                last_lines_output_count = last_lines_output_count + 1
+                if (raw_output_file):
+                    raw_output_file.write(line.rstrip() + '\n')
         
 
+#############################################################################################
+#
+# Sessions
+#
+# Extra printers captured alongside the main one ("session add lab2 10.0.0.34"). Each session
+# has its own port, fifo, decoder and log files (<output>-<name>.sift and .raw), and its
+# output on the console is prefixed with its name. The symbol tables are only read while
+# decoding, so every session shares sift's one copy of them. A session's breaks, asserts and
+# udws results don't set sift's globals (the source shown by "l", download/cad blocked at a
+# break), and its records don't go to the profiler or the archive: those follow the main
+# printer.
+#
+#############################################################################################
+
+class Session(object):
+    def __init__(self, name, port_str, echo=True):
+        self.name = name
+        self.port_str = port_str
+        self.echo = echo                    # show the output on the console/GUI too
+        self.prefix = name + "| "
+        self.at_line_start = True
+        self.printer = Printer()
+        base = os.path.splitext(options.output or DEFAULT_LOGFILE)[0]
+        self.fifo = Fifo(int(options.fifolines), int(options.fifobytes), options.fifopolicy,
+                         spill_name="%s-%s%s" % (base, name, os.path.splitext(SPILL_FILE)[1]))
+        self.decoder = TraceDecoder()
+        self.decoder.recording = False
+        self.decoder.sets_globals = False   # sift's breakpoint and udws result are the main printer's
+        self.decoder.printer = self.printer
+        self.quit_event = threading.Event()
+        self.lines = 0
+        self.output_file = LogFile(DEFAULT_LOGFILE, max_size=max_output_file_size,
+                                   name="%s-%s%s" % (base, name, os.path.splitext(DEFAULT_LOGFILE)[1]))
+        self.raw_file = LogFile(RAW_OUTPUT_FILE, max_size=max_output_file_size,
+                                name="%s-%s%s" % (base, name, os.path.splitext(RAW_OUTPUT_FILE)[1]))
+
+    def start(self):
+        self.run(self.printer.open, self.port_str, False)
+        PortToFifoThread(self.printer, self.fifo, threading.Event(), "Session " + self.name,
+            threading.Event(), self.quit_event, restarted=self.restarted).start()
+        decoding = threading.Thread(target=self.run, args=(self.decode_fifo,), name="Decode " + self.name)
+        decoding.setDaemon(True)
+        decoding.start()
+
+    def run(self, function, *args):
+        """Call function with this thread's output going to the session"""
+        rb = render_buffer
+        (session, rb.session) = (rb.session, self)
+        try:
+            return function(*args)
+        finally:
+            rb.session = session
+
+    def decode_fifo(self):
+        try:
+            while not self.quit_event.isSet():
+                for line in self.fifo.pop_batch():
+                    if line != PROMPT:
+                        self.raw_file.write(line.rstrip() + '\n')
+                        self.decoder.decode(line)
+                        self.lines += 1
+        except RuntimeError:                # fifo closed
+            pass
+
+    def restarted(self, printer):
+        output_str(self.prefix + "Printer restarted" + EOLN, "info")
+        if trace_startup > 0:
+            printer.udw("fm.trace "+str(trace_startup))
+
+    def prefixed(self, text):
+        """text with the session's prefix at the start of each line"""
+        if not text:
+            return text
+        lines = text.split(EOLN)
+        text = (EOLN + self.prefix).join(lines)
+        if self.at_line_start:
+            text = self.prefix + text
+        self.at_line_start = not lines[-1]
+        if self.at_line_start:
+            text = text[:-len(self.prefix)]
+        return text
+
+    def write_out(self, rb):
+        """Write the output a render buffer collected (see RenderBuffer.write_out)"""
+        if rb.gui:
+            if gui and self.echo:
+                gui.write_indented(self.prefixed("".join(text for (indent, text) in rb.gui)), None)
+            rb.gui = []
+        rb.process_events = False
+        if rb.text:
+            self.output_file.write("".join(rb.text))
+            rb.text = []
+        rb.html = []
+
+    def close(self):
+        self.quit_event.set()
+        self.printer.close()
+        self.fifo.close()                   # ends the decoding thread
+        self.output_file.close(quiet=True)
+        self.raw_file.close(quiet=True)
+
+sessions = {}                               # key=name, value=Session
+session_names = []                          # sessions in the order they were opened
+
+def open_session(name, port_str):
+    if name in sessions:
+        output_str("Session %s is already open" % name + EOLN, "error")
+        return
+    session = sessions[name] = Session(name, port_str)
+    session_names.append(name)
+    session.start()
+    output_str("Session %s on %s, output in %s" % (name, session.printer.port.name,
+        session.output_file.name) + EOLN, "info")
+
+def close_session(name):
+    session = sessions.pop(name, None)
+    if session:
+        session_names.remove(name)
+        session.close()
+        output_str("Closed session %s (%d lines in %s)" % (name, session.lines,
+            session.output_file.name) + EOLN, "info")
+    else:
+        output_str("No session " + name + EOLN, "error")
+
+def list_sessions():
+    if not sessions:
+        output_str("No sessions (session add <name> <port>)" + EOLN, "info")
+    for name in session_names:
+        session = sessions[name]
+        output_str(" %-10s %-24s %9d lines %7d waiting  %s%s" % (session.name, session.printer.port.name,
+            session.lines, len(session.fifo), session.output_file.name, EOLN), "args")
+
+
 def process_dot_all():
     # Since for now ALL directories are only needed temporarily, delete any existing ones
     if os.path.exists(os.path.join(SIFT_CONFIG_DIR, ALL_DIRECTORY)):
@@ -2661,6 +3312,11 @@ class CommandParserThread(threading.Thread):
     global frame_iter                   #keeps track of what frame is being printed out during call
     global process_fifo_thread
 
+    # Commands that don't name any symbols, so run them while the symbols are still loading
+    SYMBOL_FREE_COMMANDS = ("", "q", "quit", "exit", "pause", "unpause", "port", "t", "trace",
+        "level", "tick", "ticks", "clearlogs", "pwd", "h", "history", "door", "power", "sync",
+        "session", "options", "help")
+
     def __init__ (self, running_event, prompt_seen, prompt, quit_event, sync_seen):
         global last_lines_output_count
         global last_lines_output_time
@@ -2941,14 +3597,16 @@ class CommandParserThread(threading.Thread):
         for f in files[:]:
             (root,ext) = os.path.splitext(f)
             if ext in ['.all','.i','.hlg']:
-                load_symbols(f)
+                symbol_loader.start(f)
                 files.remove(f)
 
             if ext in ['.lua', '.luc']:
                 self.do_lua(f)
                 files.remove(f)
 
-        # process everything else 
+        # process everything else (once the symbols are loaded)
+        if files:
+            symbol_loader.wait()
         for f in files[:]:
             print "Reading", f
             process_file(f)
@@ -2958,6 +3616,7 @@ class CommandParserThread(threading.Thread):
     def do_calls(self, indent): #Prints frames, calls is also bt, backtrace, and w(here)
         self.calling = True
         try:
+            frames = decoder.frames
             for self.frame_iter in iter(frames):
                 if self.frame_iter <= indent:
                     process_line(frames[self.frame_iter].flow_call)
@@ -3105,7 +3764,73 @@ class CommandParserThread(threading.Thread):
             html_output_file.save(root)
         else:
             output_str("No filename given" + EOLN, "error")
+
+    # cmd profile
+    def do_profile(self, remainder):
+        args = remainder.split()
+        if not args:
+            profiler.report()
+        elif args[0] == "on":
+            profiler.start()
+            output_str("Profiling flows" + EOLN, "info")
+        elif args[0] == "off":
+            profiler.stop()
+            output_str("Stopped profiling flows" + EOLN, "info")
+        elif args[0] == "clear":
+            profiler.clear()
+        elif args[0] == "save":
+            if len(args) > 1:
+                profiler.save(args[1])
+            else:
+                output_str("No filename given" + EOLN, "error")
+        elif args[0].isdigit():
+            profiler.report(int(args[0]))
+        else:
+            output_str("Usage: profile [on|off|clear|save <file>|<n>]" + EOLN, "error")
+
+    # cmd query
+    def do_query(self, remainder):
+        global query_reader
+        args = remainder.split()
+        if args and (args[0] == "open"):
+            if query_reader:
+                query_reader.close()
+                query_reader = None
+            if len(args) > 1:
+                try:
+                    query_reader = ArchiveReader(args[1])
+                except (IOError, EOFError, ValueError), e:
+                    output_str("Couldn't open archive: " + str(e) + EOLN, "error")
+                    return
+                output_str("Querying %s (%d blocks of records)" % (args[1], len(query_reader.blocks)) + EOLN, "info")
+            return
+        name = None
+        if args and not re.match(r"^[0-9.]+$", args[0]):
+            name = args.pop(0)
+            if name == "*":
+                name = None
+        try:
+            times = [float(arg) for arg in args[:2]]
+        except ValueError:
+            output_str("Usage: query [<symbol>|*] [<from seconds> [<to seconds>]] or query open [<file>]" + EOLN, "error")
+            return
+        query_archive(name, *times)
         
+    # cmd session
+    def do_session(self, remainder):
+        args = remainder.split()
+        if not args:
+            list_sessions()
+        elif (args[0] == "add") and (len(args) == 3):
+            open_session(args[1], args[2])
+        elif (args[0] == "close") and (len(args) == 2):
+            for name in (session_names[:] if args[1] == "all" else [args[1]]):
+                close_session(name)
+        elif (args[0] in sessions) and (len(args) > 1):
+            sessions[args[0]].printer.udw(" ".join(args[1:]))
+        else:
+            output_str("Usage: session [add <name> <port>|close <name>|all|<name> <underware>]" + EOLN, "error")
+
     # cmd info
     def do_info(self):
         if dot_i_filename: output_str (".i file:     " + os.path.abspath(dot_i_filename) + EOLN)
@@ -3149,16 +3874,11 @@ class CommandParserThread(threading.Thread):
         if (line == "download" or line == "cad") and not passed == "failed" and not at_a_break_point:
             output_str("Sending file to printer " +EOLN,'warning')
 
-            # read uuencoded data and replace the chars ; and " with offsets by a given delta
+            # read uuencoded data
             uuencode = open(os.path.join(project_dir, project_name+".uue"), 'r')
 
             try:
-                for line in uuencode.readlines():
-                    read_data = line.replace("\'",chr(ord('\'')+64))
-                    read_data = read_data.replace(";",chr(ord(';')+64))
-                    read_data = read_data.replace("\\",chr(ord('\\')-64))
-                    self.do_underware("fm.u " + read_data)
-                    time.sleep(.2)
+                self.upload_uuencoded(uuencode.readlines())
             except:
                 output_str("Download Failed " +EOLN,'error')
             finally:
@@ -3167,6 +3887,19 @@ class CommandParserThread(threading.Thread):
             output_str("Can not download while at a break point", 'error')
 
 
+    def upload_uuencoded(self, lines):
+        """Send uuencoded lines with fm.u, as fast as the printer takes them"""
+        # replace the chars ' ; and \ with offsets by a given delta (the printer undoes it)
+        udw_lines = []
+        for line in lines:
+            read_data = line.replace("\'",chr(ord('\'')+64))
+            read_data = read_data.replace(";",chr(ord(';')+64))
+            read_data = read_data.replace("\\",chr(ord('\\')-64))
+            udw_lines.append("fm.u " + read_data)
+        if udw_lines:
+            self.last_udws_cmd = udw_lines[-1]
+            printer.upload(udw_lines)
+
     def do_lua(self, remainder):
 
         if remainder:
@@ -3184,13 +3917,7 @@ class CommandParserThread(threading.Thread):
                     uuencode = open(remainder+".uue", 'r')
                     output_str("Sending encoded file to printer " +EOLN,'warning')
                     try:
-                        for line in uuencode.readlines():
-                            if len(line) > 2:
-                                read_data = line.replace("\'",chr(ord('\'')+64))
-                                read_data = read_data.replace(";",chr(ord(';')+64))
-                                read_data = read_data.replace("\\",chr(ord('\\')-64))
-                                self.do_underware("fm.u " + read_data)
-                                time.sleep(.2)
+                        self.upload_uuencoded([line for line in uuencode.readlines() if len(line) > 2])
                     except:
                         output_str("Download Failed " +EOLN,'error')
                     finally:
@@ -3391,7 +4118,6 @@ class CommandParserThread(threading.Thread):
                 if (len(file_line.strip()) and (not file_line.startswith("#")) 
                         and not self.quit_event.isSet()):
                     command_parser.put(file_line.strip())
-                time.sleep(0.2)
         except:
             output_str("Could not completly process file: "+ line, "error")
             pass
@@ -3922,6 +4648,18 @@ class CommandParserThread(threading.Thread):
         elif first_word == "save":
             self.do_save(remainder)
 
+        # cmd profile
+        elif first_word == "profile":
+            self.do_profile(remainder)
+
+        # cmd query
+        elif first_word == "query":
+            self.do_query(remainder)
+
+        # cmd session
+        elif first_word == "session":
+            self.do_session(remainder)
+
         # cmd reload
         elif first_word == "reload":
             self.do_reload()
@@ -4000,6 +4738,9 @@ class CommandParserThread(threading.Thread):
         while not self.quit_event.isSet():
             line = self.queue.get()
             debug("CommandParserThread", len(line), line)
+            first_word = re.split('[() ]', line.strip())[0]
+            if symbol_loader.loading and (first_word not in self.SYMBOL_FREE_COMMANDS):
+                symbol_loader.wait()            # the command can name symbols
             self.parse(line)
             self.queue.task_done()              # marks item processed in queue
             time.sleep(0.1); 
@@ -4116,6 +4857,45 @@ def set_path_to_hlg_and_i_files(path_to_hlg = "", path_to_i =""):
     path_to_hlgfile = path_to_hlg
     path_to_ifile = path_to_i
 
+#
+# The decoders look up sections of the .hlg and .i files. Each file is read and indexed
+# once and kept in memory until it changes or new symbols are loaded, so decoding an
+# error is a dictionary lookup and a scan of the section found.
+#
+class FileSections(object):
+    '''Lines of a file, indexed by line text'''
+    def __init__(self, lines):
+        self.lines = lines
+        self.first_line = {}            # key=line text, value=first line number
+        self.more_lines = {}            # key=line text, value=all line numbers (repeated lines only)
+        for i, line in enumerate(lines):
+            if line not in self.first_line:
+                self.first_line[line] = i
+            elif line in self.more_lines:
+                self.more_lines[line].append(i)
+            else:
+                self.more_lines[line] = [self.first_line[line], i]
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        return self.lines[i]
+
+    def find(self, line, offset=0):
+        """Line number of the first line equal to line at or after offset, None if none"""
+        i = self.first_line.get(line)
+        if (i is None) or (i >= offset):
+            return i
+        if line in self.more_lines:
+            line_numbers = self.more_lines[line]
+            j = bisect.bisect_left(line_numbers, offset)
+            if j < len(line_numbers):
+                return line_numbers[j]
+        return None
+
+file_sections = {}      # key=filename, value=(symbol_cache_key, FileSections)
+
 #Opens HLG/flows.i file and reads all data and gets it into a variant(Array of string)
 def GetFileData(hlgFile = True):
     if hlgFile:
@@ -4125,19 +4905,31 @@ def GetFileData(hlgFile = True):
 
     if (filename).strip() == "":
         return                                           #End the script if no files were chosen
+
+    try:
+        key = symbol_cache_key(filename)
+    except OSError:
+        key = None
+    if (key is not None) and (filename in file_sections) and (file_sections[filename][0] == key):
+        return file_sections[filename][1]
+
     file = open(filename, 'r')
     sFiledata = file.read()
     file.close
     if not hlgFile:
         sFiledata = Replace(sFiledata, EOLN, "\n") #Flows file might have lf&cr as line terminators.
-    return sFiledata.split("\n")
+    sections = FileSections(sFiledata.split("\n"))
+    file_sections[filename] = (key, sections)
+    return sections
 
 #'Searches for a section in file data (which should be array of strings)
 def SearchForSection(sectionName, vFileData, offset):
-    i = 0
-    for i in range(offset, uBound(vFileData)):
-        if (sectionName == vFileData[i]):
-            break
+    i = vFileData.find(sectionName, offset)
+    if i is None:                       # not found leaves us on the last line
+        if offset < uBound(vFileData):
+            i = uBound(vFileData) - 1
+        else:
+            i = 0
     offset = i
     return ((i < uBound(vFileData)), offset)
 #
@@ -4760,7 +5552,6 @@ def process_dot_i(dot_i_filename):
     global flows
     global flows_by_id
     global flows_by_name
-    global frames
     global keywords
     global keywords_by_id
     global keywords_by_name
@@ -4779,6 +5570,10 @@ def process_dot_i(dot_i_filename):
     global fml_path_by_file_name
     global file_dirs
     track_flow_id = 0
+    statements_found = []                   # (offset, statement) added to statement_by_offset at the end
+    file_name_of = {}                       # key=path, value=file name
+    interpreter_items = []
+    interpreter_variables = []
     SECTION_NONE = 0
     SECTION_FLOWS = 1
     SECTION_GLOBALS = 2
@@ -4810,32 +5605,44 @@ def process_dot_i(dot_i_filename):
 
     output_str(" "+ os.path.abspath(dot_i_filename) +EOLN, "G")
 
+    # Use the already parsed tables if the .i file hasn't changed
+    cache = read_symbol_cache(dot_i_filename)
+    if cache:
+        restore_symbol_tables(cache, DOT_I_TABLES)
+        for item in cache["interpreter_items"]:
+            add_function_item_to_interpreter(item)
+        for name, value in cache["interpreter_variables"]:
+            add_variable_to_interpreter(name, value)
+        dot_i_file.close()
+        return
+
     # Loop through each line in the .i file.
     for line in dot_i_file:
         # Look to see if we've entered a section in the .i
         # file that we're interested in
-        if line.startswith("# Flow Info"):
-            current_section = SECTION_FLOWS
-        elif line.startswith("# Keyword Info"):
-            current_section = SECTION_KEYWORDS
-        elif line.startswith("# Variable Info"):
-            current_section = SECTION_GLOBALS
-        elif line.startswith("# Array Info"):
-            current_section = SECTION_NONE
-        elif line.startswith("# Constant Info"):
-            current_section = SECTION_CONSTANTS
-        elif line.startswith("# Value Info"):
-            current_section = SECTION_VALUES
-        elif line.startswith("# Assert Info"):
-            current_section = SECTION_NONE
-        elif line.startswith("# Statement Info"):
-            current_section = SECTION_STATEMENTS
-        elif line.startswith("# ExcludedLine Info"):
-            current_section = SECTION_EXCLUDEDLINE_INFO
-        elif line.startswith("# Totals"):
-            current_section = SECTION_NONE
+        if line.startswith("#"):
+            if line.startswith("# Flow Info"):
+                current_section = SECTION_FLOWS
+            elif line.startswith("# Keyword Info"):
+                current_section = SECTION_KEYWORDS
+            elif line.startswith("# Variable Info"):
+                current_section = SECTION_GLOBALS
+            elif line.startswith("# Array Info"):
+                current_section = SECTION_NONE
+            elif line.startswith("# Constant Info"):
+                current_section = SECTION_CONSTANTS
+            elif line.startswith("# Value Info"):
+                current_section = SECTION_VALUES
+            elif line.startswith("# Assert Info"):
+                current_section = SECTION_NONE
+            elif line.startswith("# Statement Info"):
+                current_section = SECTION_STATEMENTS
+            elif line.startswith("# ExcludedLine Info"):
+                current_section = SECTION_EXCLUDEDLINE_INFO
+            elif line.startswith("# Totals"):
+                current_section = SECTION_NONE
         # Ignore blank lines and lines that start with #
-        elif len(line) and (not line.startswith("#")):
+        elif len(line):
             # Now that we've determined what section we're in, process it.
 
             if current_section == SECTION_FLOWS:
@@ -4859,6 +5666,7 @@ def process_dot_i(dot_i_filename):
                         flows_by_id[id]     = flow
                         flows_by_name[name] = flow
                         add_function_item_to_interpreter(flow)
+                        interpreter_items.append(flow)
                 elif len(splits) == 1:
                     # This line contains an argument from the previous flow
                     argName = splits[0]
@@ -4870,6 +5678,7 @@ def process_dot_i(dot_i_filename):
                         flows_by_id[id]     = flow
                         flows_by_name[name] = flow
                         add_function_item_to_interpreter(flow)
+                        interpreter_items.append(flow)
                 elif len(splits) == 3:
                     type = splits[0]
                     if (type == "local"):
@@ -4891,6 +5700,7 @@ def process_dot_i(dot_i_filename):
                         keywords_by_id[id]     = keyword
                         keywords_by_name[name] = keyword
                         add_function_item_to_interpreter(keyword)
+                        interpreter_items.append(keyword)
                 elif len(splits) == 1:
                      # This line contains an argument from the previous keyword
                      argName = splits[0]
@@ -4902,12 +5712,13 @@ def process_dot_i(dot_i_filename):
                           keywords_by_id[id]     =  keyword
                           keywords_by_name[name] = keyword
                           add_function_item_to_interpreter(keyword)
+                          interpreter_items.append(keyword)
 
             elif current_section == SECTION_GLOBALS:
                 line = line.strip()
                 splits = line.split("\t")
                 if len(splits) >= 2:
-                    global_ids[splits[0]] = splits[1]
+                    global_ids[int(splits[0])] = splits[1]
                     global_names[splits[1]] = splits[0]
                     everything.append(splits[1])
 
@@ -4920,6 +5731,7 @@ def process_dot_i(dot_i_filename):
                     constant_name  = splits[2]
                     everything.append(constant_name)
                     add_variable_to_interpreter(constant_name, constant_value)
+                    interpreter_variables.append((constant_name, constant_value))
 
                     if not constant_name.startswith("ur_"):
                         # Add name to constant_names dictionary with value as key
@@ -4939,6 +5751,7 @@ def process_dot_i(dot_i_filename):
                     if enum_name in constant_names:
                         enum_value = constant_name2value[enum_name]
                         add_variable_to_interpreter(enum_name, enum_value)
+                        interpreter_variables.append((enum_name, enum_value))
                         if type_name in values_for:
                             values_for[type_name][enum_value] = enum_name.upper()
                 elif line.startswith("\t"):
@@ -4952,17 +5765,19 @@ def process_dot_i(dot_i_filename):
                 # print line
                 splits = line.split("\t")
                 if len(line) > 5 and len(splits) == 4:
-                    offset      = splits[0]
+                    offset      = int(splits[0])
                     flow_id     = splits[1]
-                    line_number = splits[2]
-                    filename   = os.path.basename(splits[3])
+                    line_number = intern(splits[2])     # interned strings are shared in the symbol cache too
+                    filename    = file_name_of.get(splits[3])
+                    if filename is None:
+                        filename = file_name_of[splits[3]] = intern(os.path.basename(splits[3]))
 
                     statement   = Statement(offset, flows_by_id[int(flow_id)], line_number,
                                     filename)
 
                     # save statement by offset so we can look it up when we hit a breakpoint
                     # print offset + " " + flows_by_id[int(flow_id)].name + " " +  line_number + " " + filename
-                    statement_by_offset[offset] = statement
+                    statements_found.append((offset, statement))
 
                     # save filenames
                     if filename not in filenames:
@@ -4993,28 +5808,43 @@ def process_dot_i(dot_i_filename):
                     file      = splits[2]
                 if not os.path.basename(file) in fml_path_by_file_name:
                     fml_path_by_file_name[os.path.basename(file)] = file
+    dot_i_file.close()
+
+    # Sorted before it's put in place, as the trace may be decoded while symbols load
+    table = OffsetTable(statement_by_offset.iteritems())
+    table.update(statements_found)
+    table.sort()
+    statement_by_offset = table
+    cache = dict([(name, globals()[name]) for name in DOT_I_TABLES])
+    cache["interpreter_items"] = interpreter_items
+    cache["interpreter_variables"] = interpreter_variables
+    write_symbol_cache(dot_i_filename, cache)
 
 # Process .hlg file and build a lookup table.
 def process_hlg(hlg_filename):
     global underware
-    global fml_filenames_str
-    global winfml_filenames_str
 
     SECTION_NONE = 0
     SECTION_DSIDS = 1
     SECTION_FML = 2
     current_section = SECTION_NONE
-    fml_filenames_str = ""
-    winfml_filenames_str = ""
+    fml_filenames = []
 
     try:
         hlg_file = open(hlg_filename, "r")
     except:
+        process_hlg_fml_filenames(hlg_filename, fml_filenames)
         return
 
     output_str(" "+ os.path.abspath(hlg_filename) +EOLN, "G")
 
-    have_flow_info  = True
+    # Use the already parsed tables if the .hlg file hasn't changed
+    cache = read_symbol_cache(hlg_filename)
+    if cache:
+        restore_symbol_tables(cache, HLG_TABLES)
+        process_hlg_fml_filenames(hlg_filename, cache["fml_filenames"])
+        return
+
     # Loop through each line in the .hlg file.
     for line in hlg_file:
         line = line.strip()
@@ -5052,79 +5882,244 @@ def process_hlg(hlg_filename):
             elif current_section == SECTION_FML:
                 m = hlg_fmls_for_i_re.match(line)
                 if m:
-                    if "FlexTool" in hlg_filename:
-                        winfml_filenames_str = winfml_filenames_str + " " + os.path.basename(hlg_filename).replace(".hlg","")+ "_" + m.group("filename").strip()
-                    else:
-                        winfml_filenames_str = winfml_filenames_str + " " + m.group("filename").strip()
-                        # Makes certain files read only
-                        # if dot_all_file and os.name == "nt" and m.group("filetype").strip() == "READ_ONLY":
-                        #    sub = subprocess.call(["attrib", "+r",os.path.join(project_dir,m.group("filename").strip())])
-
-                    if dot_all_file and not os.name == "nt":
-                        fml_filenames_str = fml_filenames_str + " " + os.path.join(project_dir,m.group("filename").strip())
-                        # Makes certain files read only
-                        # if m.group("filetype").strip() == "READ_ONLY":
-                        #    sub = subprocess.call(["chmod", "a-w", os.path.join(project_dir,m.group("filename").strip())])
-                    elif not os.name == "nt":
-                        if os.path.exists(os.path.join(os.path.join(os.path.dirname(os.path.dirname(hlg_filename)),"fm",os.path.basename(os.path.dirname(hlg_filename))), m.group("filename").strip())):
-                            fml_filenames_str = fml_filenames_str + " " +  os.path.join(os.path.join(os.path.dirname(os.path.dirname(hlg_filename)),"fm",os.path.basename(os.path.dirname(hlg_filename))), m.group("filename").strip())
-                        else:
-                            found = False
-                            for i in file_dirs:
-                                if os.path.exists(os.path.join(i,m.group("filename").strip())):
-                                    fml_filenames_str = fml_filenames_str + " " + os.path.join(i,m.group("filename").strip())
-                                    found = True
-                            try:
-                                if not found and have_flow_info:
-                                    fml_filenames_str = fml_filenames_str + " " + fml_path_by_file_name[m.group("filename").strip()]
-                            except:
-                                # ERIK: Note to self: Don't know what all this is doing. Sort it out. Getting this message:
-                                # output_str(" Mismatched .hlg file, some functionality will fail." +EOLN, 'named')
-                                have_flow_info = False
+                    fml_filenames.append(m.group("filename").strip())
                 else:
                     current_section = SECTION_NONE
         else:
             current_section = SECTION_NONE
 
-def find_and_process_i_and_hlg_files(ifile=None, hlgfile=None):
-    global i_file_directory
-    global project_dir
-    global project_name
-    global project_type
-    global hlg_filename
-    global everything_dictionary
-    global dot_i_filename
-    global gui
-    global dot_all_file
-    project_type = "fml" #assume fml
+    cache = dict([(name, globals()[name]) for name in HLG_TABLES])
+    cache["fml_filenames"] = fml_filenames
+    write_symbol_cache(hlg_filename, cache)
+    process_hlg_fml_filenames(hlg_filename, fml_filenames)
 
-    debug("find_and_process_i_and_hlg_files(%s, %s)" % (ifile, hlgfile))
+# Find where the .fml files named in the .hlg file are for the compiler command line
+def process_hlg_fml_filenames(hlg_filename, fml_filenames):
+    global fml_filenames_str
+    global winfml_filenames_str
+
+    fml_filenames_str = ""
+    winfml_filenames_str = ""
+
+    have_flow_info  = True
+    for filename in fml_filenames:
+        if "FlexTool" in hlg_filename:
+            winfml_filenames_str = winfml_filenames_str + " " + os.path.basename(hlg_filename).replace(".hlg","")+ "_" + filename
+        else:
+            winfml_filenames_str = winfml_filenames_str + " " + filename
+            # Makes certain files read only
+            # if dot_all_file and os.name == "nt" and m.group("filetype").strip() == "READ_ONLY":
+            #    sub = subprocess.call(["attrib", "+r",os.path.join(project_dir,m.group("filename").strip())])
+
+        if dot_all_file and not os.name == "nt":
+            fml_filenames_str = fml_filenames_str + " " + os.path.join(project_dir,filename)
+            # Makes certain files read only
+            # if m.group("filetype").strip() == "READ_ONLY":
+            #    sub = subprocess.call(["chmod", "a-w", os.path.join(project_dir,m.group("filename").strip())])
+        elif not os.name == "nt":
+            if os.path.exists(os.path.join(os.path.join(os.path.dirname(os.path.dirname(hlg_filename)),"fm",os.path.basename(os.path.dirname(hlg_filename))), filename)):
+                fml_filenames_str = fml_filenames_str + " " +  os.path.join(os.path.join(os.path.dirname(os.path.dirname(hlg_filename)),"fm",os.path.basename(os.path.dirname(hlg_filename))), filename)
+            else:
+                found = False
+                for i in file_dirs:
+                    if os.path.exists(os.path.join(i,filename)):
+                        fml_filenames_str = fml_filenames_str + " " + os.path.join(i,filename)
+                        found = True
+                try:
+                    if not found and have_flow_info:
+                        fml_filenames_str = fml_filenames_str + " " + fml_path_by_file_name[filename]
+                except:
+                    # ERIK: Note to self: Don't know what all this is doing. Sort it out. Getting this message:
+                    # output_str(" Mismatched .hlg file, some functionality will fail." +EOLN, 'named')
+                    have_flow_info = False
+
+
+#
+# Symbol cache
+#
+# Parsing big .i and .hlg files takes seconds. The tables built from each file are saved
+# in ~/.sift/symbols and reused as long as the file's path, size, and modification time
+# (and the Sift revision) are unchanged. The tables are stored with marshal, which only
+# handles built in types, so Flow, Keyword and Statement objects are stored once in an
+# object list and referred to by index.
+#
+
+SYMBOL_CACHE_FORMAT = 2
+
+# Tables built by process_dot_i() and process_hlg()
+DOT_I_TABLES = ["flows", "flows_by_id", "flows_by_name", "keywords", "keywords_by_id", 
+    "keywords_by_name", "global_ids", "global_names", "constant_ids", "constant_names", 
+    "constant_values", "constant_name2value", "values_for", "statement_by_offset", 
+    "statement_by_file_line", "filenames", "everything", "fml_path_by_file_name", "file_dirs"]
+HLG_TABLES = ["dsids", "dsids_by_id", "dsids_by_name", "underware", "everything_hlg"]
+
+# Cached tables holding objects, and how many dictionaries deep the objects are (0 is a list)
+SYMBOL_OBJECT_TABLES = {"flows_by_id": 1, "flows_by_name": 1, "keywords_by_id": 1, 
+    "keywords_by_name": 1, "statement_by_offset": 1, "statement_by_file_line": 2, 
+    "interpreter_items": 0}
+# Classes of the cached objects (made by passing the attributes in __slots__ order to the
+# class), and their attributes that refer to other cached objects
+SYMBOL_CLASSES = {"Flow": (Flow, ()), "Keyword": (Keyword, ()), "Statement": (Statement, ("flow",))}
+# Cached tables of objects that aren't dictionaries
+SYMBOL_TABLE_CLASSES = {"statement_by_offset": OffsetTable}
+
+def symbol_cache_key(filename):
+    """What the cached symbols for a file depend on"""
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime, REV, SYMBOL_CACHE_FORMAT)
+
+def symbol_cache_filename(filename):
+    path = os.path.abspath(filename)
+    name = os.path.basename(path) + "." + hashlib.md5(path).hexdigest()[:12]
+    return os.path.join(SIFT_CONFIG_DIR, SYMBOL_CACHE_DIR, name)
+
+def pack_symbol_objects(cache):
+    """Replace objects in the cache tables with indexes into a list of (class, values, references).
+    Values are the object's attributes in __slots__ order, references are (slot index, object index)."""
+    objects = []
+    index_of = {}
+    classes = {}                            # class: (name, attribute getter, slots of references)
+    for class_name, (cls, ref_names) in SYMBOL_CLASSES.iteritems():
+        classes[cls] = (class_name, operator.attrgetter(*cls.__slots__),
+                        [cls.__slots__.index(name) for name in ref_names])
+
+    def pack(obj):
+        i = index_of.get(id(obj))
+        if i is None:
+            (class_name, getter, ref_slots) = classes[type(obj)]
+            values = list(getter(obj))
+            refs = []
+            for slot in ref_slots:
+                if values[slot] is not None:
+                    refs.append((slot, pack(values[slot])))
+                    values[slot] = None
+            i = index_of[id(obj)] = len(objects)
+            objects.append((class_name, values, refs))
+        return i
+
+    def pack_table(table, depth):
+        if depth == 0:
+            return [pack(obj) for obj in table]
+        elif depth == 1:
+            return (table.keys(), [pack(obj) for obj in table.values()])
+        return dict([(key, pack_table(value, depth-1)) for key, value in table.iteritems()])
+
+    packed = dict(cache)
+    for name, depth in SYMBOL_OBJECT_TABLES.iteritems():
+        if name in packed:
+            packed[name] = pack_table(packed[name], depth)
+    packed["objects"] = objects
+    return packed
+
+def unpack_symbol_table(table, depth, objects, table_class=dict):
+    """Replace indexes in a packed table with the objects"""
+    if depth == 0:
+        return map(objects.__getitem__, table)
+    elif depth == 1:
+        (keys, indexes) = table
+        return table_class(zip(keys, map(objects.__getitem__, indexes)))
+    return dict([(key, unpack_symbol_table(value, depth-1, objects)) for key, value in table.iteritems()])
+
+def read_symbol_cache(filename):
+    """Return the cached symbols for a file, None if missing or out of date"""
+    try:
+        with open(symbol_cache_filename(filename), "rb") as f:
+            (key, packed) = marshal.loads(f.read())
+        if key != symbol_cache_key(filename):
+            return None
+
+        # Recreate the objects (referred to objects come first) and put them back in the tables
+        objects = []
+        for class_name, values, refs in packed.pop("objects"):
+            for slot, i in refs:
+                values[slot] = objects[i]
+            objects.append(SYMBOL_CLASSES[class_name][0](*values))
+        for name, depth in SYMBOL_OBJECT_TABLES.iteritems():
+            if name in packed:
+                packed[name] = unpack_symbol_table(packed[name], depth, objects,
+                    SYMBOL_TABLE_CLASSES.get(name, dict))
+    except Exception, e:
+        debug("read_symbol_cache", filename, e)
+        return None
+    debug("read_symbol_cache", filename, "hit")
+    return packed
+
+def write_symbol_cache(filename, cache):
+    """Save the symbols parsed from a file"""
+    cache_filename = symbol_cache_filename(filename)
+    try:
+        data = marshal.dumps((symbol_cache_key(filename), pack_symbol_objects(cache)), 2)
+        if not os.path.isdir(os.path.dirname(cache_filename)):
+            os.makedirs(os.path.dirname(cache_filename))
+        with open(cache_filename + ".tmp", "wb") as f:
+            f.write(data)
+        if os.path.exists(cache_filename):
+            os.remove(cache_filename)
+        os.rename(cache_filename + ".tmp", cache_filename)
+    except Exception, e:
+        debug("write_symbol_cache", filename, e)
+
+def without_gc(function, *args):
+    """Call function with garbage collection held off, it is slow while building big tables"""
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return function(*args)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def restore_symbol_tables(cache, names):
+    """Add cached tables into the current (freshly initialized) symbol tables"""
+    for name in names:
+        current = globals()[name]
+        if not current:
+            globals()[name] = cache[name]
+        elif isinstance(current, list):
+            current.extend(cache[name])
+        else:
+            current.update(cache[name])
+
+# The symbol files, with their sizes and times to tell when they've been rebuilt
+def symbol_files(i_filename, hlg_filename):
+    files = []
+    for filename in (dot_all_file, i_filename, hlg_filename):
+        try:
+            st = os.stat(filename)
+            files.append((os.path.abspath(filename), st.st_size, st.st_mtime))
+        except (TypeError, OSError):
+            files.append(None)
+    return files
 
-    # Find and Process .i file
+symbol_files_loaded = None                  # symbol_files() when the symbols were last loaded
+
+# The .i and .hlg files to load, the ones given or else the best ones found
+def choose_symbol_files(ifile=None, hlgfile=None):
+
+    # Find .i file
     if ifile:
-        dot_i_filename = ifile
+        i_filename = ifile
     elif options.ifile:
-        dot_i_filename = options.ifile                      # specified
+        i_filename = options.ifile                          # specified
     elif dot_all_file:
-        dot_i_filename = find_best_filename(".i", [(project_dir, False)])
+        i_filename = find_best_filename(".i", [(project_dir, False)])
     else:
-        dot_i_filename = find_best_filename(".i", [(".", False)])      # current directory
-        if not dot_i_filename:
+        i_filename = find_best_filename(".i", [(".", False)])          # current directory
+        if not i_filename:
             if gui: gui.process_events()
-            dot_i_filename = find_best_filename(".i", SEARCH_PATH)       # in system
+            i_filename = find_best_filename(".i", SEARCH_PATH)           # in system
 
-    process_dot_i(dot_i_filename)
-
-    # Find and Process .hlg file
+    # Find .hlg file
     hlg_filename = None
     if hlgfile:
         hlg_filename = hlgfile
     if (options.hlg):                                       # specified
         hlg_filename = options.hlg
     elif not dot_all_file:
-        if (dot_i_filename):
+        if (i_filename):
             hlg_filename = find_best_filename(".hlg",       # same place .i file is
-                [(os.path.dirname(os.path.abspath(dot_i_filename)),False)])
+                [(os.path.dirname(os.path.abspath(i_filename)),False)])
         if not hlg_filename:
             hlg_filename = find_best_filename(".hlg", [(".",False)])  # current directory
         if not hlg_filename:
@@ -5132,9 +6127,30 @@ def find_and_process_i_and_hlg_files(ifile=None, hlgfile=None):
     elif dot_all_file:
         hlg_filename = find_best_filename(".hlg", [(project_dir,False)])
 
+    return (i_filename, hlg_filename)
+
+def find_and_process_i_and_hlg_files(ifile=None, hlgfile=None):
+    global i_file_directory
+    global project_dir
+    global project_name
+    global project_type
+    global hlg_filename
+    global completion_index
+    global dot_i_filename
+    global gui
+    global dot_all_file
+    global symbol_files_loaded
+    project_type = "fml" #assume fml
+
+    debug("find_and_process_i_and_hlg_files(%s, %s)" % (ifile, hlgfile))
+
+    # Find and Process .i and .hlg files
+    (dot_i_filename, hlg_filename) = choose_symbol_files(ifile, hlgfile)
+    without_gc(process_dot_i, dot_i_filename)
+
     # Only process if you have not processed already
     if not dot_all_file:
-        process_hlg(hlg_filename)
+        without_gc(process_hlg, hlg_filename)
         if hlg_filename:
             project_name = os.path.basename(hlg_filename).replace(".hlg","")
         else:
@@ -5155,19 +6171,11 @@ def find_and_process_i_and_hlg_files(ifile=None, hlgfile=None):
         no_caps_everything[i] = no_caps_everything[i].lower()
     no_caps_everything.sort()
 
-    # Put everything into an alphabetized dictionary
-    start_from = 0
-    for letter in range(ord('a'),ord('z')+1):
-        letter = chr(letter)
-        temp = []
-        for i in no_caps_everything[start_from:]:
-            if i.lower().startswith(letter):
-                temp.append(i)
-                start_from +=1
-            else: break
-        everything_dictionary[letter] = temp
+    completion_index = CompletionIndex(no_caps_everything)
     del no_caps_everything
 
+    symbol_files_loaded = symbol_files(dot_i_filename, hlg_filename)
+
     # What did we find in the .i and .hlg files
     output_str (" " + str(len(flows)) + " flows   " + str(len(global_names)) + " globals   " + 
         str(len(keywords)) + " keywords   " + str(len(constant_names)) + " constants   " + 
@@ -5200,22 +6208,34 @@ def find_and_process_i_and_hlg_files(ifile=None, hlgfile=None):
 # realizes Sift overwrote an existing file.  Sift overwrites its trace file
 #
 
-def backup_file(file):
+def backup_file(file, backup=BACKUP_DEFAULT_LOGFILE):
     global output_file_size
     try:
-        f = open(file, "r")
-        backup_file = open(BACKUP_DEFAULT_LOGFILE, "w")
-        backup_file.write(f.read())
-    except (IOError, MemoryError, OverflowError):
+        if os.path.exists(backup):
+            os.remove(backup)                   # Windows won't rename onto an existing file
+        os.rename(file, backup)
+    except OSError:
         pass
-    finally:
+    output_file_size = 0
+
+# Compress file to file.gz, replacing any older file.gz. Slow, so done on its own thread.
+def gzip_file(file):
+    try:
+        f = open(file, "rb")
         try:
-            f.close()
-        except: pass
-        try:
-            backup_file.close()
-        except: pass
-        output_file_size = 0
+            gz = gzip.open(file + ".gz.tmp", "wb")
+            try:
+                shutil.copyfileobj(f, gz, LOG_BATCH_SIZE)
+            finally:
+                gz.close()
+        finally:
+            f.close()
+        if os.path.exists(file + ".gz"):
+            os.remove(file + ".gz")
+        os.rename(file + ".gz.tmp", file + ".gz")
+        os.remove(file)
+    except (IOError, OSError):
+        pass
 
 
 ############################################################
@@ -5292,10 +6312,57 @@ if os.name == "nt":
 #
 #########################################################################################
 
+# ANSI colors for each text type
+# 30 black, 31 red, 32 green, 33 yellow, 34 blue, 35 magenta, 36 cyan (dark)
+# 90 gray,  91 red, 92 green, 93 yellow, 94 blue, 95 magenta, 96 cyan (light)
+# 1; bold   4; underline
+ANSI_COLORS = {
+        "default": '\033[0m',  "none":    '\033[0m',          # default
+        "indent":  '\033[31m',                                 # red
+        "F":       '\033[1;30m',                               # black or white (bold)
+        "r":       '\033[30m',                                 # grey
+        "args":    '\033[0;34m',                               # blue
+        "comment": '\033[90m', "raw": '\033[90m', "time": '\033[90m',   # grey
+        "K":       '\033[1;34m', "info": '\033[0;34m',         # blue or cyan (bold)
+        "number":  '\033[31m',                                 # red or yellow
+        "G":       '\033[32m',                                 # green
+        "L":       '\033[90m',                                 # grey
+        "named":   '\033[0;35m',                               # magenta
+        "error":   '\033[31m',                                 # red
+        "warning": '\033[1;31m',                               # red
+        "c":       '\033[32m',                                 # green
+        "l":       '\033[1;30m',                               # black or white (bold)
+        "R":       '\033[1;30m',                               # grey
+        "I":       '\033[30m',                                 # grey
+        }
+
+# DOS command colors for each text type
+if os.name == "nt":
+    CONSOLE_COLORS = {
+        "default": FOREGROUND_GREY, "none": FOREGROUND_GREY,                    # default
+        "indent":  FOREGROUND_RED | FOREGROUND_INTENSITY | default_bg,          # red
+        "F":       FOREGROUND_GREY | FOREGROUND_INTENSITY | default_bg,         # black or white (bold)
+        "r":       FOREGROUND_GREY | default_bg,                                # grey
+        "args":    FOREGROUND_CYAN | default_bg,                                # blue
+        "comment": FOREGROUND_GREY | default_bg,                                # grey
+        "raw":     FOREGROUND_GREY | default_bg,                                # grey
+        "time":    FOREGROUND_GREY | default_bg,                                # grey
+        "K":       FOREGROUND_CYAN | FOREGROUND_INTENSITY | default_bg,         # blue or cyan (bold)
+        "info":    FOREGROUND_CYAN | FOREGROUND_INTENSITY | default_bg,         # blue or cyan (bold)
+        "number":  FOREGROUND_YELLOW | FOREGROUND_INTENSITY | default_bg,       # red or yellow
+        "G":       FOREGROUND_GREEN | FOREGROUND_INTENSITY | default_bg,        # green
+        "L":       FOREGROUND_GREY | default_bg,                                # grey
+        "named":   FOREGROUND_GREY | default_bg,                                # green
+        "error":   FOREGROUND_RED | FOREGROUND_INTENSITY | default_bg,          # red
+        "warning": FOREGROUND_YELLOW | FOREGROUND_INTENSITY | default_bg,       # yellow
+        "c":       FOREGROUND_GREEN | FOREGROUND_INTENSITY | default_bg,        # green
+        "l":       FOREGROUND_GREY | FOREGROUND_INTENSITY | default_bg,         # black or white (bold)
+        "R":       FOREGROUND_GREY | FOREGROUND_INTENSITY | default_bg,         # grey
+        "I":       FOREGROUND_GREY | default_bg,                                # grey
+        }
+
 # Colorize various types of text (to each output simultaneously)
 def output_text_type(new_text_type):
-    global text_type
-    global text_type_stack
     global html_output_file
     global html_output_size
     global gui
@@ -5305,26 +6372,22 @@ def output_text_type(new_text_type):
     except:
         return
 
-    # Make our static globals if needed
-    try:
-        foo = text_type_stack
-    except NameError:
-        text_type = "default"
-        text_type_stack = []
+    rb = render_buffer
 
     # push, pop, or clear
     if (new_text_type == "pop"):
-        new_text_type = "pop" + text_type
+        new_text_type = "pop" + rb.text_type
         try:
-            text_type = text_type_stack.pop()
+            rb.text_type = rb.text_type_stack.pop()
         except IndexError:
-            text_type = "default"
+            rb.text_type = "default"
     elif (new_text_type == "clear"):
-        text_type = "default"
-        text_type_stack = []
+        rb.text_type = "default"
+        rb.text_type_stack = []
     else:
-        text_type_stack.append(text_type)
-        text_type = new_text_type
+        rb.text_type_stack.append(rb.text_type)
+        rb.text_type = new_text_type
+    text_type = rb.text_type
 
     # try:
     #     # if options.debug: print "COLOR"+new_text_type+"|"+text_type+"COLOR"
@@ -5334,104 +6397,27 @@ def output_text_type(new_text_type):
 
     # HTML file
     if (html_output_file):
-        # if (options.sdv):
-        #     html_output_file.write(process_color(sdv_color_dictionary, new_text_type, text_type))
-        # else:
-            html_output_file.write(process_color(html_color_dictionary, new_text_type, text_type))
-            html_output_size = html_output_size - 1
+        rb.html.append(html_colors.color(new_text_type, text_type))
+        html_output_size = html_output_size - 1
 
     # GUI colors
     if options.gui and gui:
-        gui.write(process_color(qt_color_dictionary, new_text_type, text_type))
+        color = qt_colors.color(new_text_type, text_type)
+        rb.gui.append((rb.line_indent, color))
 
     # Standard out
     if (not options.quiet) and (not options.gui):
         if os.name == 'posix':  # ANSI colors
-            # 30 black, 31 red, 32 green, 33 yellow, 34 blue, 35 magenta, 36 cyan (dark)
-            # 90 gray,  91 red, 92 green, 93 yellow, 94 blue, 95 magenta, 96 cyan (light)
-            # 1; bold   4; underline
-            if ((text_type == "default") or (text_type == "none")):     # default
-                sys.stdout.write('\033[0m')
-            elif (text_type == "indent"):       # red
-                sys.stdout.write('\033[31m')
-            elif (text_type == 'F'):            # black or white (bold)
-                sys.stdout.write('\033[1;30m')
-            elif (text_type == 'r'):            # grey
-                sys.stdout.write('\033[30m')
-            elif (text_type == 'args'):         # blue
-                sys.stdout.write('\033[0;34m')
-            elif (text_type == "comment"):      # grey
-                sys.stdout.write('\033[90m')
-            elif (text_type == "raw"):          # grey
-                sys.stdout.write('\033[90m')
-            elif (text_type == "time"):         # grey
-                sys.stdout.write('\033[90m')
-            elif (text_type == 'K'):            # blue or cyan (bold)
-                sys.stdout.write('\033[1;34m')
-            elif (text_type == 'info'):         # blue or cyan (bold)
-                sys.stdout.write('\033[0;34m')
-            elif (text_type == 'number'):       # red or yellow
-                sys.stdout.write('\033[31m')
-            elif (text_type == 'G'):            # green
-                sys.stdout.write('\033[32m')
-            elif (text_type == 'L'):            # grey
-                sys.stdout.write('\033[90m')
-            elif (text_type == 'named'):        # magenta
-                sys.stdout.write('\033[0;35m')
-            elif (text_type == 'error'):        # red
-                sys.stdout.write('\033[31m')
-            elif (text_type == 'warning'):      # red
-                sys.stdout.write('\033[1;31m')
-            elif (text_type == 'c'):            # green
-                sys.stdout.write('\033[32m')
-            elif (text_type == 'l'):            # black or white (bold)
-                sys.stdout.write('\033[1;30m')
-            elif (text_type == 'R'):            # grey
-                sys.stdout.write('\033[1;30m')
-            elif (text_type == 'I'):            # grey
-                sys.stdout.write('\033[30m')
-
+            if text_type in ANSI_COLORS:
+                rb.stdout.append(ANSI_COLORS[text_type])
         elif os.name == 'nt':  # DOS command colors
-            if ((text_type == "default") or (text_type == "none")):             # default
-                set_text_attr(FOREGROUND_GREY)
-            elif (text_type == "indent"):       # red
-                set_text_attr(FOREGROUND_RED | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'F'):            # black or white (bold)
-                set_text_attr(FOREGROUND_GREY | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'r'):            # grey
-                set_text_attr(FOREGROUND_GREY | default_bg)
-            elif (text_type == 'args'):         # blue
-                set_text_attr(FOREGROUND_CYAN | default_bg)
-            elif (text_type == "comment"):      # grey
-                set_text_attr(FOREGROUND_GREY | default_bg)
-            elif (text_type == "raw"):          # grey
-                set_text_attr(FOREGROUND_GREY | default_bg)
-            elif (text_type == "time"):         # grey
-                set_text_attr(FOREGROUND_GREY | default_bg)
-            elif (text_type == 'K'):            # blue or cyan (bold)
-                set_text_attr(FOREGROUND_CYAN | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'info'):            # blue or cyan (bold)
-                set_text_attr(FOREGROUND_CYAN | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'number'):       # red or yellow
-                set_text_attr(FOREGROUND_YELLOW | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'G'):            # green
-                set_text_attr(FOREGROUND_GREEN | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'L'):            # grey
-                set_text_attr(FOREGROUND_GREY | default_bg)
-            elif (text_type == 'named'):        # green
-                set_text_attr(FOREGROUND_GREY | default_bg)
-            elif (text_type == 'error'):        # red
-                set_text_attr(FOREGROUND_RED | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'warning'):      # yellow
-                set_text_attr(FOREGROUND_YELLOW | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'c'):            # green
-                set_text_attr(FOREGROUND_GREEN | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'l'):            # black or white (bold)
-                set_text_attr(FOREGROUND_GREY | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'R'):            # grey
-                set_text_attr(FOREGROUND_GREY | FOREGROUND_INTENSITY | default_bg)
-            elif (text_type == 'I'):            # grey
-                set_text_attr(FOREGROUND_GREY | default_bg)
+            if text_type in CONSOLE_COLORS:
+                rb.write_stdout()       # console colors apply to what is written after them
+                set_text_attr(CONSOLE_COLORS[text_type])
+
+    if not rb.depth:
+        with output_str_lock:
+            rb.write_out()
 
 ##########################################################################
 #
@@ -5445,6 +6431,82 @@ def output_text_type(new_text_type):
 
 output_str_lock = threading.Lock()
 
+#
+# Output is collected per thread and written to each place with one write. output_str()
+# on its own writes its output out before returning; between output_begin() and
+# output_end() a thread's output (e.g. a whole decoded line) is kept until the end.
+#
+class RenderBuffer(threading.local):
+    def __init__(self):
+        self.depth = 0                  # output_begin() calls waiting for output_end()
+        self.stdout = []
+        self.gui = []                   # (line_indent, text), the GUI indents by line_indent
+        self.text = []
+        self.html = []
+        self.process_events = False
+        self.text_type = "default"      # color of the text (each thread colors its own output)
+        self.text_type_stack = []
+        self.line_class = None          # record type of the line being output (None for text)
+        self.line_indent = None         # and its indent, for the HTML and GUI colors
+        self.session = None             # Session this thread's output goes to (None for sift's own)
+
+    def write_stdout(self):
+        if self.stdout:
+            if not self.session:
+                sys.stdout.write("".join(self.stdout))
+            elif self.session.echo:
+                sys.stdout.write(self.session.prefixed("".join(self.stdout)))
+            self.stdout = []
+
+    def write_out(self):
+        """Write what has been collected to each output (caller holds output_str_lock)"""
+        self.write_stdout()
+        if self.session:
+            self.session.write_out(self)
+            return
+
+        if self.gui:
+            if gui:
+                (indent, texts) = (self.gui[0][0], [])
+                for (line_indent_then, text) in self.gui:
+                    if line_indent_then != indent:
+                        gui.write_indented("".join(texts), indent)
+                        (indent, texts) = (line_indent_then, [])
+                    texts.append(text)
+                gui.write_indented("".join(texts), indent)
+                if self.process_events:
+                    gui.process_events()
+            self.gui = []
+        self.process_events = False
+
+        if self.text:
+            if output_file:
+                output_file.write("".join(self.text))
+            self.text = []
+
+        if self.html:
+            if html_output_file:
+                html_output_file.write("".join(self.html))
+            self.html = []
+
+render_buffer = RenderBuffer()
+
+# Start keeping this thread's output
+def output_begin():
+    render_buffer.depth += 1
+
+# Write out the output kept since the matching output_begin()
+def output_end():
+    global time_writing
+
+    rb = render_buffer
+    rb.depth -= 1
+    if not rb.depth:
+        t0 = time.clock()
+        with output_str_lock:
+            rb.write_out()
+        time_writing += time.clock() - t0
+
 # Output a string to various places simultaneously. If given a text type, colorize it
 def output_str (str, text_type=None, flush=False):
     global output_file
@@ -5458,42 +6520,55 @@ def output_str (str, text_type=None, flush=False):
     if not str: str=""
 
     t0 = time.clock()
-    output_str_lock.acquire()
-
-    if text_type:
-        output_text_type(text_type)
-    else:
-        if (EOLN in str) and (str != EOLN):
-            text_type = "text"
+    rb = render_buffer
+    writing_out = not rb.depth
+    if writing_out:
+        output_str_lock.acquire()
+        rb.depth = 1
+    try:
+        if text_type:
             output_text_type(text_type)
+        else:
+            if (EOLN in str) and (str != EOLN):
+                text_type = "text"
+                output_text_type(text_type)
+
+        # if not options.quiet:
+        if not options.gui and not options.quiet:
+            if '\n' in str:
+                rb.stdout.append(eoln_re.sub("\r\n", str))
+            else:
+                rb.stdout.append(str)
 
-    # if not options.quiet:
-    if not options.gui and not options.quiet:
-        sys.stdout.write(eoln_re.sub("\r\n", str))
-
-    # Using options.gui so we can switch output back to stdout for exceptions
-    if options.gui:
-        if gui: 
-            gui.write(str)
-        if (flush) or (text_type == "error") or (text_type == "warning") or (text_type == "info"):
-            if gui: gui.process_events()
-
-    if output_file:
-        output_file.write(str)
+        # Using options.gui so we can switch output back to stdout for exceptions
+        if options.gui:
+            if gui: 
+                rb.gui.append((rb.line_indent, str))
+            if (flush) or (text_type == "error") or (text_type == "warning") or (text_type == "info"):
+                rb.process_events = True
 
-    if html_output_file:
-        html_output_file.write(eoln_re.sub("", str))
+        if output_file or rb.session:
+            rb.text.append(str)
 
-    # if ConnectionThread and len(ConnectionThread.connections):
-    #     try:
-    #         ConnectionThread.send_all(str)
-    #     except socket.error:
-    #         pass
+        if html_output_file:
+            if '\n' in str:
+                rb.html.append(eoln_re.sub("", str))
+            else:
+                rb.html.append(str)
 
-    if text_type:
-        output_text_type("pop")
+        # if ConnectionThread and len(ConnectionThread.connections):
+        #     try:
+        #         ConnectionThread.send_all(str)
+        #     except socket.error:
+        #         pass
 
-    output_str_lock.release()
+        if text_type:
+            output_text_type("pop")
+    finally:
+        if writing_out:
+            rb.depth = 0
+            rb.write_out()
+            output_str_lock.release()
     time_writing += time.clock() - t0
 
 
@@ -5584,10 +6659,9 @@ def debug(*args):
 def startup_trace(printer):
     global command_parser
     global trace_startup
-    global fiber
 
     if options.debug: debug("startup_trace", printer, printer.port)
-    fiber = ""
+    decoder.fiber = ""
     if printer:
         # Clear printer's serial port and trigger a prompt to be sent
         if printer.port.running_shell:
@@ -5655,21 +6729,648 @@ def startup_trace(printer):
 #
 # Decodes a single raw trace line from the printer.
 #
-# This function decodes a line of text received from the
-# printer and pretties it up for human consumption.  This is the
-# grandmother of all Sift. This is where Sift began. In fact, the
-# design of this function hasn't changed -- only additions and tweaks
-# have been made. It is sorely in need of redesign. Alas, it works hard
-# and well.
+# This code decodes a line of text received from the printer and
+# pretties it up for human consumption.  This is the grandmother of
+# all Sift. This is where Sift began.
+#
+# The decoding is done by a TraceDecoder object which keeps the state
+# that carries over from one line to the next (time, fiber, frames,
+# wrap count, ...). Lines are sorted out cheaply before any regular
+# expression is tried:
+#
+#   - A trace record can only start with '+', a digit, white space or
+#     an indent letter, or else contain a Serial Tool header ending in
+#     ':'. Only those lines are run through decode_line_re.
+#   - The item name of a trace record is output by a handler picked
+#     from a table by record type.
+#   - Everything else is only tried against the DSID, machine state and
+#     underware regular expressions if it contains their fixed text.
 #
 #############################################################################
 
-last_time = 0
-time_highorder = 0
-time_format_determined = False
-old_time_format = False
+# First characters of a trace record that has no Serial Tool header
+TRACE_START_CHARS = frozenset("+0123456789" + string.whitespace + string.ascii_uppercase)
+
+class TraceDecoder(object):
+    '''Decodes raw trace lines. Holds the decoding state carried from line to line.'''
+
+    def __init__(self):
+        self.last_time = 0
+        self.time_highorder = 0
+        self.time_format_determined = False
+        self.old_time_format = False
+        self.wrap_count = 0                 # >0 lines left before wrapped data, -1 wrapped data done
+        self.fiber = ""
+        self.indent = None
+        self.trace_time = None
+        self.frames = {}                    # Keeps track of flows for break point backtrace print out
+        self.flow_stack = {}                # key=indent, value=flow
+        self.dsid_trap_line = None          # latest udw trap
+        self.ifile_suspect = False
+        self.recording = True               # records go to the profiler and the archive
+        self.printer = None                 # printer the lines come from (None for sift's printer)
+        self.sets_globals = True            # breaks, asserts and udws results set sift's globals
+        self.match = None                   # decode_line_re match of the latest line (None if not a record)
+
+        # Output of the item name by record type (others show type and id)
+        self.name_handlers = {
+            'F': self.name_flow,
+            'K': self.name_item,
+            'G': self.name_global,
+            'H': self.name_item,
+            'R': self.name_return,
+            'r': self.name_return,
+            '=': self.name_resumed,
+            'N': self.name_string,
+            'B': self.name_break,
+            'A': self.name_assert,
+            'L': self.name_local,
+            'T': self.name_tracing,
+            'M': self.name_time,
+            't': self.name_time,
+            'C': self.name_constant,
+        }
+
+    def get_state(self):
+        """The state carried to the next line, as plain values to compare or pass to another process"""
+        return (self.last_time, self.time_highorder, self.time_format_determined, self.old_time_format,
+            self.wrap_count, self.fiber, self.trace_time, self.dsid_trap_line, self.ifile_suspect,
+            sorted((indent, flow.name) for (indent, flow) in self.flow_stack.items()),
+            sorted((indent, frame.flow_call, frame.time_highorder, frame.time, sorted(frame.locals.items()))
+                for (indent, frame) in self.frames.items()),
+            render_buffer.text_type, tuple(render_buffer.text_type_stack))
+
+    def set_state(self, state):
+        """Carry on from a state returned by get_state()"""
+        (self.last_time, self.time_highorder, self.time_format_determined, self.old_time_format,
+            self.wrap_count, self.fiber, self.trace_time, self.dsid_trap_line, self.ifile_suspect,
+            flow_stack, frames, text_type, text_type_stack) = state
+        render_buffer.text_type = text_type
+        render_buffer.text_type_stack = list(text_type_stack)
+        self.flow_stack = dict((indent, flows_by_name[name]) for (indent, name) in flow_stack)
+        self.frames = {}
+        for (indent, flow_call, time_highorder, time, locals) in frames:
+            self.frames[indent] = Frame(flow_call, time_highorder, time)
+            self.frames[indent].locals = dict(locals)
+
+    def record_time(self):
+        """Time of the latest trace record, in hundredths of a second"""
+        if (self.time_format_determined and self.old_time_format):
+            return self.time_highorder*1000 + self.trace_time
+        return self.last_time
+
+    def items_for(self, type):
+        """Symbol table for record types that index one"""
+        if   (type == 'F'):   return flows_by_id
+        elif (type == 'K'):   return keywords_by_id
+        elif (type == 'G'):   return global_ids
+        elif (type == 'H'):   return headers
+        return None
+
+    def decode(self, line):
+        """Decode and output one line"""
+        global lines_processed
+        global time_processing
+
+        if options.debug: debug("process_line:", len(line), line.strip())
+
+        lines_processed += 1
+        t0 = time.clock()
+        output_begin()                      # write the line out in one go
+        try:
+            self.match = None
+            if len(line) > 0:
+                m = None
+                self.indent = None
+                if (line[0] in TRACE_START_CHARS) or (':' in line):
+                    m = self.match = self.decode_trace(line)
+                else:
+                    self.ifile_suspect = False
+
+                if not m:
+                    render_buffer.line_class  = None;
+                    render_buffer.line_indent = None;
+                    output_text_type("line")
+
+                    self.decode_text(line)
+
+                    port = (self.printer or printer).port
+                    if port and (not port.running_shell) and (line != PROMPT):
+                        output_text_type("pop")
+                output_text_type("pop") #line
+
+            if (self.wrap_count == -1):
+                output_str ("   [WRAP]", "warning")
+                self.wrap_count = 0
+
+            output_str(EOLN)
+        finally:
+            output_end()
+
+        time_processing += time.clock() - t0
+
+    def decode_trace(self, line):
+        """Decode and output a FML trace record, return None if the line isn't one"""
+        self.ifile_suspect = False
+
+        # Regular expression match for a FML trace line
+        m = decode_line_re.match(line)
+        if not m:
+            return None
+
+        indent = self.indent = ord(m.group("indent")) - ord('A')
+
+        newfiber = m.group("fiber")
+        if (len(newfiber)==1) and (newfiber != self.fiber):
+            self.fiber = newfiber
+
+        type   = m.group("type")
+        id     = int(m.group("id"))
+
+        self.decode_time(m, type, id)
+
+        items = self.items_for(type)
+        if (items) and (id > len(items)):
+            self.ifile_suspect = True
+            return None
+
+        # Since imported files go straight to process line and bypass command_parser
+        # need to check if command parser has been initialized.
+        cmd_parser_bool = 'command_parser' in globals()
+
+        # Flow times for the profiler and records for the archive (not the calls shown by "calls")
+        if (self.recording and (profiler.enabled or archive.file)
+                and not (cmd_parser_bool and command_parser and command_parser.calling)):
+            record_time = self.record_time()
+            if profiler.enabled and (type in 'FRr'):
+                profiler.record(type, indent, id, record_time)
+            if archive.file:
+                archive.record(record_time, type, id, self.fiber or " ", line.rstrip("\r\n"))
+
+        render_buffer.line_class  = type;
+        render_buffer.line_indent = indent;
+        output_text_type("line")
+
+        # Format the output
+
+        # Raw display
+        if (options.raw):
+            output_str("%-15s " % line[0:14].strip(), "raw")
+
+        # Serial Tool header (don't know if we want to show it)
+        if m.group("header"):
+            output_str(m.group("header"))
+
+        # Timestamp
+        if cmd_parser_bool and command_parser and command_parser.calling:
+            output_str (" ".rjust(12) , text_type="time")
+        else:
+            if not options.raw:
+                output_str ("+");
+                output_str (self.fiber);
+            if (self.time_format_determined and self.old_time_format):
+                output_str ("%6d.%02ds " %
+                  ((self.time_highorder*1000+self.trace_time)/100, self.trace_time%100),
+                  text_type="time")
+            else:
+                output_str ("%6d.%02ds " %
+                  (self.last_time/100, self.last_time%100),
+                  text_type="time")
+
+        # Indentation
+        output_text_type("indent")
+        if indent:
+          for i in xrange(indent):
+            if (options.indent) and (cmd_parser_bool and not command_parser.calling):
+                output_str(options.indent)
+            elif not (cmd_parser_bool and command_parser and command_parser.calling):
+                if ((i % 3) == 0):
+                    output_str ('| ')
+                else:
+                    output_str ('. ')
+            else:
+                output_str ('  ')
+        output_text_type("pop") #indent
+
+        # Item name
+        output_text_type(type)
+        if type in self.name_handlers:
+            self.name_handlers[type](m, type, id, items, cmd_parser_bool)
+        else:
+            output_str(type + str(id))
+
+        # Arguments
+        args = m.group("args")
+        if args:
+            self.decode_args(args, type, id, items)
+        else:
+            if type in 'FK':
+                output_str("()")
+
+        # Result value
+        if m.group("result"):
+            self.decode_result(m.group("result"), type, id)
+
+        output_text_type("pop") #type
+
+        if m.group("remain"):
+            output_text_type("pop")
+            render_buffer.line_class  = None;
+            render_buffer.line_indent = None;
+            output_text_type("line")
+            output_str(EOLN + m.group("remain"))
+
+        return m
+
+    def decode_time(self, m, type, id):
+        """Track the trace time of a record"""
+        time_str = m.group("time")
+        self.trace_time = None
+
+        if not self.time_format_determined:
+            if (len(time_str) == 3):
+                if (time_str[0] == '0'):
+                    self.old_time_format = True
+                    self.time_format_determined = True
+            else:
+                self.old_time_format = False
+                self.time_format_determined = True
+
+        if (self.time_format_determined and self.old_time_format):
+            if (not len(time_str) == 3):
+                # time is really old format
+                self.old_time_format = False
+
+        if (self.time_format_determined and self.old_time_format):
+            # Old time format
+            if (type == 'M' or type == 't'):
+                # Time sync
+                new_time = int(id) / 10
+                self.trace_time = new_time % 1000
+                self.time_highorder = new_time / 1000
+            else:
+                # Roll high order of time digits
+                self.trace_time = int(time_str)
+                if (self.trace_time < self.last_time):
+                    self.time_highorder = self.time_highorder + 1
+            self.last_time = self.trace_time
+
+        else:
+            # New time format
+            if (len(time_str) > 0):
+                self.trace_time = int(time_str)
+                self.last_time = self.trace_time
+
+    def decode_args(self, args, type, id, items):
+        """Output the argument list of a record"""
+        args = args.strip("([])")
+        if type == 'Y':
+            output_str('[')
+        else:
+            output_str('(')
+        args = args.split(",")
+        i = 0
+        for arg in args:
+          if (items and (id < len(items))
+                  and (id in items)
+                  and (hasattr(items[id],"argList"))
+                  and (i < len(items[id].argList))):
+              arg_name = items[id].argList[i]
+          else:
+              arg_name = None
+              self.ifile_suspect = True
+          output_text_type("args")
+          output_number (arg, arg_name)
+          if ((type == 'H') and (arg_name == "wrap_line")):
+              self.wrap_count = int(arg)
+              if (self.wrap_count > 0):
+                  output_str("[WRAP]")
+          i = i + 1
+          if (i < len(args)):
+              output_str(", ")
+          output_text_type("pop") #args
+
+        if type == 'Y':
+            output_str(']')
+        else:
+            output_str(')')
+
+    def decode_result(self, result, type, id):
+        """Output the result value of a record"""
+        frames = self.frames
+        if (type == 'R' or type == 'r'):
+            output_str("(")
+            if id in flows_by_id:
+                output_number(result, flows_by_id[id].value_for)
+            else:
+                output_number(result)
+            output_str(")")
+            if (id < len (flows_by_id)):
+                output_str(" // " + flows_by_id[id].name, text_type="comment")
+                try:   #check to make sure flow being returned is in the frame
+                    if len(frames) and frames[len(frames)-1].flow_call == flows_by_id[id].name:
+                       del frames[len(frames)-1]  # removes last frame
+                except:
+                    pass
+        elif (type == 'G'):
+                output_str('=', text_type="comment")
+                output_number(result)
+                output_str(" // global", text_type="comment")
+        else:
+                output_str('=', text_type="comment")
+                output_number(result)
+
+    # Item name handlers
+
+    def name_flow(self, m, type, id, items, cmd_parser_bool):
+        indent = self.indent
+        try:
+            output_str(flows_by_id[id].name)
+            self.flow_stack[indent+1] = flows_by_id[id]
+            #tracks flows for break point back trace
+            try:
+                if not (cmd_parser_bool and command_parser.calling):
+                    if self.trace_time is not None:
+                        self.frames[indent+1] = Frame(m.string, self.time_highorder, self.trace_time)
+            except:
+                pass
+        except KeyError:
+            output_str(type + str(id))
+
+    def name_item(self, m, type, id, items, cmd_parser_bool):
+        if (items) and (id < len(items)):
+            output_str(items[id].name)                           # Item name
+        else:
+            output_str(type + str(id))
+
+    def name_global(self, m, type, id, items, cmd_parser_bool):
+        if (id < len(items)):
+            output_str(items[id])
+        else:
+            output_str(type + str(id))
+
+    def name_return(self, m, type, id, items, cmd_parser_bool):
+        output_str("return")
+
+    def name_resumed(self, m, type, id, items, cmd_parser_bool):
+        # resumed keyword result
+        output_str(type)
+        output_number(str(id))
+
+    def name_string(self, m, type, id, items, cmd_parser_bool):
+        try:
+            output_str(N_STRINGS[id])
+        except IndexError:
+            output_str(type+str(id))
+
+    def name_break(self, m, type, id, items, cmd_parser_bool):
+        global at_a_break_point
+        if self.sets_globals:
+            at_a_break_point = True
+        self.show_statement(id, "BREAK IN  %s()  %s:%s", "BREAK AT  %s", ())
+
+    def name_assert(self, m, type, id, items, cmd_parser_bool):
+        self.show_statement(id, "ASSERT %s IN  %s()  %s:%s", "ASSERT %s AT  %s", (m.group("args"),))
+
+    def show_statement(self, id, found_format, not_found_format, args):
+        """Output the statement at a break or assert and its source code"""
+        global current_fml_file
+        global current_fml_line
+        global break_or_assert_pc
+        global break_or_assert_file
+        global compatibility_error
+        try:
+            s = statement_by_offset[id]
+            output_str((found_format+EOLN)
+                  % (args + (s.flow.name, s.file_name, s.line_number)), "error")
+            fml_file = flows_by_name[s.flow.name].filename
+
+            pc = int(s.line_number)
+            if pc - 5 > 0:
+                start = pc -5
+                stop = pc + 6
+            else:
+                start = 1
+                stop = 11
+            output_str(EOLN)
+            stop = print_fml_source_code (fml_file , start, stop, pc, True, pc)
+            if self.sets_globals:
+                current_fml_file = fml_file
+                current_fml_line = stop
+                break_or_assert_pc = pc
+                break_or_assert_file = fml_file
+                compatibility_error = False
+        except KeyError:
+            output_str((not_found_format+EOLN) % (args + (str(id),)), "error")
+            if self.sets_globals:
+                compatibility_error = True
+                current_fml_file = None
+                current_fml_line = id
+
+    def name_local(self, m, type, id, items, cmd_parser_bool):
+        indent = self.indent
+        try:
+            flow = self.flow_stack[indent]
+            num_locals = len(flow.locals)
+            output_str(flow.locals[num_locals-id])
+        except (KeyError, IndexError):
+            output_str(type + str(id))
+        try:
+            self.frames[indent].locals[id] = m.string
+        except KeyError:
+            pass
+
+    def name_tracing(self, m, type, id, items, cmd_parser_bool):
+        output_text_type("args")
+        output_str("Tracing ")
+        if TRACE_FLUSH & id:
+            output_str(" SLOW FLUSH", "error");
+        if TRACE_FLOWS & id:
+            output_str(" FLOWS", "F");
+        if TRACE_GLOBALS & id:
+            output_str(" GLOBALS", "G");
+        if TRACE_LOCALS & id:
+            output_str(" LOCALS", "L");
+        if TRACE_KEYWORDS & id:
+            output_str(" KEYWORDS", "K");
+        if TRACE_ARRAYS & id:
+            output_str(" ARRAYS");
+        output_text_type("pop") #args
+
+    def name_time(self, m, type, id, items, cmd_parser_bool):
+        # obsolete 't'
+        output_str("Time", "args")
+
+    def name_constant(self, m, type, id, items, cmd_parser_bool):
+        try:
+            output_str(constant_ids[str(id)].upper())
+        except KeyError:
+            output_str(type + str(id))
+
+    def decode_text(self, line):
+        """Decode and output a line that isn't a trace record"""
+        global udws_str_result
+
+        # Timestamp
+        if (not self.time_format_determined) or self.old_time_format:
+            m = timestamp_re.match(line)
+            if m:
+                new_time = int(float(m.group("time"))*100)
+                new_time_highorder = new_time/1000
+                new_last_time = new_time - new_time_highorder*1000
+                if (new_time_highorder != self.time_highorder):
+                    self.last_time = new_last_time
+                    self.time_highorder = new_time_highorder
+                    if (options.debug):
+                        print "Time, time_highorder, last_time = ", time, self.time_highorder, self.last_time
+
+        if ("BEGINNING OF TRACE" in line) or ("END OF TRACE" in line):
+            self.last_time = 0
+
+        # DSID watch and error trap
+        m = None
+        if "udw trap: id " in line:
+            m = dsid_trap_re.match(line)
+        if not m and "DS2 error : DSID " in line:
+            m = dsid_err_re.match(line)
+
+        if m:
+            output_str(m.group("prefix"))
+            output_number(m.group("dsid"))
+            output_str(m.group("suffix"))
+            self.dsid_trap_line = m.group("prefix") + m.group("dsid") + m.group("suffix")
+            if gui: gui.process_events()
+            return
+
+        # Spontaneous machine state change
+        n = None
+        if "PSTS " in line:
+            n = spont_old_new_re.match(line)
+        if n:
+            output_text_type("F")
+            output_str(n.group("PSTS"))
+            output_str(n.group("time"))
+            output_str(n.group("str"))
+            output_str(" "+n.group("new"))
+            new_val = int(n.group("new_value"))
+            output_str(n.group("new_value"), "number")
+            new_id = machine_states[new_val]
+            output_str(" "+new_id + "  ", "named")
+            output_str(n.group("old"),"F")
+            old_val = int(n.group("old_value"))
+            output_str(n.group("old_value"),"F")
+            old_id = machine_states[old_val]
+            output_str(" "+old_id,"F")
+            output_text_type("pop")
+            if gui: gui.process_events()
+            return
+
+        # Underware return result
+        m = None
+        if (';' in line) or ("udws()" in line):
+            m = udws_return_re.match(line)
+        if m:
+            try:
+                last_underware_cmd = command_parser.last_udws_cmd
+            except (NameError, AttributeError):
+                last_underware_cmd = ""
+
+            # Checks if last udws cmd was machine state
+            if dsid_machine_state_re.match(last_underware_cmd):
+                try:
+                    num = int( m.group("result").strip().split(";")[0])
+                    name = m.group("result").replace(str(num), machine_states[num],1).strip()
+                    id =  m.group("result").split(";")[0] + ": "
+                    output_str(id,"args")
+                    output_str(name,"named")
+                except:
+                    pass
+            else: # all other underware results
+
+                if "00001," in line:
+                    results = m.group("result").split("00001,",1)
+                    output_str(results[0]+"00001,","comment")
+                    output_str(results[1],"args")
+                else:
+                    output_str(m.group("result"),"args")
+
+                if self.sets_globals:
+                    udws_str_result = m.group("result")  # MAGGIE: if named 'underware_result", others could use
+                output_str(m.group("suffix"),"comment")
+
+            if self.sets_globals:
+                underware_result_seen.set()
+            if gui: gui.process_events()
+            return
+
+        # Everything else
+        if line.endswith("\n"):
+            try:
+                matches = (dsids_by_id[self.dsid_trap_line.split(",")[0].split(" id ")[1]] == "MACHINE_STATE")
+            except:
+                matches = False
+
+            if matches and old_new_re.match(line):
+                try:
+                    line_match = old_new_re.match(line)
+                    old_int = int(line_match .group("old_value"))
+                    new_int = int(line_match .group("new_value"))
+                    old_name = machine_states[old_int]
+                    new_name = machine_states[new_int]
+                    output_str(line_match .group("old"))
+                    output_str(line_match .group("old_value") + ": ","args")
+                    output_str(old_name,"named")
+                    output_str(line_match .group("new"))
+                    output_str(line_match .group("new_value") + ": ","args")
+                    output_str(new_name,"named")
+                except:
+                    pass
+            else:
+                output_str(line.rstrip())
+            if (self.ifile_suspect):
+                output_str ("        *****  .i file wrong  *****", "error")
+        else:
+            #double udws return..............
+            output_str(line)
+            sys.stdout.flush()
+
+decoder = TraceDecoder()
 
 def process_line(line):
+    decoder.decode(line)
+
+
+#############################################################################################
+#
+# Old Process Line (--benchmark)
+#
+# process_line() as it was before the TraceDecoder, its state in globals. It's kept only
+# so --benchmark can time the TraceDecoder against it on the same file. (The symbol tables
+# it reads are now keyed by int ids.)
+#
+#############################################################################################
+
+def reset_old_process_line():
+    global last_time
+    global time_highorder
+    global time_format_determined
+    global old_time_format
+    global frames
+    global flow_stack
+    global fiber
+    global wrap_count
+    global dsid_trap_line
+    last_time              = 0
+    time_highorder         = 0
+    time_format_determined = False
+    old_time_format        = False
+    frames                 = {}    # Keeps track of flows for break point backtrace print out
+    flow_stack             = {}    # key=indent, value=flow
+    fiber                  = ""
+    wrap_count             = 0
+    dsid_trap_line         = ""
+
+def old_process_line(line):
     global last_time
     global time_highorder
     global dsid_trap_line  #keeps track of latest trap
@@ -5683,8 +7384,6 @@ def process_line(line):
     global compatibility_error
     global at_a_break_point
     global indent
-    global line_class
-    global line_indent
     global wrap_count
     global time_format_determined
     global old_time_format
@@ -5789,8 +7488,8 @@ def process_line(line):
               ifile_suspect = True
 
       if m:
-          line_class  = type;
-          line_indent = indent;
+          render_buffer.line_class  = type;
+          render_buffer.line_indent = indent;
           output_text_type("line")
 
           # Format the output
@@ -5850,7 +7549,7 @@ def process_line(line):
               except KeyError:
                   output_str(type + str(id))
           elif ((items is global_ids) and (id < len(items))):        # TODO: Cleanup
-              output_str(items[str(id)])
+              output_str(items[id])
           elif (items) and (id < len(items)):
               output_str(items[id].name)                           # Item name
           elif (type == 'R' or type == 'r'):
@@ -5866,7 +7565,7 @@ def process_line(line):
           elif (type == 'B'):                   # break
               at_a_break_point = True
               try:
-                  s = statement_by_offset[str(id)]
+                  s = statement_by_offset[id]
                   output_str(("BREAK IN  %s()  %s:%s"+EOLN)
                         % (s.flow.name, s.file_name, s.line_number), "error")
                   current_fml_file = flows_by_name[s.flow.name].filename
@@ -5893,7 +7592,7 @@ def process_line(line):
 
           elif (type == 'A'):                   # assert
               try:
-                  s = statement_by_offset[str(id)]
+                  s = statement_by_offset[id]
                   output_str(("ASSERT %s IN  %s()  %s:%s"+EOLN)
                         % (m.group("args"), s.flow.name, s.file_name, s.line_number), "error")
                   current_fml_file = flows_by_name[s.flow.name].filename
@@ -6023,16 +7722,16 @@ def process_line(line):
 
           if m.group("remain"):
               output_text_type("pop")
-              line_class  = None;
-              line_indent = None;
+              render_buffer.line_class  = None;
+              render_buffer.line_indent = None;
               output_text_type("line")
               output_str(EOLN + m.group("remain"))
 
           want_linefeed = True
 
       else:
-          line_class  = None;
-          line_indent = None;
+          render_buffer.line_class  = None;
+          render_buffer.line_indent = None;
           output_text_type("line")
 
 #          if (using_pcs and (line == PROMPT_PCS)):
@@ -6210,6 +7909,480 @@ def process_line(line):
 
     time_processing += time.clock() - t0
 
+#
+# Render buffer session keeping the text output (see RenderBuffer.write_out)
+#
+class KeptOutput(object):
+    def __init__(self):
+        self.echo = False
+        self.texts = []
+
+    def write_out(self, rb):
+        self.texts.extend(rb.text)
+        rb.text = []
+        rb.gui = []
+        rb.html = []
+        rb.process_events = False
+
+# Time decoding a trace file with old_process_line() and with a TraceDecoder, the output
+# kept instead of written
+def benchmark_decode(data_filename):
+    file_class = (SwappedFile if ".bin" in data_filename else MappedFile)
+    new_decoder = TraceDecoder()
+    new_decoder.recording = False
+    times = []
+    texts = []
+    for decode in (old_process_line, new_decoder.decode):
+        reset_old_process_line()
+        f = file_class(data_filename)
+        lines = 0
+        output = KeptOutput()
+        rb = render_buffer
+        (session, rb.session) = (rb.session, output)
+        start_time = time.time()
+        try:
+            for line in f.lines():
+                if chr(0) not in line:
+                    decode(line)
+                    lines += 1
+        finally:
+            rb.session = session
+            f.close()
+        times.append(time.time() - start_time)
+        texts.append("".join(output.texts))
+    (old_time, new_time) = times
+    sys.stderr.write("benchmark: decode %d lines %.2fs line by line before (%d lines/sec), "
+        "%.2fs with a TraceDecoder (%d lines/sec, %.1fx)%s\n" %
+        (lines, old_time, lines / max(old_time, 0.001), new_time, lines / max(new_time, 0.001),
+        old_time / max(new_time, 0.001), "" if texts[0] == texts[1] else ", RESULTS DIFFER"))
+
+
+#############################################################################################
+#
+# Flow Profiler
+#
+# Builds a call tree from the flow (F) and return (R) records of a live or saved trace to
+# show where the firmware's time goes: calls, inclusive and exclusive time per flow, the
+# busiest call paths, and flamegraph folded stacks. The decoder only queues each record;
+# a thread adds the queued records into the tree every PROFILE_FOLD_TIME seconds (and
+# before a report), so profiling a soak test doesn't hold up decoding. Times are in the
+# trace's hundredths of a second.
+#
+#############################################################################################
+
+# Calls along one call path
+class ProfileNode(object):
+    __slots__ = ("name", "calls", "inclusive", "exclusive", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.inclusive = 0
+        self.exclusive = 0
+        self.children = {}                  # key=flow name, value=ProfileNode
+
+class FlowProfiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.records = collections.deque()  # (type, indent, id, time) not added up yet
+        self.lock = threading.Lock()
+        self.folder = None
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.root = ProfileNode("")
+            self.stack = []                 # calls in progress: [depth, id, node, start time, time in calls]
+            self.flows = {}                 # key=flow name, value=[calls, inclusive, exclusive]
+            self.first_time = None
+            self.last_time = None
+
+    def start(self):
+        self.enabled = True
+        if not self.folder:
+            self.folder = threading.Thread(target=self.fold_records, name="profiler")
+            self.folder.setDaemon(True)
+            self.folder.start()
+
+    def stop(self):
+        self.enabled = False
+
+    def record(self, type, indent, id, time):
+        """Queue a flow or return record (called by the decoder)"""
+        self.records.append((type, indent, id, time))
+
+    def fold_records(self):
+        while True:
+            time.sleep(PROFILE_FOLD_TIME)
+            self.fold()
+
+    def fold(self):
+        """Add the queued records into the call tree"""
+        with self.lock:
+            records = self.records
+            for i in xrange(len(records)):
+                (type, indent, id, time) = records.popleft()
+                if self.first_time is None:
+                    self.first_time = time
+                self.last_time = time
+                if type == 'F':
+                    self.call(indent + 1, id, time)
+                else:
+                    self.ret(id, time)
+
+    def call(self, depth, id, time):
+        while self.stack and (self.stack[-1][0] >= depth):      # returns missing from the trace
+            self.end_call(time)
+        try:
+            name = flows_by_id[id].name
+        except KeyError:
+            name = "F" + str(id)
+        parent = self.stack[-1][2] if self.stack else self.root
+        node = parent.children.get(name)
+        if node is None:
+            node = parent.children[name] = ProfileNode(name)
+        self.stack.append([depth, id, node, time, 0])
+
+    def ret(self, id, time):
+        for i in xrange(len(self.stack) - 1, -1, -1):
+            if self.stack[i][1] == id:
+                while len(self.stack) > i:
+                    self.end_call(time)
+                return
+
+    def end_call(self, time):
+        (depth, id, node, start, time_in_calls) = self.stack.pop()
+        inclusive = max(time - start, 0)
+        exclusive = max(inclusive - time_in_calls, 0)
+        node.calls += 1
+        node.inclusive += inclusive
+        node.exclusive += exclusive
+        if self.stack:
+            self.stack[-1][4] += inclusive
+        flow = self.flows.get(node.name)
+        if flow is None:
+            flow = self.flows[node.name] = [0, 0, 0]
+        flow[0] += 1
+        flow[2] += exclusive
+        if not [call for call in self.stack if call[2].name == node.name]:
+            flow[1] += inclusive            # time in a recursive call is already in the outer call
+
+    def paths(self):
+        """(call path, node) for every call path in the tree"""
+        paths = []
+        nodes = [((), self.root)]
+        while nodes:
+            (path, node) = nodes.pop()
+            for child in node.children.itervalues():
+                paths.append((path + (child.name,), child))
+                nodes.append((path + (child.name,), child))
+        return paths
+
+    def report(self, count=PROFILE_REPORT_LINES):
+        """Output the busiest flows and call paths"""
+        self.fold()
+        with self.lock:
+            flows = sorted(self.flows.iteritems(), key=lambda (name, times): times[2], reverse=True)
+            paths = sorted(self.paths(), key=lambda (path, node): node.exclusive, reverse=True)
+            traced = (self.last_time or 0) - (self.first_time or 0)
+        seconds = lambda time: "%d.%02ds" % (time/100, time%100)
+
+        output_str(EOLN + "Flow profile: %d flows called, %s of trace" % (len(flows), seconds(traced)) + EOLN, "info")
+        output_str("     calls   inclusive   exclusive  flow" + EOLN, "args")
+        for (name, (calls, inclusive, exclusive)) in flows[:count]:
+            output_str("%10d %11s %11s  " % (calls, seconds(inclusive), seconds(exclusive)))
+            output_str(name + EOLN, "F")
+        output_str("Busiest call paths (exclusive time)" + EOLN, "args")
+        for (path, node) in paths[:count]:
+            if node.exclusive:
+                output_str("%11s  " % seconds(node.exclusive))
+                output_str(" > ".join(path) + EOLN, "F")
+
+    def save(self, filename):
+        """Write the call tree as flamegraph folded stacks (exclusive milliseconds per call path)"""
+        self.fold()
+        with self.lock:
+            lines = [";".join(path) + " " + str(node.exclusive * 10) + "\n"
+                     for (path, node) in self.paths() if node.exclusive]
+        lines.sort()
+        try:
+            with open(filename, "w") as f:
+                f.writelines(lines)
+        except IOError, e:
+            output_str("Couldn't save profile: " + str(e) + EOLN, "error")
+            return
+        output_str("Profile saved in: " + filename + EOLN, "info")
+
+profiler = FlowProfiler()
+
+
+#############################################################################################
+#
+# Trace Archive
+#
+# With --archive, each trace record decoded is also written to a compact binary archive:
+# its time, type, id and fiber, and the record itself with its arguments. The records are
+# written in blocks of ARCHIVE_BLOCK_RECORDS, and an index of each block's time range and
+# the symbols in it goes at the end, so "query" reads only the blocks that can match
+# rather than decoding the whole trace again. Matched records are shown by a decoder of
+# their own so the trace being decoded isn't disturbed.
+#
+# An archive is ARCHIVE_MAGIC, the blocks, the marshalled index, then the index offset and
+# ARCHIVE_MAGIC again. A block is its record count and length, then its records a column
+# at a time, compressed: times, ids, types, fibers, where each record's text ends, and the
+# texts. An archive that wasn't closed has no index and is indexed again from the blocks.
+#
+#############################################################################################
+
+ARCHIVE_MAGIC  = "SIFTARC1"
+ARCHIVE_BLOCK  = struct.Struct("<II")   # records, compressed length of the columns
+ARCHIVE_FOOTER = struct.Struct("<Q8s")  # index offset, ARCHIVE_MAGIC
+
+# Writes the trace records to an archive (file is None when not archiving)
+class TraceArchive(object):
+    def __init__(self):
+        self.file = None
+        self.filename = None
+        self.lock = threading.Lock()
+        self.block_size = ARCHIVE_BLOCK_RECORDS
+        self.block = []                     # (time, type, id, fiber, text) not written yet
+
+    def open(self, filename):
+        self.close()
+        try:
+            self.file = open(filename, "wb")
+        except IOError, e:
+            output_str("Couldn't open archive: " + str(e) + EOLN, "error")
+            return False
+        self.filename = filename
+        self.file.write(ARCHIVE_MAGIC)
+        self.offset = len(ARCHIVE_MAGIC)
+        self.blocks = []                    # (offset, records, length, first time, last time)
+        self.symbols = {}                   # key=(type, id), value=numbers of the blocks with it
+        self.block = []
+        return True
+
+    def record(self, time, type, id, fiber, text):
+        """Add a trace record (called by the decoder)"""
+        self.block.append((time, type, id, fiber, text))
+        if len(self.block) >= self.block_size:
+            self.write_block()
+
+    def extend(self, records):
+        """Add records kept by a decoding process"""
+        self.block.extend(records)
+        while len(self.block) >= self.block_size:
+            self.write_block()
+
+    def write_block(self):
+        with self.lock:
+            block = self.block[:self.block_size]
+            del self.block[:self.block_size]
+            if not block:
+                return
+            (times, types, ids, fibers, texts) = zip(*block)
+            times = array.array('i', times)
+            ids = array.array(WORD_TYPECODE, [min(id, 0xFFFFFFFF) for id in ids])
+            ends = array.array(WORD_TYPECODE)
+            end = 0
+            for text in texts:
+                end += len(text)
+                ends.append(end)
+            data = zlib.compress("".join((times.tostring(), ids.tostring(), "".join(types),
+                "".join(fibers), ends.tostring()) + texts))
+            number = len(self.blocks)
+            for key in set(zip(types, ids)):
+                self.symbols.setdefault(key, []).append(number)
+            self.blocks.append((self.offset, len(block), len(data), min(times), max(times)))
+            self.file.write(ARCHIVE_BLOCK.pack(len(block), len(data)))
+            self.file.write(data)
+            self.offset += ARCHIVE_BLOCK.size + len(data)
+
+    def index(self):
+        return {"blocks": self.blocks, "symbols": self.symbols, "byteorder": sys.byteorder,
+                "old_time_format": decoder.old_time_format}
+
+    def flush(self):
+        if self.file:
+            with self.lock:
+                self.file.flush()
+
+    def reader(self):
+        """An ArchiveReader of the records archived so far"""
+        with self.lock:
+            self.file.flush()
+            return ArchiveReader(self.filename, self.index(), list(self.block))
+
+    def close(self):
+        if not self.file:
+            return
+        while self.block:
+            self.write_block()
+        with self.lock:
+            self.file.write(marshal.dumps(self.index()))
+            self.file.write(ARCHIVE_FOOTER.pack(self.offset, ARCHIVE_MAGIC))
+            self.file.close()
+            self.file = None
+
+archive = TraceArchive()
+
+# Finds records in an archive. Given no index, it is read from the end of the archive (or
+# made by reading the blocks). Records not written yet can be given too.
+class ArchiveReader(object):
+    def __init__(self, filename, index=None, pending=()):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        if self.file.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            self.file.close()
+            raise IOError("%s isn't a Sift archive" % filename)
+        self.index = index or self.read_index()
+        self.blocks = self.index["blocks"][:]
+        self.pending = pending
+
+    def read_index(self):
+        f = self.file
+        f.seek(0, 2)
+        size = f.tell()
+        if size >= len(ARCHIVE_MAGIC) + ARCHIVE_FOOTER.size:
+            f.seek(size - ARCHIVE_FOOTER.size)
+            (offset, magic) = ARCHIVE_FOOTER.unpack(f.read(ARCHIVE_FOOTER.size))
+            if magic == ARCHIVE_MAGIC:
+                f.seek(offset)
+                return marshal.loads(f.read(size - ARCHIVE_FOOTER.size - offset))
+
+        # Not closed, index the blocks written
+        if options.debug: debug("ArchiveReader: indexing", self.filename)
+        index = {"blocks": [], "symbols": {}, "byteorder": sys.byteorder,
+                 "old_time_format": decoder.old_time_format}
+        offset = len(ARCHIVE_MAGIC)
+        while offset + ARCHIVE_BLOCK.size <= size:
+            f.seek(offset)
+            (count, length) = ARCHIVE_BLOCK.unpack(f.read(ARCHIVE_BLOCK.size))
+            if offset + ARCHIVE_BLOCK.size + length > size:
+                break
+            entry = (offset, count, length, 0, 0)
+            (times, ids, types) = self.read_block(entry, index["byteorder"])[:3]
+            for key in set(zip(types, ids)):
+                index["symbols"].setdefault(key, []).append(len(index["blocks"]))
+            index["blocks"].append((offset, count, length, min(times), max(times)))
+            offset += ARCHIVE_BLOCK.size + length
+        return index
+
+    def read_block(self, entry, byteorder=None):
+        """The columns of a block: times, ids, types, fibers, text ends, texts"""
+        (offset, count, length) = entry[:3]
+        self.file.seek(offset + ARCHIVE_BLOCK.size)
+        data = zlib.decompress(self.file.read(length))
+        columns = []
+        start = 0
+        for (typecode, size) in (('i', 4), (WORD_TYPECODE, 4), (None, 1), (None, 1), (WORD_TYPECODE, 4)):
+            column = data[start:start + count*size]
+            if typecode:
+                column = array.array(typecode, column)
+                if (byteorder or self.index["byteorder"]) != sys.byteorder:
+                    column.byteswap()
+            columns.append(column)
+            start += count*size
+        columns.append(data[start:])
+        return columns
+
+    def records(self, key=None, start=None, stop=None):
+        """Generate the (time, type, id, fiber, text) records with the key (type, id) from start
+        to stop (times in 100ths of a second, None for either end of the archive)"""
+        low  = -sys.maxint if start is None else start
+        high = sys.maxint if stop is None else stop
+        if key:
+            numbers = [n for n in self.index["symbols"].get(key, ()) if n < len(self.blocks)]
+        else:
+            numbers = range(len(self.blocks))
+        for n in numbers:
+            entry = self.blocks[n]
+            if (entry[3] > high) or (entry[4] < low):
+                continue
+            (times, ids, types, fibers, ends, texts) = self.read_block(entry)
+            within = (entry[3] >= low) and (entry[4] <= high)
+            if key:
+                # Look for the id in the column of ids, then check the type
+                id_data = ids.tostring()
+                packed = array.array(WORD_TYPECODE, [key[1]]).tostring()
+                matches = []
+                i = id_data.find(packed)
+                while i >= 0:
+                    if (i % 4) == 0 and (types[i/4] == key[0]):
+                        matches.append(i/4)
+                    i = id_data.find(packed, i + 1)
+            else:
+                matches = xrange(len(times))
+            for i in matches:
+                if within or (low <= times[i] <= high):
+                    yield (times[i], types[i], ids[i], fibers[i], texts[ends[i-1] if i else 0:ends[i]])
+        for record in self.pending:
+            if ((not key) or (record[1:3] == key)) and (low <= record[0] <= high):
+                yield record
+
+    def close(self):
+        self.file.close()
+
+# Decoder for records found in an archive (archived breaks and asserts aren't the live ones)
+query_decoder = TraceDecoder()
+query_decoder.recording = False
+query_decoder.sets_globals = False
+
+# Archive queried (None to query the one being written)
+query_reader = None
+
+# Find the (type, id) of a symbol name, or of a type and id like "F12"
+def archive_key(name):
+    if name in flows_by_name:
+        return ('F', flows_by_name[name].id)
+    if name in keywords_by_name:
+        return ('K', keywords_by_name[name].id)
+    if name in global_names:
+        return ('G', int(global_names[name]))
+    m = re.match(r"^([A-Za-z=])(\d+)$", name)
+    if m:
+        return (m.group(1), int(m.group(2)))
+    return None
+
+# Show the archived records of a symbol between two times (seconds)
+def query_archive(name=None, start=None, stop=None, limit=ARCHIVE_QUERY_LIMIT):
+    key = None
+    if name:
+        key = archive_key(name)
+        if not key:
+            output_str("Unknown symbol: " + name + EOLN, "error")
+            return
+    if query_reader:
+        reader = query_reader
+    elif archive.file:
+        reader = archive.reader()
+    else:
+        output_str("No archive (use --archive or \"query open <file>\")" + EOLN, "error")
+        return
+
+    start = None if start is None else int(round(start * 100))
+    stop  = None if stop is None else int(round(stop * 100))
+    count = 0
+    t0 = time.time()
+    try:
+        for (record_time, type, id, fiber, text) in reader.records(key, start, stop):
+            if count == limit:
+                output_str("(first %d records shown)" % limit + EOLN, "info")
+                break
+            query_decoder.time_format_determined = True
+            query_decoder.old_time_format = reader.index["old_time_format"]
+            query_decoder.time_highorder = record_time / 1000
+            query_decoder.last_time = 0
+            query_decoder.fiber = fiber.strip()
+            query_decoder.decode(text)
+            count += 1
+        else:
+            output_str("%d records found in %.2fs" % (count, time.time() - t0) + EOLN, "info")
+    finally:
+        if reader is not query_reader:
+            reader.close()
+
 
 #############################################################################################
 #
@@ -6920,13 +9093,340 @@ meter {
   <button title="Clear searches and bread crumbs" onclick="clear_highlights()">Clear Highlights</button>
  </div>
  <div id=info>
-   <meter id="progressbar">0%</meter>
+   <meter id="progressbar">0%</meter>
+   <form name="options">
+     Auto ScrollTo <input title="After search, scroll window" type="checkbox" checked name="autoscroll" value=yes/><br/>
+     Case Sensitive <input title="Case sensitive searching" type="checkbox" name="casesensitive" value=yes/>
+   </form>
+ </div>
+</div>
+"""
+
+# Viewer written as the HTML file when the HTML log is written as pages (--htmlpages). It
+# finds the pages next to itself (trace.html reads trace.pages/), loads the pages being
+# looked at as the window scrolls and forgets ones not looked at for a while. Searching
+# uses the index of the words on each page to load only the pages that can match.
+HTML_PAGES_VIEWER = r"""<!DOCTYPE HTML>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Sift</title>
+<script type="text/javascript">
+
+// Sift HTML pages
+//
+// View with Chrome, Firefox, or Safari.
+
+var PAGES = document.location.href.replace(/[?#].*$/, "").replace(/\.html?$/, "") + ".pages/";
+var LINE_HEIGHT = 16;           // px, matches #view div
+var MAX_HEIGHT = 8000000;       // px, browsers can't scroll much further
+var CACHED_PAGES = 40;          // pages kept once loaded
+
+var index = null;               // lines, page_lines, pages, words (key=word, value=pages)
+var pages = {};                 // key=page number, value=lines of HTML
+var loading = {};               // key=page number, value=functions to call once loaded
+var loaded_order = [];          // page numbers, oldest first
+var first_line = 0;
+var matches = [];               // line numbers matching the search
+var match = -1;
+var search_text = null;
+var searching = 0;              // pages left to search
+
+function status(text) {
+    document.getElementById("status").textContent = text;
+}
+
+function load_script(name) {
+    var script = document.createElement("script");
+    script.src = PAGES + name + "?" + new Date().getTime();
+    script.onload = script.onerror = function() { document.head.removeChild(script); };
+    document.head.appendChild(script);
+}
+
+function page_name(n) {
+    return "page" + ("00000" + n).slice(-6) + ".js";
+}
+
+// Called by index.js
+function sift_index(new_index) {
+    index = new_index;
+    var height = Math.min(index.lines * LINE_HEIGHT, MAX_HEIGHT);
+    document.getElementById("lines").style.height = height + "px";
+    status(index.lines + " lines");
+    render();
+}
+
+// Called by each page file
+function sift_page(n, lines) {
+    pages[n] = lines;
+    loaded_order.push(n);
+    while (loaded_order.length > CACHED_PAGES) {
+        delete pages[loaded_order.shift()];
+    }
+    var waiting = loading[n] || [];
+    delete loading[n];
+    for (var i = 0; i < waiting.length; i++) {
+        waiting[i]();
+    }
+}
+
+// Call done once page n is loaded
+function with_page(n, done) {
+    if (n in pages) {
+        done();
+    } else if (n in loading) {
+        loading[n].push(done);
+    } else {
+        loading[n] = [done];
+        load_script(page_name(n));
+    }
+}
+
+function visible_lines() {
+    return Math.ceil(window.innerHeight / LINE_HEIGHT);
+}
+
+// Line at the top of the window (scrolling is scaled when the lines are too tall)
+function scrolled_line() {
+    var range = document.body.scrollHeight - window.innerHeight;
+    if (range <= 0) return 0;
+    return Math.floor(window.pageYOffset / range * Math.max(index.lines - visible_lines() + 1, 0));
+}
+
+function scroll_to_line(line) {
+    var range = document.body.scrollHeight - window.innerHeight;
+    var lines = Math.max(index.lines - visible_lines() + 1, 1);
+    window.scrollTo(0, Math.ceil(Math.max(line - 2, 0) / lines * range));
+    render();
+}
+
+function render() {
+    if (index == null) return;
+    first_line = scrolled_line();
+    var last_line = Math.min(first_line + visible_lines(), index.lines);
+    var html = [];
+    var missing = {};
+    for (var line = first_line; line < last_line; line++) {
+        var n = Math.floor(line / index.page_lines);
+        if (n in pages) {
+            var text = pages[n][line % index.page_lines];
+            if (line == matches[match]) {
+                text = "<div class=select>" + text + "</div>";
+            } else if ((search_text != null) && (matches.length) && (binary_search(matches, line))) {
+                text = "<div class=search>" + text + "</div>";
+            }
+            html.push(text);
+        } else {
+            html.push("<div class=loading>...</div>");
+            missing[n] = true;
+        }
+    }
+    document.getElementById("view").innerHTML = html.join("");
+    for (var n in missing) {
+        with_page(+n, render);
+    }
+    if (searching == 0) {
+        status("Line " + (first_line + 1) + " of " + index.lines +
+            (matches.length ? ", match " + (match + 1) + " of " + matches.length : ""));
+    }
+}
+
+function binary_search(list, value) {
+    var low = 0, high = list.length - 1;
+    while (low <= high) {
+        var mid = (low + high) >> 1;
+        if (list[mid] < value) low = mid + 1;
+        else if (list[mid] > value) high = mid - 1;
+        else return true;
+    }
+    return false;
+}
+
+// Pages that can have the text on them, from the index of words on each page. Numbers and
+// single letters aren't in the index, so only the words in the text narrow down the pages.
+function pages_to_search(text) {
+    var all = [];
+    for (var n = 0; n < index.pages; n++) all.push(n);
+    var parts = text.toLowerCase().split(/[^a-z0-9_]+/);
+    var found = null;
+    for (var i = 0; i < parts.length; i++) {
+        if ((parts[i].length < 2) || !/^[a-z_]/.test(parts[i])) continue;    // not indexed
+        var with_part = {};
+        for (var word in index.words) {
+            if (word.indexOf(parts[i]) >= 0) {
+                var word_pages = index.words[word];
+                for (var j = 0; j < word_pages.length; j++) with_part[word_pages[j]] = true;
+            }
+        }
+        found = (found == null) ? with_part : intersect(found, with_part);
+    }
+    if (found == null) return all;
+    return all.filter(function(n) { return n in found; });
+}
+
+function intersect(a, b) {
+    var both = {};
+    for (var n in a) if (n in b) both[n] = true;
+    return both;
+}
+
+function plain_text(html) {
+    return html.replace(/<[^>]*>/g, "").replace(/&lt;/g, "<").replace(/&gt;/g, ">").replace(/&amp;/g, "&");
+}
+
+function find(text) {
+    if ((index == null) || (text == "")) return;
+    search_text = text;
+    matches = [];
+    match = -1;
+    var case_sensitive = document.options.casesensitive.checked;
+    if (!case_sensitive) text = text.toLowerCase();
+    var todo = pages_to_search(text);
+    var total = todo.length;
+    searching = total;
+    var search = search_text;
+    function next_page() {
+        if (search != search_text) return;          // a new search started
+        if (todo.length == 0) {
+            searching = 0;
+            matches.sort(function(a, b) { return a - b; });
+            if (matches.length) {
+                next(1);
+            } else {
+                render();
+                status("Not found: " + search);
+            }
+            return;
+        }
+        var n = todo.shift();
+        with_page(n, function() {
+            var lines = pages[n];
+            for (var i = 0; i < lines.length; i++) {
+                var line = plain_text(lines[i]);
+                if (!case_sensitive) line = line.toLowerCase();
+                if (line.indexOf(text) >= 0) matches.push(n * index.page_lines + i);
+            }
+            status("Searching " + (total - todo.length) + " of " + total + " pages, " + matches.length + " found");
+            setTimeout(next_page, 0);
+        });
+    }
+    next_page();
+}
+
+function next(direction) {
+    if (matches.length == 0) return;
+    if (match < 0) {
+        // first match after the top of the window
+        match = 0;
+        while ((match < matches.length) && (matches[match] < first_line)) match++;
+        if (direction < 0) match--;
+    } else {
+        match += direction;
+    }
+    match = (match + matches.length) % matches.length;
+    scroll_to_line(matches[match]);
+}
+
+function search_keypress(e) {
+    if (e.keyCode == 13) find(document.getElementById("searchbox").value);
+}
+
+// Lines are all shown in pages, there are no flows to open or close
+function toggle(event) {
+}
+
+function reload() {
+    pages = {};
+    loaded_order = [];
+    load_script("index.js");
+}
+
+function load() {
+    window.onscroll = render;
+    window.onresize = render;
+    reload();
+}
+
+</script>
+
+<style>
+body  {color:grey; font-family:monospace; font-size:10pt; background-color:Ivory; margin:0;}
+#view {position:fixed; top:0; left:0; right:0; padding-left:8px;}
+#view div {height:16px; line-height:16px; margin:0; padding:0; white-space:pre; overflow:hidden;}
+#view div div {padding:0;}
+.i {color:red; font-weight:normal;}
+.F {color:black; font-weight:bold;}
+.G {color:green;}
+.K {color:MediumBlue;}
+.r {color:black;}
+.time {color:grey; font-weight:normal;}
+.args {color:blue; font-weight:normal;}
+.number {color:red;}
+.named {color:magenta;}
+.comment {font-style:italic;}
+.search {background-color:Aquamarine;}
+.select {background-color:Khaki;}
+.loading {color:lightgrey;}
+#panel {
+    text-align: center;
+    position:fixed;
+    top:0;right:0;
+    padding:2px;
+    background: rgba(139,119,101,0.1);
+    border-left: 1px solid rgba(139,119,101,0.2);
+    border-bottom: 1px solid rgba(139,119,101,0.2);
+    color: black;
+    z-index: 1;
+}
+#panel #status {
+    color: green;
+}
+#searchbox {
+   text-align: center;
+   background: rgba(255,255,255,0.7);
+}
+#searchcmds button {
+   width: 60px;
+   border: 1px solid darkblue;
+   background: pink;
+   margin-top:5px;
+}
+#info {
+    margin-top:1px;
+    color: black;
+    font-size: small;
+    text-align: right;
+    opacity:0.5;
+}
+</style>
+</head>
+
+<body onload="load()">
+
+<div id=lines></div>
+<div id=view></div>
+
+<div id=panel>
+ <div id=searchline>
+  <input type="text" name="siftsearch" id="searchbox" size=30 onkeydown="search_keypress(event)">
+ </div>
+ <div id=statusline>
+   <span id=status>Welcome to Sift</span>
+ </div>
+ <div id=searchcmds>
+  <button title="Find all matches" onclick="find(document.getElementById('searchbox').value)">Find</button>
+  <button title="Find next match" onclick="next(1)">Next</button>
+  <button title="Find previous match" onclick="next(-1)">Prev</button>
+  <button title="Show lines added since the page was loaded" onclick="reload()">Reload</button>
+ </div>
+ <div id=info>
    <form name="options">
-     Auto ScrollTo <input title="After search, scroll window" type="checkbox" checked name="autoscroll" value=yes/><br/>
      Case Sensitive <input title="Case sensitive searching" type="checkbox" name="casesensitive" value=yes/>
    </form>
  </div>
 </div>
+</body>
+</html>
 """
 
 
@@ -6939,10 +9439,96 @@ meter {
 #
 #############################################################################################
 
+# A trace file read through a memory map, so reading it doesn't copy the whole file or
+# make a system call per line. Offsets are byte offsets into the file.
+class MappedFile(object):
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        else:
+            self.map = ""                   # an empty file can't be mapped
+        self.crlf = (os.linesep == "\r\n")  # read lines as a text mode file would
+
+    def close(self):
+        if self.size:
+            self.map.close()
+        self.file.close()
+
+    def read(self, start, stop):
+        """The bytes from offset start up to offset stop"""
+        return self.map[start:stop]
+
+    def line_end(self, offset):
+        """Offset just past the end of the line at offset"""
+        while offset < self.size:
+            block = self.read(offset, offset + LINE_SEARCH_SIZE)
+            end = block.find("\n")
+            if end >= 0:
+                return offset + end + 1
+            offset += len(block)
+        return self.size
+
+    def line_start(self, offset):
+        """Offset of the first line starting at or after offset"""
+        if (offset == 0) or (self.read(offset - 1, offset) == "\n"):
+            return offset
+        return self.line_end(offset)
+
+    def lines_back(self, offset, count):
+        """Offset of the line count lines before the line at offset"""
+        while (offset > 0) and (count > 0):
+            end = offset - 1                # newline ending the line before
+            offset = 0
+            while end > 0:
+                start = max(end - LINE_SEARCH_SIZE, 0)
+                newline = self.read(start, end).rfind("\n")
+                if newline >= 0:
+                    offset = start + newline + 1
+                    break
+                end = start
+            count -= 1
+        return offset
+
+    def line(self, offset):
+        return self.read(offset, self.line_end(offset))
+
+    def lines(self, start=0, stop=None):
+        """The lines from offset start up to offset stop"""
+        if stop is None:
+            stop = self.size
+        partial = ""
+        for offset in xrange(start, stop, MAPPED_BLOCK_SIZE):
+            lines = (partial + self.read(offset, min(offset + MAPPED_BLOCK_SIZE, stop))).split("\n")
+            partial = lines.pop()
+            for line in lines:
+                if self.crlf and line.endswith("\r"):
+                    line = line[:-1]
+                yield line + "\n"
+        if partial:
+            yield partial
+
+WORD_TYPECODE = [code for code in "IL" if array.array(code).itemsize == 4][0]   # array of 32 bit words
+
+# Swap the bytes of each 32 bit word. Bytes after the last whole word are swapped around too.
+def swap_words(data):
+    words = len(data) & ~3
+    swapped = array.array(WORD_TYPECODE, data[:words])
+    swapped.byteswap()
+    return swapped.tostring() + data[words:][::-1]
+
+# A coredump read through a memory map with the bytes of each word swapped into order
+class SwappedFile(MappedFile):
+    def read(self, start, stop):
+        first = start & ~3
+        last = min((stop + 3) & ~3, self.size)
+        return swap_words(self.map[first:last])[start-first:stop-first]
+
 # Swap words in the coredump input file
 def swap (input_filename, output_filename):
     try:
-        input  = open(input_filename, "rb")
+        input  = SwappedFile(input_filename)
     except:
         output_str(EOLN+"Bin file '"+str(input_filename)+"' couldn't be opened"+EOLN,text_type="error")
         raise
@@ -6953,6 +9539,23 @@ def swap (input_filename, output_filename):
                 " while processing coredump, maybe need write access."+EOLN,text_type="error")
         exit()
 
+    for offset in xrange(0, input.size, MAPPED_BLOCK_SIZE):
+        output.write(input.read(offset, offset + MAPPED_BLOCK_SIZE))
+    input.close()
+    output.close()
+
+# Time swapping a synthetic coredump of the given size a byte at a time (as swap() used
+# to) against swapping it a block at a time
+def benchmark_swap(megabytes):
+    dump_filename = os.path.join(SIFT_CONFIG_DIR, "benchmark.bin")
+    raw_filename  = os.path.join(SIFT_CONFIG_DIR, "benchmark.raw")
+    with open(dump_filename, "wb") as dump:
+        for i in xrange(megabytes):
+            dump.write(os.urandom(1048576))
+
+    start_time = time.time()
+    input  = open(dump_filename, "rb")
+    output = open(raw_filename, "wb")
     a = input.read(1)
     while (a):
         b = input.read(1)
@@ -6965,40 +9568,185 @@ def swap (input_filename, output_filename):
         a = input.read(1)
     input.close()
     output.close()
+    bytewise_time = time.time() - start_time
+    with open(raw_filename, "rb") as raw:
+        bytewise_md5 = hashlib.md5(raw.read()).hexdigest()
+
+    start_time = time.time()
+    swap(dump_filename, raw_filename)
+    block_time = time.time() - start_time
+    with open(raw_filename, "rb") as raw:
+        block_md5 = hashlib.md5(raw.read()).hexdigest()
+
+    os.remove(dump_filename)
+    os.remove(raw_filename)
+    sys.stderr.write("benchmark: swap %dMB %.2fs a byte at a time, %.2fs a block at a time (%.0fx)%s\n" %
+        (megabytes, bytewise_time, block_time, bytewise_time / max(block_time, 0.001),
+        "" if block_md5 == bytewise_md5 else ", RESULTS DIFFER"))
+
+#############################################################################################
+#
+# Parallel Decoding
+#
+# A saved trace or coredump can be decoded by several processes (--jobs). The file is cut
+# into pieces where the trace time is resynced, each process decodes a piece starting
+# from what it picks up on the lines just before it, and the pieces are written out in
+# order. A piece only counts when its starting state is the state serial decoding
+# arrives at, otherwise it is decoded again here. Wrapped data held back by a piece
+# is kept for the end, as when decoding serially.
+#
+#############################################################################################
+
+# Globals that decoding only sets, passed back from the decoding processes
+DECODER_SET_GLOBALS = ("at_a_break_point", "compatibility_error", "current_fml_file",
+    "current_fml_line", "break_or_assert_pc", "break_or_assert_file", "udws_str_result")
+
+parallel_file = None                        # MappedFile being decoded in parallel
+not_set = object()
+
+# Can the time be worked out from this line alone
+def is_time_resync(line):
+    m = decode_line_re.match(line)
+    return m and ((m.group("type") in "Mt") or (len(m.group("time")) != 3))
+
+# Split a MappedFile into (warmup, start, stop) pieces, each starting at a time resync
+def parallel_chunks(mapped, jobs):
+    size = max(mapped.size / (jobs * PARALLEL_CHUNKS_PER_JOB), PARALLEL_MIN_CHUNK_SIZE)
+    starts = [0]
+    for start in xrange(size, mapped.size, size):
+        start = mapped.line_start(max(start, starts[-1] + 1))
+        while (start < mapped.size) and not is_time_resync(mapped.line(start)):
+            start = mapped.line_end(start)
+        if start < mapped.size:
+            starts.append(start)
+    stops = starts[1:] + [mapped.size]
+    return [(mapped.lines_back(start, PARALLEL_WARMUP_LINES), start, stop) for (start, stop) in zip(starts, stops)]
+
+# Decode a line of a file, holding it back if the data has wrapped
+def decode_file_line(line, hold_queue):
+    if (not chr(0) in line):
+        if (decoder.wrap_count > 0):        # detected data has wrapped, save it for later
+            hold_queue.append(line)
+            decoder.wrap_count = decoder.wrap_count - 1
+        else:
+            process_line(line)
+
+# Decode a piece of parallel_file in a decoding process, return its output and states
+def decode_chunk(chunk):
+    global lines_processed
+    global html_output_size
+    global time_processing
+    (warmup, start, stop) = chunk
+    rb = render_buffer
+    first_end = parallel_file.line_end(start)
+
+    output_begin()
+    for line in parallel_file.lines(warmup, first_end):
+        decode_file_line(line, [])
+    (rb.stdout, rb.text, rb.html) = ([], [], [])
+    profiler.records.clear()
+    archive.block = []
+    archive.block_size = sys.maxint         # the parent writes the archive
+    start_state = decoder.get_state()
+    for name in DECODER_SET_GLOBALS:
+        globals()[name] = not_set
+    (lines_then, html_size_then, time_then) = (lines_processed, html_output_size, time_processing)
+
+    hold_queue = []
+    for line in parallel_file.lines(first_end, stop):
+        decode_file_line(line, hold_queue)
+
+    set_globals = dict((name, globals()[name]) for name in DECODER_SET_GLOBALS if globals()[name] is not not_set)
+    return ("".join(rb.stdout), "".join(rb.text), "".join(rb.html), hold_queue, start_state,
+        decoder.get_state(), set_globals, lines_processed - lines_then, html_size_then - html_output_size,
+        time_processing - time_then, list(profiler.records), archive.block)
+
+# Decode a MappedFile with options.jobs processes. Lines held back because the data has
+# wrapped are added to hold_queue. Return False if the file is too small to split up (or
+# this Python has no multiprocessing).
+def decode_in_parallel(mapped, hold_queue):
+    global parallel_file
+    global lines_processed
+    global html_output_size
+    global time_processing
+
+    try:                    # Python 2.6 and later, otherwise the file is decoded in this process
+        import multiprocessing
+    except ImportError:
+        return False
+
+    chunks = parallel_chunks(mapped, options.jobs)
+    if len(chunks) < 2:
+        return False
+
+    rb = render_buffer
+    parallel_file = mapped
+    archive.flush()                         # so the decoding processes don't write it again
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        for ((warmup, start, stop), result) in zip(chunks, pool.imap(decode_chunk, chunks)):
+            first_end = mapped.line_end(start)
+            decode_file_line(mapped.line(start), hold_queue)
+            (stdout, text, html, held, start_state, end_state, set_globals, count, html_size, seconds,
+                profile_records, archive_records) = result
+            if start_state == decoder.get_state():
+                rb.stdout.append(stdout)
+                rb.text.append(text)
+                rb.html.append(html)
+                hold_queue.extend(held)
+                decoder.set_state(end_state)
+                globals().update(set_globals)
+                lines_processed += count
+                html_output_size -= html_size
+                time_processing += seconds
+                profiler.records.extend(profile_records)
+                archive.extend(archive_records)
+            else:
+                if options.debug: debug("decode_in_parallel: decoding again from", first_end)
+                for line in mapped.lines(first_end, stop):
+                    decode_file_line(line, hold_queue)
+            output_end()
+            output_begin()
+    finally:
+        pool.terminate()
+        parallel_file = None
+    return True
 
 # Process a data file
 def process_file(data_filename):
-    global wrap_count
-    wrap_count = 0                          # process_line() sets hold_count if data has wrapped
-
-    if (".bin" in data_filename):           # coredump is word swapped, convert to normal raw file
-        try:
-            swap(data_filename, RAW_OUTPUT_FILE)
-        except:
-            return
+    decoder.wrap_count = 0                  # process_line() sets wrap_count if data has wrapped
 
-        data_filename = RAW_OUTPUT_FILE
+    if (".bin" in data_filename):           # coredump is word swapped, swap it back as it's read
+        file_class = SwappedFile
+    else:
+        file_class = MappedFile
     try:
-        f = open(data_filename, "r")
+        f = file_class(data_filename)
     except:
         try:
-            f = open(os.path.join(dir_sift_started_in,data_filename), "r")
+            f = file_class(os.path.join(dir_sift_started_in,data_filename))
         except:
             output_str(EOLN + "Raw file '" + str(data_filename) + "' couldn't be opened" +EOLN, text_type="error")
             return
 
     hold_queue = collections.deque()        # create fifo to hold wrapped data
-    for line in f:
-        if (not chr(0) in line):
-            if (wrap_count > 0):                # detected data has wrapped, save it for later
-                hold_queue.append(line)
-                wrap_count = wrap_count - 1
-            else:
+    output_begin()                          # write output every FILE_OUTPUT_LINES, not every line
+    try:
+        lines = f.lines()
+        if (options.jobs > 1) and (os.name == 'posix') and (not options.gui):
+            if decode_in_parallel(f, hold_queue):
+                lines = []
+        for (count, line) in enumerate(lines):
+            decode_file_line(line, hold_queue)
+            if (count % FILE_OUTPUT_LINES) == 0:
+                output_end()
+                output_begin()
+        if (len(hold_queue) > 0):
+            decoder.wrap_count = -1;
+            for line in hold_queue:                 # now process the wrapped data
                 process_line(line)
-    if (len(hold_queue) > 0):
-        wrap_count = -1;
-        for line in hold_queue:                 # now process the wrapped data
-            process_line(line)
+    finally:
+        output_end()
     f.close()
 
 
@@ -7157,6 +9905,10 @@ else:
   # gets much better performance regardless of buffer size
   GUI_DEFAULT_LINES = 100000
 
+  # Output written to the GUI is queued and handed to the BufferView once a frame
+  GUI_FRAME_TIME = 16                   # ms
+  GUI_MAX_QUEUED = 200000               # pieces of output waiting for a frame, more are dropped
+
   class BufferView(SiftWidget.BufferView):
       def __init__(self, maxLines = GUI_DEFAULT_LINES, parent = None):
           SiftWidget.BufferView.__init__(self, maxLines, parent)
@@ -7185,8 +9937,9 @@ else:
           gui.sf_displayFlow(text)
 
       def insertPlainText(self, text):
-          global line_indent
-          indent = line_indent
+          self.insertIndentedText(text, render_buffer.line_indent)
+
+      def insertIndentedText(self, text, indent):
           if indent == 99 or indent is None:
               indent = -1
           self.addText(text, indent)
@@ -7228,6 +9981,55 @@ else:
         if event.button() == QtCore.Qt.LeftButton and self.rect().contains(event.pos()):
             self._pickColor()
 
+  # A list for a list view or combo box that reads its rows straight from the symbol
+  # tables as they're shown, rather than copying every symbol into an item.  rows() gives
+  # the rows (a list, usually the table itself or the sorted names in it) and text(row)
+  # what's shown for one.  The filter is applied here too, so only the rows whose text
+  # contains it (any case) are shown.  Call load() when the tables change.
+  class SymbolListModel(QtCore.QAbstractListModel):
+    def __init__(self, rows, text=str, parent=None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.get_rows = rows
+        self.text = text
+        self.filter = ""
+        self.rows = []                      # the text shown for each row
+        self.shown = self.rows
+        self.count = 0                      # rows shown (the table may grow until the next load)
+
+    def load(self):
+        """Read the rows from the symbol tables again (their text too, so painting and
+           filtering don't look in the tables, which a reload empties and refills)"""
+        text = self.text
+        self.rows = [text(row) for row in self.get_rows()]
+        self.show()
+
+    def clear(self):
+        self.rows = []
+        self.show()
+
+    def set_filter(self, text):
+        self.filter = str(text).strip().lower()
+        self.show()
+
+    def show(self):
+        if self.filter:
+            self.shown = [row for row in self.rows if self.filter in row.lower()]
+        else:
+            self.shown = self.rows
+        self.count = len(self.shown)
+        self.reset()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.count
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if index.isValid() and (index.row() < self.count) and \
+           (role == QtCore.Qt.DisplayRole or role == QtCore.Qt.EditRole):
+            return QtCore.QVariant(self.shown[index.row()])
+        return QtCore.QVariant()
+
 
 
   ########################################
@@ -8101,25 +10903,34 @@ else:
         self.horizontalLayout_3.setSpacing(2)
         self.horizontalLayout_3.setMargin(1)
         self.horizontalLayout_3.setObjectName(_fromUtf8("horizontalLayout_3"))
+        self.dsidLayout = QtGui.QVBoxLayout()
+        self.dsidLayout.setSpacing(2)
+        self.dsidLayout.setObjectName(_fromUtf8("dsidLayout"))
+        self.dsid_filter = QtGui.QLineEdit(self.DSIDTab)
+        self.dsid_filter.setObjectName(_fromUtf8("dsid_filter"))
+        self.dsidLayout.addWidget(self.dsid_filter)
         self.horizontalLayout_2 = QtGui.QHBoxLayout()
         self.horizontalLayout_2.setObjectName(_fromUtf8("horizontalLayout_2"))
-        self.dsids = QtGui.QListWidget(self.DSIDTab)
+        self.dsids = QtGui.QListView(self.DSIDTab)
         font = QtGui.QFont()
         font.setPointSize(9)
         self.dsids.setFont(font)
         self.dsids.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.dsids.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.dsids.setUniformItemSizes(True)
         self.dsids.setObjectName(_fromUtf8("dsids"))
         self.horizontalLayout_2.addWidget(self.dsids)
-        self.dsid_numbers = QtGui.QListWidget(self.DSIDTab)
+        self.dsid_numbers = QtGui.QListView(self.DSIDTab)
         font = QtGui.QFont()
         font.setPointSize(9)
         self.dsid_numbers.setFont(font)
         self.dsid_numbers.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.dsid_numbers.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.dsid_numbers.setUniformItemSizes(True)
         self.dsid_numbers.setObjectName(_fromUtf8("dsid_numbers"))
         self.horizontalLayout_2.addWidget(self.dsid_numbers)
-        self.horizontalLayout_3.addLayout(self.horizontalLayout_2)
+        self.dsidLayout.addLayout(self.horizontalLayout_2)
+        self.horizontalLayout_3.addLayout(self.dsidLayout)
         self.Tabs.addTab(self.DSIDTab, _fromUtf8(""))
         self.UnderwareTab = QtGui.QWidget()
         self.UnderwareTab.setObjectName(_fromUtf8("UnderwareTab"))
@@ -8129,14 +10940,22 @@ else:
         self.horizontalLayout_6.setObjectName(_fromUtf8("horizontalLayout_6"))
         self.horizontalLayout_5 = QtGui.QHBoxLayout()
         self.horizontalLayout_5.setObjectName(_fromUtf8("horizontalLayout_5"))
-        self.underware = QtGui.QListWidget(self.UnderwareTab)
+        self.underwareLayout = QtGui.QVBoxLayout()
+        self.underwareLayout.setSpacing(2)
+        self.underwareLayout.setObjectName(_fromUtf8("underwareLayout"))
+        self.underware_filter = QtGui.QLineEdit(self.UnderwareTab)
+        self.underware_filter.setObjectName(_fromUtf8("underware_filter"))
+        self.underwareLayout.addWidget(self.underware_filter)
+        self.underware = QtGui.QListView(self.UnderwareTab)
         font = QtGui.QFont()
         font.setPointSize(9)
         self.underware.setFont(font)
         self.underware.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.underware.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.underware.setUniformItemSizes(True)
         self.underware.setObjectName(_fromUtf8("underware"))
-        self.horizontalLayout_5.addWidget(self.underware)
+        self.underwareLayout.addWidget(self.underware)
+        self.horizontalLayout_5.addLayout(self.underwareLayout)
         self.underware_description = QtGui.QTextEdit(self.UnderwareTab)
         self.underware_description.setReadOnly(True)
         self.underware_description.setObjectName(_fromUtf8("underware_description"))
@@ -8145,9 +10964,15 @@ else:
         self.Tabs.addTab(self.UnderwareTab, _fromUtf8(""))
         self.VariablesTab = QtGui.QWidget()
         self.VariablesTab.setObjectName(_fromUtf8("VariablesTab"))
-        self.horizontalLayout_4 = QtGui.QHBoxLayout(self.VariablesTab)
+        self.variablesLayout = QtGui.QVBoxLayout(self.VariablesTab)
+        self.variablesLayout.setSpacing(2)
+        self.variablesLayout.setMargin(1)
+        self.variablesLayout.setObjectName(_fromUtf8("variablesLayout"))
+        self.variables_filter = QtGui.QLineEdit(self.VariablesTab)
+        self.variables_filter.setObjectName(_fromUtf8("variables_filter"))
+        self.variablesLayout.addWidget(self.variables_filter)
+        self.horizontalLayout_4 = QtGui.QHBoxLayout()
         self.horizontalLayout_4.setSpacing(2)
-        self.horizontalLayout_4.setMargin(1)
         self.horizontalLayout_4.setObjectName(_fromUtf8("horizontalLayout_4"))
         self.verticalLayout = QtGui.QVBoxLayout()
         self.verticalLayout.setObjectName(_fromUtf8("verticalLayout"))
@@ -8155,12 +10980,13 @@ else:
         self.label.setAlignment(QtCore.Qt.AlignBottom|QtCore.Qt.AlignLeading|QtCore.Qt.AlignLeft)
         self.label.setObjectName(_fromUtf8("label"))
         self.verticalLayout.addWidget(self.label)
-        self.globals = QtGui.QListWidget(self.VariablesTab)
+        self.globals = QtGui.QListView(self.VariablesTab)
         font = QtGui.QFont()
         font.setPointSize(10)
         self.globals.setFont(font)
         self.globals.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.globals.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.globals.setUniformItemSizes(True)
         self.globals.setObjectName(_fromUtf8("globals"))
         self.verticalLayout.addWidget(self.globals)
         self.horizontalLayout_4.addLayout(self.verticalLayout)
@@ -8170,12 +10996,13 @@ else:
         self.label_2.setAlignment(QtCore.Qt.AlignBottom|QtCore.Qt.AlignLeading|QtCore.Qt.AlignLeft)
         self.label_2.setObjectName(_fromUtf8("label_2"))
         self.verticalLayout_2.addWidget(self.label_2)
-        self.constants = QtGui.QListWidget(self.VariablesTab)
+        self.constants = QtGui.QListView(self.VariablesTab)
         font = QtGui.QFont()
         font.setPointSize(9)
         self.constants.setFont(font)
         self.constants.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.constants.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.constants.setUniformItemSizes(True)
         self.constants.setObjectName(_fromUtf8("constants"))
         self.verticalLayout_2.addWidget(self.constants)
         self.horizontalLayout_4.addLayout(self.verticalLayout_2)
@@ -8185,15 +11012,17 @@ else:
         self.label_3.setAlignment(QtCore.Qt.AlignBottom|QtCore.Qt.AlignLeading|QtCore.Qt.AlignLeft)
         self.label_3.setObjectName(_fromUtf8("label_3"))
         self.verticalLayout_3.addWidget(self.label_3)
-        self.named = QtGui.QListWidget(self.VariablesTab)
+        self.named = QtGui.QListView(self.VariablesTab)
         font = QtGui.QFont()
         font.setPointSize(9)
         self.named.setFont(font)
         self.named.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.named.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.named.setUniformItemSizes(True)
         self.named.setObjectName(_fromUtf8("named"))
         self.verticalLayout_3.addWidget(self.named)
         self.horizontalLayout_4.addLayout(self.verticalLayout_3)
+        self.variablesLayout.addLayout(self.horizontalLayout_4)
         self.Tabs.addTab(self.VariablesTab, _fromUtf8(""))
         self.OptionsTab = QtGui.QWidget()
         self.OptionsTab.setObjectName(_fromUtf8("OptionsTab"))
@@ -8459,13 +11288,13 @@ else:
         self.Tabs.setTabText(self.Tabs.indexOf(self.UserTab), QtGui.QApplication.translate("MainWindow", "User Favorites", None, QtGui.QApplication.UnicodeUTF8))
         self.Tabs.setTabText(self.Tabs.indexOf(self.HighlightTab), QtGui.QApplication.translate("MainWindow", "User Highlights", None, QtGui.QApplication.UnicodeUTF8))
         self.dsids.setToolTip(QtGui.QApplication.translate("MainWindow", "Double click to query DSID", None, QtGui.QApplication.UnicodeUTF8))
-        self.dsids.setSortingEnabled(True)
         self.dsid_numbers.setToolTip(QtGui.QApplication.translate("MainWindow", "Double click to query DSID", None, QtGui.QApplication.UnicodeUTF8))
-        self.dsid_numbers.setSortingEnabled(True)
+        self.dsid_filter.setToolTip(QtGui.QApplication.translate("MainWindow", "Type to show only the DSIDs containing the text", None, QtGui.QApplication.UnicodeUTF8))
         self.Tabs.setTabText(self.Tabs.indexOf(self.DSIDTab), QtGui.QApplication.translate("MainWindow", "DSIDs", None, QtGui.QApplication.UnicodeUTF8))
         self.underware.setToolTip(QtGui.QApplication.translate("MainWindow", "Double click to copy underware to input box.", None, QtGui.QApplication.UnicodeUTF8))
-        self.underware.setSortingEnabled(True)
+        self.underware_filter.setToolTip(QtGui.QApplication.translate("MainWindow", "Type to show only the underware containing the text", None, QtGui.QApplication.UnicodeUTF8))
         self.Tabs.setTabText(self.Tabs.indexOf(self.UnderwareTab), QtGui.QApplication.translate("MainWindow", "Underware", None, QtGui.QApplication.UnicodeUTF8))
+        self.variables_filter.setToolTip(QtGui.QApplication.translate("MainWindow", "Type to show only the variables containing the text", None, QtGui.QApplication.UnicodeUTF8))
         self.label.setText(QtGui.QApplication.translate("MainWindow", "Globals", None, QtGui.QApplication.UnicodeUTF8))
         self.globals.setToolTip(QtGui.QApplication.translate("MainWindow", "Double click to query global", None, QtGui.QApplication.UnicodeUTF8))
         self.label_2.setText(QtGui.QApplication.translate("MainWindow", "Constants", None, QtGui.QApplication.UnicodeUTF8))
@@ -8541,6 +11370,7 @@ else:
     NUM_HIGHLIGHT_LINES = 10
     exception = QtCore.pyqtSignal(QtCore.QString)
     dataready = QtCore.pyqtSignal()
+    symbolsadded = QtCore.pyqtSignal()
     ioready   = QtCore.pyqtSignal()
 
     def __init__(self):
@@ -8562,6 +11392,7 @@ else:
                 break
         self.exception.connect(self.handle_exception, QtCore.Qt.QueuedConnection)
         self.dataready.connect(self.handle_dataready, QtCore.Qt.QueuedConnection)
+        self.symbolsadded.connect(self.handle_symbolsadded, QtCore.Qt.QueuedConnection)
         self.ioready.connect(self.handle_ioready, QtCore.Qt.QueuedConnection)
         if sys.platform == "darwin":
             self.app.setStyle("Cleanlooks")
@@ -8580,13 +11411,42 @@ else:
         self.dsids_loaded = False
         self.underware_loaded = False
         self.variables_loaded = False
-        self.global_breaks_loaded = False
         self.favorites_loaded = False
         self.data_ready_event = threading.Event()
+        self.loaded_flows = None                # flows list once all the symbols are loaded
+
+        # The symbol lists are models reading the symbol tables, not items copied from them
+        self.dsids_model = SymbolListModel(self.dsid_rows,
+                                           lambda dsid: "%s  (%05d)" % (dsid, int(dsids_by_name[dsid])))
+        self.dsid_numbers_model = SymbolListModel(lambda: sorted(self.dsid_rows(), key=self.dsid_number),
+                                                  lambda dsid: "(%05d)  %s" % (int(dsids_by_name[dsid]), dsid))
+        self.underware_model = SymbolListModel(lambda: sorted(underware))
+        self.globals_model = SymbolListModel(lambda: sorted(global_names.keys()))
+        self.constants_model = SymbolListModel(lambda: self.constant_rows(False), self.constant_text)
+        self.named_model = SymbolListModel(lambda: self.constant_rows(True), self.constant_text)
+        self.single_model = SymbolListModel(lambda: [""] + flows + keywords)
+        self.flow_break_model = SymbolListModel(lambda: [""] + flows)
+        self.global_break_model = SymbolListModel(lambda: [""] + sorted(global_names.keys()))
+        self.input_model = SymbolListModel(lambda: everything)
+        self.ui.dsids.setModel(self.dsids_model)
+        self.ui.dsid_numbers.setModel(self.dsid_numbers_model)
+        self.ui.underware.setModel(self.underware_model)
+        self.ui.globals.setModel(self.globals_model)
+        self.ui.constants.setModel(self.constants_model)
+        self.ui.named.setModel(self.named_model)
+        self.ui.single.setModel(self.single_model)
+        self.ui.flow_break.setModel(self.flow_break_model)
+        self.ui.global_break.setModel(self.global_break_model)
+        input_completer = QtGui.QCompleter(self.input_model, self)
+        input_completer.setModelSorting(QtGui.QCompleter.CaseInsensitivelySortedModel)
+        input_completer.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
+        self.ui.input.setCompleter(input_completer)
         self.openfile_history = QtCore.QStringList()
         self.filename = ""
         self.last_input = None 
         self.write_time = 0
+        self.output = collections.deque()   # (text, indent) written and not yet in the bufferView
+        self.output_dropped = 0             # pieces of output dropped since the last frame
         self.default_port = "3ksdj23lkj3kj2"
         self.allow_serial = True
         self.allow_usb = True
@@ -8668,6 +11528,9 @@ else:
         self.ui.periodic_tick = QtCore.QTimer()
         self.ui.periodic_tick.timeout.connect(self.periodic_tick)
         self.ui.periodic_tick.start(300)
+        self.ui.output_tick = QtCore.QTimer()
+        self.ui.output_tick.timeout.connect(self.deliver_output)
+        self.ui.output_tick.start(GUI_FRAME_TIME)
 
         # Main Window
         self.ui.Tabs.currentChanged.connect(self.load_tab)
@@ -8730,12 +11593,18 @@ else:
         self.ui.fmclear.clicked.connect(self.fmclear)
 
         # DSIDs, Underware, FM Variables
-        self.ui.dsids.itemDoubleClicked.connect(self.send_item)
-        self.ui.dsid_numbers.itemDoubleClicked.connect(self.send_item)
-        self.ui.underware.itemDoubleClicked.connect(self.enter_item)
-        self.ui.globals.itemDoubleClicked.connect(self.send_item)
-        self.ui.constants.itemDoubleClicked.connect(self.send_item)
-        self.ui.named.itemDoubleClicked.connect(self.send_item)
+        self.ui.dsids.doubleClicked.connect(self.send_item)
+        self.ui.dsid_numbers.doubleClicked.connect(self.send_item)
+        self.ui.underware.doubleClicked.connect(self.enter_item)
+        self.ui.globals.doubleClicked.connect(self.send_item)
+        self.ui.constants.doubleClicked.connect(self.send_item)
+        self.ui.named.doubleClicked.connect(self.send_item)
+        self.ui.dsid_filter.textChanged.connect(self.dsids_model.set_filter)
+        self.ui.dsid_filter.textChanged.connect(self.dsid_numbers_model.set_filter)
+        self.ui.underware_filter.textChanged.connect(self.underware_model.set_filter)
+        self.ui.variables_filter.textChanged.connect(self.globals_model.set_filter)
+        self.ui.variables_filter.textChanged.connect(self.constants_model.set_filter)
+        self.ui.variables_filter.textChanged.connect(self.named_model.set_filter)
 
         # User Favorites
         for i in xrange(Gui.NUM_USER_LINES):
@@ -8949,7 +11818,7 @@ else:
 
     def refresh_ports(self):
         """Refresh the dynamic fields of an active connect dialog."""
-        self.load_ports()
+        self.load_ports(refresh=True)
 
     def start_pcs(self):
         try:
@@ -8961,7 +11830,7 @@ else:
         self.load_ports()
 
     def load_ports(self, default_port=None, allow_serial=None,
-        allow_usb=None, allow_pcs=None, allow_ip=None, allow_noconn=None):
+        allow_usb=None, allow_pcs=None, allow_ip=None, allow_noconn=None, refresh=False):
         """Load up all the dynamic fields of the connect dialog."""
 
         self.cui.serial_radio.setEnabled(False)
@@ -9063,7 +11932,7 @@ else:
 
         # PCS Printers
         try:
-            pcs_printers = PCSPort().printers()
+            pcs_printers = PCSPort().printers(refresh=refresh)
         except (NoService, LostService), e:
             if options.debug: print e 
             pcs_printers = None
@@ -9179,8 +12048,10 @@ else:
         if (not self.favorites_loaded) and (index == self.ui.Tabs.indexOf(self.ui.UserTab)):
             self.data_ready_event.wait(2)
             if self.data_ready_event.isSet():
+                if not completion_index.qt_model:
+                    completion_index.qt_model = QtGui.QStringListModel(completion_index.names)
                 for i in xrange(Gui.NUM_USER_LINES):
-                    gui_completer = QtGui.QCompleter(everything)
+                    gui_completer = QtGui.QCompleter(completion_index.qt_model, self)
                     gui_completer.setModelSorting(QtGui.QCompleter.CaseInsensitivelySortedModel)
                     if QtCore.QT_VERSION >= 0x040600 and QtCore.PYQT_VERSION >= 0x040700:
                         # This was in Qt 4.6, but PyQt doesn't provide access
@@ -9197,57 +12068,39 @@ else:
         if (not self.dsids_loaded) and (index == self.ui.Tabs.indexOf(self.ui.DSIDTab)):
             self.data_ready_event.wait(2)
             if self.data_ready_event.isSet():
-                count = 0
-                dsid_names = []
-                dsid_numbers = []
-                for dsid in dsids:
-                    if not dsid.startswith("DSID_"):
-                        dsid_names.append("%s  (%05d)" % (dsid, int(dsids_by_name[dsid])))
-                dsid_names.sort()
-                self.ui.dsids.addItems(dsid_names)
-                self.process_events();
-
-                for dsid in dsids:
-                    if not dsid.startswith("DSID_"):
-                        dsid_numbers.append("(%05d)  %s" % (int(dsids_by_name[dsid]),dsid))
-                dsid_numbers.sort()
-                self.ui.dsid_numbers.addItems(dsid_numbers)
+                self.dsids_model.load()
+                self.dsid_numbers_model.load()
                 self.dsids_loaded = True
 
         elif (not self.underware_loaded) and (index == self.ui.Tabs.indexOf(self.ui.UnderwareTab)):
             self.data_ready_event.wait(2)
             if self.data_ready_event.isSet():
-                self.ui.underware.addItems(underware)
+                self.underware_model.load()
                 self.underware_loaded = True
 
         elif (not self.variables_loaded) and (index == self.ui.Tabs.indexOf(self.ui.VariablesTab)):
             self.data_ready_event.wait(2)
             if self.data_ready_event.isSet():
-                if len(global_names):
-                    globals_sorted = global_names.keys()
-                    globals_sorted.sort()
-                    self.ui.globals.addItems(globals_sorted)
-                    self.process_events()
-                    if not self.global_breaks_loaded:
-                        self.ui.global_break.addItem("");
-                        self.ui.global_break.addItems(globals_sorted)
-                        self.global_breaks_loaded = True
-                        self.process_events()
-
-                consts = []
-                named  = []
-                for name, value in constant_name2value.items():
-                    id = constant_names[name]
-                    if (id == "-1"): named.append(("%s = %s" % (name, value)).upper())
-                    else:            consts.append(("%s = %s" % (name, value)).upper())
-                self.process_events()
-                consts.sort()
-                named.sort()
-                self.ui.constants.addItems(consts)
-                self.process_events()
-                self.ui.named.addItems(named)
+                self.globals_model.load()
+                self.constants_model.load()
+                self.named_model.load()
                 self.variables_loaded = True
 
+    def dsid_rows(self):
+        return sorted(dsid for dsid in dsids if not dsid.startswith("DSID_"))
+
+    def dsid_number(self, dsid):
+        return int(dsids_by_name[dsid])
+
+    def constant_rows(self, named):
+        """The constants (or named values, which have no id) sorted as they're shown"""
+        rows = [name for name in constant_name2value if (constant_names[name] == "-1") == named]
+        rows.sort(key=self.constant_text)
+        return rows
+
+    def constant_text(self, name):
+        return ("%s = %s" % (name, constant_name2value[name])).upper()
+
     def load_tabs(self):
         """Force load all the tabs. Usually after a new .all file is loaded"""
         self.load_tab(self.ui.Tabs.indexOf(self.ui.UserTab))
@@ -9268,6 +12121,19 @@ else:
         self.first_time = first_time
         self.dataready.emit()
 
+    def symbols_added(self):
+        self.symbolsadded.emit()
+
+    def handle_symbolsadded(self):
+        """Some of the symbols being loaded are in, show the ones so far in the lists
+        (they're read again, sorted, once they're all loaded)"""
+        if self.loaded_flows is flows:          # already all loaded
+            return
+        self.single_model.load()
+        self.flow_break_model.load()
+        self.global_break_model.load()
+        self.ui.status2.setText("Loading symbols: %d flows" % len(flows))
+
     def handle_dataready(self):
         """The .i/.hlg files have been loaded"""
         global everything
@@ -9278,20 +12144,23 @@ else:
         self.data_ready_event.set()
         gui.process_events()
 
-        # Make sure everything is cleared
+        # Read the lists again from the new tables (the tabs when they're shown)
+        self.loaded_flows = flows
+        self.single_model.load()
+        self.flow_break_model.load()
+        self.global_break_model.load()
+        self.input_model.load()
+        self.ui.input.clear()
         if not self.first_time:
-            self.ui.single.clear()
-            self.ui.flow_break.clear()
-            self.ui.global_break.clear()
-            self.ui.input.clear()
             self.dsids_loaded = False
-            self.ui.dsids.clear()
-            self.ui.dsid_numbers.clear()
+            self.dsids_model.clear()
+            self.dsid_numbers_model.clear()
             self.underware_loaded = False
-            self.ui.underware.clear()
+            self.underware_model.clear()
             self.variables_loaded = False
-            self.ui.globals.clear()
-            self.ui.global_break.clear()
+            self.globals_model.clear()
+            self.constants_model.clear()
+            self.named_model.clear()
 
         # Tab enables
         self.ui.Tabs.setTabEnabled(self.ui.Tabs.indexOf(self.ui.DSIDTab), len(dsids) > 0)
@@ -9300,9 +12169,6 @@ else:
 
         # trace singles
         if len(flows) + len(keywords) > 0:
-            self.ui.single.addItem("")
-            self.ui.single.addItems(flows)
-            self.ui.single.addItems(keywords)
             self.ui.single.setEnabled(True)
             self.ui.label_4.setEnabled(True)
         else:
@@ -9311,19 +12177,11 @@ else:
 
         # break singles
         if len(flows) + len(global_names) > 0:
-            self.ui.flow_break.addItem("")
-            self.ui.flow_break.addItems(flows)
-            globals_sorted = global_names.keys()
-            globals_sorted.sort()
-            self.process_events()
-            self.ui.global_break.addItem("");
-            self.ui.global_break.addItems(globals_sorted)
             self.ui.FMDebug.setEnabled(True)
         else:
             self.ui.FMDebug.setEnabled(False)
 
-        # main input text
-        self.ui.input.addItems(everything)
+        # main input text (the symbols are completed from input_model, only history is listed)
         self.ui.input.addItems(history)
         self.ui.input.setCurrentIndex(self.ui.input.count()-1)
         self.ui.input.clearEditText()
@@ -9338,14 +12196,43 @@ else:
         #Reload SiftFlow
         self.sf_reload()
 
+    # Any thread can write, the output is queued (a deque needs no lock to append and pop)
+    # and deliver_output() hands it to the bufferView from the GUI thread each frame. When
+    # the GUI can't keep up, output past GUI_MAX_QUEUED is dropped (the log files have it).
     def write(self, text):              # Stdout compatibility (filter non-printables first)
+        self.write_indented(text, render_buffer.line_indent)
+
+    def write_indented(self, text, indent):
+        if len(self.output) < GUI_MAX_QUEUED:
+            self.output.append((text, indent))
+        else:
+            self.output_dropped += 1
+
+    def flush(self):                    # Stdout compatibility (delivered with the next frame)
+        pass
+
+    def deliver_output(self):
+        """Hand the output queued since the last frame to the bufferView, joining it into
+        one call for each change of indent"""
+        output = self.output
+        if not output:
+            return
         t0 = time.clock()
-        self.ui.bufferView.insertPlainText(text)
+        (text, indent) = output.popleft()
+        texts = [text]
+        for i in xrange(len(output)):       # only what's queued now, more may be coming
+            (text, text_indent) = output.popleft()
+            if text_indent != indent:
+                self.ui.bufferView.insertIndentedText("".join(texts), indent)
+                (indent, texts) = (text_indent, [])
+            texts.append(text)
+        self.ui.bufferView.insertIndentedText("".join(texts), indent)
+        if self.output_dropped:
+            (dropped, self.output_dropped) = (self.output_dropped, 0)
+            self.ui.bufferView.insertIndentedText("%s<<< GUI behind: %d pieces of output not shown, "
+                "see the log file >>>%s" % (EOLN, dropped, EOLN), None)
         self.write_time += time.clock() - t0
 
-    def flush(self):                    # Stdout compatibility
-        self.process_events()
-
     def parse(self, text):
         """Parse the given Sift command"""
         text = str(text).strip()        # Might be a QString
@@ -9478,18 +12365,18 @@ else:
         else:
             self.parse("depth "+str(self.ui.depth.value()))
 
-    def send_item(self, item):
+    def send_item(self, index):
         if len(self.ui.input.currentText()) > 0:
-            self.enter_item(item)
+            self.enter_item(index)
         else:
-            item_string = str(item.text()).strip()
+            item_string = str(index.data().toString()).strip()
             if (" = " in item_string):
                 item_string = item_string.split()[0]
             item_string = re.sub("\(\d{5}\)", "", item_string).strip()
             self.parse(item_string)
 
-    def enter_item(self, item):
-        item_string = str(item.text()).strip()
+    def enter_item(self, index):
+        item_string = str(index.data().toString()).strip()
         item_string = re.sub("\(\d{5}\)", "", item_string).strip()
         if (" = " in item_string):
             item_string = item_string.split()[0]
@@ -9542,6 +12429,8 @@ else:
             self.ui.input.clearEditText()
 
     def clear(self):
+        self.output.clear()                 # or what's queued shows up after the clear
+        self.output_dropped = 0
         self.parse("clearlogs")
         self.ui.bufferView.clear()
         self.ui.input.clearEditText()
@@ -9680,6 +12569,9 @@ def interactive_help(short = False):
         output_str('| dot4              - Enable dot4                                             |'+EOLN)
         output_str('| ok                - Front panel "OK"                                        |'+EOLN)
         output_str('| flash <filename>  - Flash printer (Linux only via USB cable)                |'+EOLN)
+        output_str('| session add <n> <p> - Also capture the printer on port p, logged as n       |'+EOLN)
+        output_str('| session [close <n>] - List sessions, or close session n (or all)            |'+EOLN)
+        output_str('| session <n> <u.w>   - Send underware to session n\'s printer                 |'+EOLN)
         output_str('| help <substring>  - Search for <substring> within all identifiers           |'+EOLN)
         output_str('| !linux_cmd        - Execute linux command in shell                          |'+EOLN)
         output_str('| q                 - Quit (and save log file)                                |'+EOLN)
@@ -9735,6 +12627,12 @@ def help_debug():
     output_str('| n[ext]            - Run to next statement (step over flows)                 |'+EOLN)
     output_str('| f[inish]          - Finish current flow (step out of flow)                  |'+EOLN)
     output_str('| c[lear]           - Clear all breakpoints                                   |'+EOLN)
+    output_str('| profile on|off    - Start/stop profiling flow times from the trace          |'+EOLN)
+    output_str('| profile [<n>]     - Show the n busiest flows and call paths                 |'+EOLN)
+    output_str('| profile save <f>  - Save the profile as flamegraph folded stacks            |'+EOLN)
+    output_str('| profile clear     - Forget the flow times profiled so far                   |'+EOLN)
+    output_str('| query <s> <t> <t> - Show archived records of symbol s (or *) between times  |'+EOLN)
+    output_str('| query open <f>    - Query archive f instead of the one being written        |'+EOLN)
     output_str('-------------------------------------------------------------------------------'+EOLN)
 
 
@@ -9744,7 +12642,7 @@ def help_debug():
 #
 ####################################################################################################
 
-def process_options():
+def process_options(argv=None):
     global options
     global args
     global dot_all_file
@@ -9873,6 +12771,30 @@ def process_options():
         help="Window title")
     parser.add_option ("--monitor", action="store_true",
         help=SUPPRESS_HELP)
+    parser.add_option ("--benchmark", action="store_true",
+        help=SUPPRESS_HELP)
+    parser.add_option ("--swapbenchmark", type="int", metavar="MB",
+        help=SUPPRESS_HELP)
+    parser.add_option ("-j", "--jobs", type="int", default=1,
+        help="decode the file (-f) with this many processes")
+    parser.add_option ("--profile", type="string", metavar="FILE",
+        help="save a flamegraph profile of the flows in the file (-f) to FILE")
+    parser.add_option ("--htmlpages", action="store_true",
+        help="write HTML as pages loaded as they're viewed (no size limit)")
+    parser.add_option ("--archive", type="string", metavar="FILE",
+        help="archive the decoded trace records to FILE for the query command")
+    parser.add_option ("--session", action="append", default=[], metavar="NAME=PORT",
+        help="also capture the printer on PORT, logged with NAME in the file names (repeatable)")
+    parser.add_option ("--fifolines", type="int", default=DEFAULT_FIFO_MAX_LINES,
+        help=SUPPRESS_HELP)
+    parser.add_option ("--fifobytes", type="int", default=DEFAULT_FIFO_MAX_BYTES,
+        help=SUPPRESS_HELP)
+    parser.add_option ("--fifopolicy", type="choice", choices=FIFO_POLICIES, default=FIFO_POLICIES[0],
+        help=SUPPRESS_HELP)
+    parser.add_option ("--logflush", type="float", default=DEFAULT_LOG_FLUSH_TIME,
+        help=SUPPRESS_HELP)
+    parser.add_option ("--gziplogs", action="store_true",
+        help=SUPPRESS_HELP)
     parser.add_option ("-a", type="string", dest="flashhost",
         help="Alternative hostname to send flash (assumes PCS)")
     parser.add_option ("-z", "--reset", action="store_true",
@@ -9886,7 +12808,7 @@ def process_options():
     parser.add_option ("-e", "--edit", action="store_true", help="open SiftFlow")
     parser.set_defaults(**config_dict)          # want to remove use of config_dict
     parser.set_defaults(**user_options)
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
 
     if options.reset:
         reset_sift() 
@@ -9901,6 +12823,10 @@ def process_options():
         errcodes()
         sys.exit(0)
 
+    if options.swapbenchmark:
+        benchmark_swap(options.swapbenchmark)
+        sys.exit(0)
+
     # Default look for .all file in cwd
     dot_all_file_path = os.getcwd()
     dot_all_file =None
@@ -9967,7 +12893,9 @@ def load_symbols(filename=None, first_time=False):
             elif ext == ".hlg":
                 options.hlg = filename
 
-    # initialize things
+    # initialize things (the GUI doesn't read the lists again until they're loaded)
+    if gui:
+        gui.data_ready_event.clear()
     init_arrays_and_dictionaries ()
     init_arrays_and_dict_for_hlg()
 
@@ -9981,7 +12909,7 @@ def load_symbols(filename=None, first_time=False):
 
         # If a file does not already exist for the curProject make one
         process_dot_all()
-        process_hlg(find_best_filename(".hlg", [(project_dir, False)]))
+        without_gc(process_hlg, find_best_filename(".hlg", [(project_dir, False)]))
         # Compile .i and .dwn files
         if compile() == "failed":
             print "compile failed"
@@ -10000,6 +12928,85 @@ def load_symbols(filename=None, first_time=False):
         gui.data_ready(first_time)
 
 
+# Loads the symbols on a thread of its own, so a live trace is decoded while a big project
+# loads. The tables fill in as the .i and .hlg files are read, so the decoder picks up the
+# symbols as they're found, and the GUI lists are topped up every SYMBOL_PUBLISH_TIME.
+# Trace lines received while loading are kept and decoded again once the symbols are in.
+class SymbolLoader(object):
+    def __init__(self):
+        self.ready = threading.Event()
+        self.ready.set()
+        self.held = collections.deque()     # the last SYMBOL_HELD_LINES received while loading
+        self.thread = None
+        self.fifo = None                    # Fifo of the ProcessFifoThread holding lines
+
+    @property
+    def loading(self):
+        return not self.ready.isSet()
+
+    def start(self, filename=None, first_time=False):
+        self.wait()                         # one load at a time
+        self.ready.clear()
+        self.held.clear()
+        self.thread = threading.Thread(target=self.load, args=(filename, first_time), name="SymbolLoader")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def wait(self):
+        """Wait until the symbols are loaded"""
+        while not self.ready.isSet():
+            self.ready.wait(1)              # a timeout keeps the wait interruptible
+
+    def hold(self, line):
+        self.held.append(line)
+        if len(self.held) > SYMBOL_HELD_LINES:
+            self.held.popleft()
+
+    def load(self, filename, first_time):
+        publisher = threading.Thread(target=self.publish, name="SymbolPublisher")
+        publisher.setDaemon(True)
+        publisher.start()
+        t0 = time.time()
+        try:
+            load_symbols(filename, first_time)
+        finally:
+            self.ready.set()
+        debug("SymbolLoader: loaded in %.2fs" % (time.time() - t0))
+        if first_time and gui and user_options.get("gui") and (len(flows) == 0) and (len(dsids) == 0):
+            output_str(' No symbols loaded. Use "Open.." to select an .all file.'+EOLN,"G")
+        if self.fifo:
+            self.fifo.append(SYMBOLS_LOADED)    # held lines are decoded on the ProcessFifoThread
+        else:
+            decoder.frames = {}                 # forget flows of the old symbols
+
+    def publish(self):
+        """Show the symbols found so far in the GUI until they're all loaded"""
+        while True:
+            self.ready.wait(SYMBOL_PUBLISH_TIME)
+            if self.ready.isSet():
+                return
+            if gui:
+                gui.symbols_added()
+
+    def decode_held(self):
+        """Decode again the trace records received while the symbols were loading (called by
+           the ProcessFifoThread, so it's the one thread decoding the printer's lines)"""
+        decoder.frames = {}                 # forget flows of the old symbols
+        lines = [line for line in self.held if decode_line_re.match(line)]
+        self.held.clear()
+        if not lines:
+            return
+        output_str(EOLN + " Trace received while the symbols loaded (%d records):" % len(lines) + EOLN, "info")
+        held_decoder = TraceDecoder()
+        held_decoder.recording = False
+        held_decoder.sets_globals = False   # the live decode of these lines set them
+        for line in lines:
+            held_decoder.decode(line)
+        output_str(" End of trace received while the symbols loaded" + EOLN + EOLN, "info")
+
+symbol_loader = SymbolLoader()
+
+
 ####################################################################################################
 #
 # Read/Write Dictionary Items 
@@ -10074,20 +13081,35 @@ def reset_sift():
 ####################################################################################################
 
 class LogFile():
+    """Output is queued by write() and written to the file in batches by a writer thread,
+       every options.logflush seconds or sooner once LOG_BATCH_SIZE is waiting."""
 
-    def __init__(self, default_name, enabled=True, max_size=None):
+    def __init__(self, default_name, enabled=True, max_size=None, name=None):
         global options
 
         self.file = None
+        self.own_name = name                            # name given, rather than made from the options
         try:
             self.lock.acquire()
         except AttributeError:
-            self.lock = threading.RLock()
+            self.lock = threading.RLock()               # guards the file itself
+            self.pending_lock = threading.Lock()        # guards output waiting to be written
+            self.wake_writer = threading.Event()
+            self.flushed = threading.Condition()
+            self.pending = []
+            self.pending_size = 0
+            self.flushes_requested = 0
+            self.flushes_done = 0
+            self.stopping = False
+            self.writer = None
+            self.compressor = None
             self.lock.acquire()
 
         try:
             if (not enabled) or (options.noout):  # user disabled output
                 return 
+            elif name:
+                self.name = name
             elif options.output:  # user specified an output file name
                 self.name = options.output + os.path.splitext(default_name)[1]
             elif options.file:  # user specified an input file name
@@ -10097,7 +13119,7 @@ class LogFile():
                 self.name = default_name
 
             if os.path.splitext(self.name)[1] == os.path.splitext(DEFAULT_LOGFILE)[1]:
-                backup_file(self.name)
+                self.backup()
         
             try:
                 self.file = open(self.name, "w")
@@ -10114,40 +13136,114 @@ class LogFile():
                 output_str("Output file and Input file can not be the same; please rename " +EOLN, "error")
                 exit(1)
 
-            # Add on the HTML header if this is an HTML file
-            if self.ext == os.path.splitext(DEFAULT_HTML_FILE)[1]:
-                self.write(HTML_HEADER_BLOCK)
+            if not self.writer:
+                self.stopping = False
+                self.writer = threading.Thread(target=self.write_pending, name="LogFile "+self.name)
+                self.writer.setDaemon(True)
+                self.writer.start()
+
+            self.write_header()
         finally:
             self.lock.release()
 
 
+    def write_header(self):
+        # Add on the HTML header if this is an HTML file
+        if self.ext == os.path.splitext(DEFAULT_HTML_FILE)[1]:
+            self.write(HTML_HEADER_BLOCK)
+
     def write(self, str):
         if self.file:
-            self.lock.acquire()
+            with self.pending_lock:
+                self.pending.append(str)
+                self.pending_size += len(str)
+            if self.pending_size >= LOG_BATCH_SIZE:
+                self.wake_writer.set()
+
+    def write_pending(self):
+        """Writer thread: write out whatever output has been queued, until stopped"""
+        while True:
+            self.wake_writer.wait(options.logflush)
+            self.wake_writer.clear()
+            with self.pending_lock:
+                batch = self.pending
+                self.pending = []
+                self.pending_size = 0
+                flushes_requested = self.flushes_requested
+                stopping = self.stopping
+
+            if batch:
+                self.write_batch("".join(batch))
+
+            with self.flushed:
+                self.flushes_done = flushes_requested
+                self.flushed.notifyAll()
+            if stopping:
+                return
+
+    def write_batch(self, data):
+        with self.lock:
+            if not self.file:
+                return
             try:
-                try:
-                    self.file.write(str)
-                except (IOError, AttributeError):
-                    print "Couldn't write to " + self.file
-                    self.file = None
-                    pass
-                else:
-                    if self.max_size:
-                        self.size += len(str)
-                        if self.size >= self.max_size:
-                            try:
-                                self.file.close()
-                                backup_file(self.name)
-                                self.file = open(self.name, "w")
-                                self.size = 0
-                            except IOError:
-                                print "Couldn't backup " + self.file
-                                self.file = None
-            finally:
-                self.lock.release()
+                self.file.write(data)
+                self.file.flush()
+            except (IOError, AttributeError):
+                print "Couldn't write to " + self.name
+                self.file = None
+            else:
+                if self.max_size:
+                    self.size += len(data)
+                    if self.size >= self.max_size:
+                        try:
+                            self.file.close()
+                            self.backup()
+                            self.file = open(self.name, "w")
+                            self.size = 0
+                        except IOError:
+                            print "Couldn't backup " + self.name
+                            self.file = None
+
+    def backup(self):
+        """Move the file out of the way (renamed, not copied), gzipping it if asked to"""
+        (root, ext) = os.path.splitext(self.name)
+        if (ext == os.path.splitext(DEFAULT_LOGFILE)[1]) and not self.own_name:
+            backup = BACKUP_DEFAULT_LOGFILE
+        else:                                   # e.g. trace.bak.html
+            backup = root + os.path.splitext(BACKUP_DEFAULT_LOGFILE)[1] + ext
+        if self.compressor:
+            self.compressor.join()              # still compressing the last backup
+            self.compressor = None
+        if not os.path.exists(self.name):
+            return
+        backup_file(self.name, backup)
+        if options.gziplogs:
+            self.compressor = threading.Thread(target=gzip_file, args=(backup,), name="gzip "+backup)
+            self.compressor.setDaemon(True)
+            self.compressor.start()
+
+    def flush(self):
+        """Wait until everything written so far is in the file"""
+        with self.pending_lock:
+            self.flushes_requested += 1
+            flush = self.flushes_requested
+        self.wake_writer.set()
+        with self.flushed:
+            while (self.flushes_done < flush) and self.writer and self.writer.isAlive():
+                self.flushed.wait(1)
+
+    def stop_writer(self):
+        """Write out everything queued and stop the writer thread"""
+        if self.writer:
+            with self.pending_lock:
+                self.stopping = True
+            self.wake_writer.set()
+            self.writer.join()
+            self.writer = None
 
     def close(self, quiet=False):
         if self.file:
+            self.stop_writer()
             self.lock.acquire()
             try:
                 try:
@@ -10176,9 +13272,9 @@ class LogFile():
             if not quiet:
                 output_str("Saving " + dest + EOLN, "info")
             
+            self.flush()
             try:
                 self.lock.acquire()
-                self.file.flush()
                 try:
                     shutil.copyfile(self.name, dest)
                 except IOError:
@@ -10191,10 +13287,126 @@ class LogFile():
     def clear(self):
 
         if self.file:
-            self.lock.acquire()
-            self.close(quiet=True)
-            self.__init__(default_name=self.name, max_size=self.max_size)
-            self.lock.release()
+            self.close(quiet=True)              # writes out what is queued, then stops the writer
+            self.__init__(default_name=self.name, max_size=self.max_size, name=self.own_name)
+
+
+# Javascript for a list of strings (or numbers). repr() escapes a string the way
+# Javascript reads it back (\\, \', \n, \xhh).
+def js_array(items):
+    return "[" + ", ".join([repr(item) for item in items]) + "]"
+
+
+# HTML output for long traces (--htmlpages). Instead of one HTML file capped at
+# MAX_HTML_SIZE, the lines go into numbered page files in a directory next to the HTML file
+# (trace.pages/ for trace.html), and the HTML file is a viewer that loads the pages as
+# they're scrolled to. The pages are Javascript so a browser will load them from disk.
+# index.js has the number of lines and the words on each page, for searching.
+class HtmlPageFile(LogFile):
+
+    def write_header(self):
+        self.pages_dir = os.path.splitext(self.name)[0] + HTML_PAGES_EXT
+        self.page = []                      # lines of the page being filled
+        self.partial = ""                   # start of the next line
+        self.pages = 0                      # pages filled
+        self.lines = 0                      # lines on the pages filled
+        self.words = {}                     # key=word, value=pages it's on
+        try:
+            if not os.path.isdir(self.pages_dir):
+                os.makedirs(self.pages_dir)
+            for name in glob.glob(os.path.join(self.pages_dir, "*.js")):
+                os.remove(name)
+            self.file.write(HTML_PAGES_VIEWER)
+            self.file.flush()
+            self.write_index()
+        except (IOError, OSError):
+            print "Couldn't write to " + self.pages_dir
+            self.file = None
+
+    def write_batch(self, data):
+        with self.lock:
+            if not self.file:
+                return
+            lines = (self.partial + data).split("\n")
+            self.partial = lines.pop()
+            try:
+                start = 0
+                while start < len(lines):
+                    stop = start + HTML_PAGE_LINES - len(self.page)
+                    self.page.extend(lines[start:stop])
+                    start = stop
+                    if len(self.page) == HTML_PAGE_LINES:
+                        self.write_page(filled=True)
+            except (IOError, OSError):
+                print "Couldn't write to " + self.pages_dir
+                self.file = None
+
+    def page_words(self):
+        """Words on the page being filled, lower case (not numbers, nor the times)"""
+        text = html_tag_re.sub(" ", "\n".join(self.page)).lower()
+        return set(html_word_re.findall(text))
+
+    def write_page(self, filled=False):
+        """Write out the page being filled, and start the next one if it's full"""
+        name = os.path.join(self.pages_dir, "page%06d.js" % self.pages)
+        with open(name, "w") as f:
+            f.write("sift_page(%d, %s);\n" % (self.pages, js_array(self.page)))
+        if filled:
+            for word in self.page_words():
+                self.words.setdefault(word, []).append(self.pages)
+            self.pages += 1
+            self.lines += len(self.page)
+            self.page = []
+            if (self.pages % HTML_INDEX_PAGES) == 0:
+                self.write_index()
+
+    def write_index(self):
+        """Write index.js, including the page being filled"""
+        (pages, lines, words) = (self.pages, self.lines, self.words)
+        if self.page:
+            words = dict(words)
+            for word in self.page_words():
+                words[word] = words.get(word, []) + [pages]
+            (pages, lines) = (pages + 1, lines + len(self.page))
+        words = ", ".join(["%r: %s" % (word, js_array(word_pages)) for (word, word_pages) in words.items()])
+        with open(os.path.join(self.pages_dir, "index.js"), "w") as f:
+            f.write('sift_index({"lines": %d, "pages": %d, "page_lines": %d, "words": {%s}});\n'
+                    % (lines, pages, HTML_PAGE_LINES, words))
+
+    def flush(self):
+        """Wait until everything written so far is in the pages"""
+        LogFile.flush(self)
+        with self.lock:
+            if self.file:
+                if self.page:
+                    self.write_page()
+                self.write_index()
+
+    def save(self, dest, quiet=False):
+        LogFile.save(self, dest, quiet)     # flushes and copies the viewer
+        (root, ext) = os.path.splitext(dest)
+        dest_pages = root + HTML_PAGES_EXT
+        with self.lock:
+            try:
+                shutil.rmtree(dest_pages, ignore_errors=True)
+                shutil.copytree(self.pages_dir, dest_pages)
+            except (IOError, OSError, shutil.Error):
+                output_str("Couldn't write " + dest_pages + EOLN, "error")
+
+    def close(self, quiet=False):
+        if self.file:
+            self.stop_writer()
+            with self.lock:
+                if self.partial:
+                    self.page.append(self.partial)
+                    self.partial = ""
+                try:
+                    if self.page:
+                        self.write_page(filled=True)
+                    self.write_index()
+                except (IOError, OSError):
+                    print "Couldn't write to " + self.pages_dir
+        LogFile.close(self, quiet)
 
 
 ###################################################################################################
@@ -10342,6 +13554,155 @@ class UsageThread(threading.Thread):
             if options.debug:
                 sys.stderr.write ("Sift: " + str(err) + "\r\n")
 
+###################################################################################################
+#
+# Library
+#
+# Sift's decoder for Python scripts and test harnesses, without the console:
+#
+#     import sift
+#     library = sift.Library("project.i", "project.hlg")
+#     for record in library.decode_file("trace.txt"):
+#         if record.type == 'A':
+#             print record.time, record.text
+#
+# Nothing is shown or written: no GUI, no colors, no log files, no keyboard or threads. Options
+# given as command line arguments (Library(..., args=["--indent", "  "])) change the decoding.
+# The symbols are loaded once, and each decode_*() has a decoder of its own, so decodes can be
+# run one after another in the same process. There is one set of symbol tables in sift, so
+# one project is loaded at a time.
+#
+###################################################################################################
+
+class Record(object):
+    """A decoded line. The fields other than line and text are None for lines that aren't
+       trace records. time is in seconds, name is the flow/keyword/global's name (the flow
+       returned from for a return)."""
+    __slots__ = ("line", "text", "time", "type", "id", "fiber", "indent", "name", "args")
+
+    def __init__(self, line, text, time=None, type=None, id=None, fiber=None, indent=None,
+                 name=None, args=None):
+        self.line = line
+        self.text = text
+        self.time = time
+        self.type = type
+        self.id = id
+        self.fiber = fiber
+        self.indent = indent
+        self.name = name
+        self.args = args
+
+    def __repr__(self):
+        return "Record(%r)" % self.text
+
+
+class Library(KeptOutput):
+    def __init__(self, ifile=None, hlgfile=None, args=()):
+        if "options" not in globals():      # the sift application sets these up itself
+            global user_options
+            init_globals()
+            user_options = dict(DEFAULT_USER_OPTIONS)
+            process_options(["--nogui", "--nohtml", "--nocolor", "--quiet"] + list(args))
+        KeptOutput.__init__(self)           # the render buffer's session: the output is kept
+        self.load_symbols(ifile, hlgfile)
+
+    def load_symbols(self, ifile=None, hlgfile=None):
+        """Load a .all file, or a .i and .hlg file (found the way sift finds them if not given)"""
+        global dot_all_file
+        if ifile and ifile.endswith(".all"):
+            load_symbols(ifile)
+        else:
+            (dot_all_file, options.ifile, options.hlg) = (None, ifile, hlgfile)
+            load_symbols()
+
+    def new_decoder(self, printer=None):
+        decoder = TraceDecoder()
+        decoder.recording = False
+        decoder.sets_globals = False        # each decode starts from nothing left by another
+        decoder.printer = printer or Printer()
+        return decoder
+
+    def decode_line(self, decoder, line):
+        """Decode one raw trace line, return its Record"""
+        rb = render_buffer
+        (session, rb.session) = (rb.session, self)
+        try:
+            decoder.decode(line)
+        finally:
+            rb.session = session
+        text = "".join(self.texts)
+        if text.endswith(EOLN):             # decode() ends each line with one
+            text = text[:-len(EOLN)]
+        self.texts = []
+        m = decoder.match
+        if not m:
+            return Record(line, text)
+        (type, id) = (m.group("type"), int(m.group("id")))
+        items = decoder.items_for(type)
+        if type in "Rr":                    # a return names the flow returned from
+            items = flows_by_id
+        try:
+            name = items[id]
+            name = getattr(name, "name", name)
+        except (TypeError, KeyError, IndexError):
+            name = None
+        return Record(line, text, decoder.record_time() / 100.0, type, id, decoder.fiber,
+                      decoder.indent, name, m.group("args"))
+
+    def decode_lines(self, lines, printer=None):
+        """Decode raw trace lines, yield a Record for each"""
+        decoder = self.new_decoder(printer)
+        for line in lines:
+            yield self.decode_line(decoder, line)
+
+    def decode_file(self, filename):
+        """Decode a trace file (.bin core dumps are word swapped), yield a Record for each line"""
+        f = (SwappedFile if ".bin" in filename else MappedFile)(filename)
+        decoder = self.new_decoder()
+        held = []                           # wrapped data, decoded after the rest
+        try:
+            for line in f.lines():
+                if chr(0) in line:
+                    continue
+                if decoder.wrap_count > 0:
+                    held.append(line)
+                    decoder.wrap_count -= 1
+                else:
+                    yield self.decode_line(decoder, line)
+            if held:
+                decoder.wrap_count = -1
+                for line in held:
+                    yield self.decode_line(decoder, line)
+        finally:
+            f.close()
+
+    def decode_port(self, port_str):
+        """Decode the trace of the printer on port_str (as given to --port), yield a Record for
+           each line until the connection is lost. Stop iterating to close the port."""
+        printer = Printer()
+        printer.open(port_str, remember=False)
+        try:
+            for record in self.decode_lines(self.port_lines(printer), printer):
+                yield record
+        finally:
+            printer.close()
+
+    def port_lines(self, printer):
+        framer = LineFramer()
+        while printer.is_open_event.isSet():
+            port = printer.port
+            try:
+                data = port.read()
+            except TryAgain:
+                time.sleep(.1)
+                continue
+            except (NoService, LostService):
+                return
+            for line in framer.feed(data, port.terminator):
+                if line != PROMPT:
+                    yield line
+
+
 ###################################################################################################
 #
 # Main
@@ -10369,39 +13730,26 @@ def signal_handler(signum, frame):
         gui.app.exit(0)
 
 
-# The main function. Execution starts here.
-def main():
-    global printer
+# Starting values of the globals, set by main() and by a Library
+def init_globals():
+    """Give the module's globals their starting values (before any options or symbols)"""
     global output_file
     global command_parser
     global project_dir
-    global project_name
-    global project_path
-    global was_l_minus          # for list commands
-    global break_or_assert_pc   # for list commands
-    global break_or_assert_file # for list commands
-    global compatibility_error  # using flextool data so feature will not work
+    global was_l_minus
+    global break_or_assert_pc
+    global break_or_assert_file
+    global compatibility_error
     global at_a_break_point
-    global process_fifo_thread
     global dir_sift_started_in
-    global keyboard
     global html_output_file
     global raw_output_file
-    global line_class
-    global line_indent
-    global wrap_count
-    global quit_event
-    global startup_seen
-    global ready_for_flash_file
-    global underware_result_seen
     global gui
     global sift_flow
     global hlg_filename
     global dot_i_filename
     global i_file_directory
-    global shelf
     global give_gui_install_info
-    global user_options
     global lines_processed
     global time_processing
     global time_writing
@@ -10410,7 +13758,10 @@ def main():
     global trace_startup
     global current_fml_file
     global current_fml_line
-    global fiber
+    global quit_event
+    global startup_seen
+    global ready_for_flash_file
+    global underware_result_seen
 
     was_l_minus           = False
     break_or_assert_pc    = None
@@ -10418,13 +13769,9 @@ def main():
     compatibility_error   = False
     dir_sift_started_in   = os.getcwd()
     project_dir           = dir_sift_started_in
-    output_file_size      = 0
     at_a_break_point      = False
-    line_class            = None
-    line_indent           = None
     html_output_file      = None
     raw_output_file       = None
-    wrap_count            = 0
     gui                   = None
     sift_flow             = None
     output_file           = None
@@ -10441,7 +13788,61 @@ def main():
     trace_startup         = 0
     current_fml_file      = None
     current_fml_line      = None
-    fiber                 = ""
+    quit_event            = threading.Event()
+    startup_seen          = threading.Event()
+    ready_for_flash_file  = threading.Event()
+    underware_result_seen = threading.Event()
+
+    headers[0] = Header(id="1", name="SiftCoreDump", numArgs=0, argList=[])
+    headers[1] = Header(id="1", name="Sift", numArgs=4,
+        argList=["TRACE_BUFFER_REV","NUM_FLOWS","NUM_VARS","NUM_CONSTANTS"])
+    headers[2] = Header(id="1", name="SiftBufferSize", numArgs=2,
+        argList=["FM_TRACE_SIZE","sizeof(data)"])
+    headers[3] = Header(id="1", name="SiftBufferPtr", numArgs=3,
+        argList=["who","wrap_line","wrap_ptr"])
+
+
+# The main function. Execution starts here.
+def main():
+    global printer
+    global output_file
+    global command_parser
+    global project_dir
+    global project_name
+    global project_path
+    global was_l_minus          # for list commands
+    global break_or_assert_pc   # for list commands
+    global break_or_assert_file # for list commands
+    global compatibility_error  # using flextool data so feature will not work
+    global at_a_break_point
+    global process_fifo_thread
+    global port_to_fifo_thread
+    global dir_sift_started_in
+    global keyboard
+    global html_output_file
+    global raw_output_file
+    global quit_event
+    global startup_seen
+    global ready_for_flash_file
+    global underware_result_seen
+    global gui
+    global sift_flow
+    global hlg_filename
+    global dot_i_filename
+    global i_file_directory
+    global shelf
+    global give_gui_install_info
+    global user_options
+    global lines_processed
+    global time_processing
+    global time_writing
+    global time_painting
+    global paint_count
+    global trace_startup
+    global current_fml_file
+    global current_fml_line
+
+    init_globals()
 
     # Calculate user options
     user_options = DEFAULT_USER_OPTIONS
@@ -10464,11 +13865,7 @@ def main():
     parser_idle  = threading.Event()
     prompt_seen  = threading.Event()
     prompt       = threading.Event()
-    quit_event   = threading.Event()
     sync_seen    = threading.Event()
-    startup_seen = threading.Event()
-    ready_for_flash_file = threading.Event()
-    underware_result_seen = threading.Event()
 
     # Set up persistent data (sorry, multiple ways are used right now)
     try:
@@ -10493,7 +13890,11 @@ def main():
     # Set up log files
     output_file =  LogFile(default_name=DEFAULT_LOGFILE,
                             max_size=max_output_file_size)
-    html_output_file = LogFile(default_name=DEFAULT_HTML_FILE,
+    if options.htmlpages:
+        html_output_file = HtmlPageFile(default_name=DEFAULT_HTML_FILE,
+                            enabled=(not (options.nohtml)))
+    else:
+        html_output_file = LogFile(default_name=DEFAULT_HTML_FILE,
                             enabled=(not (options.nohtml)),
                             max_size=MAX_HTML_SIZE)
 
@@ -10549,21 +13950,32 @@ def main():
     output_str(" -------------------------------------------------------------------------" +EOLN)
     if gui: gui.process_events()
 
-    headers[0] = Header(id="1", name="SiftCoreDump", numArgs=0, argList=[])
-    headers[1] = Header(id="1", name="Sift", numArgs=4,
-        argList=["TRACE_BUFFER_REV","NUM_FLOWS","NUM_VARS","NUM_CONSTANTS"])
-    headers[2] = Header(id="1", name="SiftBufferSize", numArgs=2,
-        argList=["FM_TRACE_SIZE","sizeof(data)"])
-    headers[3] = Header(id="1", name="SiftBufferPtr", numArgs=3,
-        argList=["who","wrap_line","wrap_ptr"])
+    # Load the symbols (using the command line options). A file is decoded once they're
+    # loaded, otherwise they load while the printer is opened and the trace starts.
+    if options.file:
+        load_symbols(first_time=True)
+    else:
+        symbol_loader.fifo = port_fifo
+        symbol_loader.start(first_time=True)
 
-    # Load the symbols (using the command line options)
-    load_symbols(first_time=True)
+    if options.archive:
+        archive.open(options.archive)
 
     # Batch process input file
     if options.file:
         UsageThread("file").start()
+        start_time = time.time()
+        if options.profile:
+            profiler.start()
         process_file(options.file)
+        if options.profile:
+            profiler.save(options.profile)
+        if options.benchmark:
+            elapsed = time.time() - start_time
+            sys.stderr.write("benchmark: %d lines in %.2fs, %d lines/sec (%.2fs decoding, %.2fs output)\n" % 
+                (lines_processed, elapsed, lines_processed / max(elapsed, 0.001), 
+                time_processing - time_writing, time_writing))
+            benchmark_decode(options.file)
 
     # Interactive mode
     else:
@@ -10571,8 +13983,6 @@ def main():
         if gui:
             if (not "gui" in user_options) or (not user_options["gui"]):
                 output_str(' You can permanently enable GUI Mode in the Options tab.'+EOLN,"G")
-            elif (len(flows) == 0) and (len(dsids) == 0):
-                output_str(' No symbols loaded. Use "Open.." to select an .all file.'+EOLN,"G")
         else:
             if not options.nogui or not isinstance(gui, Gui):
                 output_str(' Sift has a GUI when started with "-g".'+EOLN, "G")
@@ -10613,14 +14023,24 @@ def main():
         raw_output_file = LogFile(RAW_OUTPUT_FILE, max_size=max_output_file_size)
 
         # Process serial data (pausing when CommandParser isn't idle)
+        port_fifo.set_limits(int(options.fifolines), int(options.fifobytes), options.fifopolicy)
         if not options.sim:
-            PortToFifoThread(printer, port_fifo, prompt_seen, "InputFifo", 
-                startup_seen, quit_event).start()
+            port_to_fifo_thread = PortToFifoThread(printer, port_fifo, prompt_seen, "InputFifo", 
+                startup_seen, quit_event)
+            port_to_fifo_thread.start()
 
         process_fifo_thread = ProcessFifoThread(port_fifo, processing_allowed=parser_idle,
                         quit_event=quit_event, sync_seen=sync_seen)
         process_fifo_thread.start()
 
+        # Other printers captured at the same time
+        for session in options.session:
+            (name, sep, port_str) = session.partition("=")
+            if name and port_str:
+                open_session(name, port_str)
+            else:
+                output_str("--session expects NAME=PORT, not " + session + EOLN, "error")
+
         # Perform interactive command processing
         command_parser = CommandParserThread(parser_idle, prompt_seen, prompt, quit_event, sync_seen)
 
@@ -10722,6 +14142,16 @@ def cleanup():
         printer.close() 
     except: pass
 
+    for name in session_names[:]:
+        try:
+            session_names.remove(name)
+            sessions.pop(name).close()
+        except: pass
+
+    try:
+        pcs_registry.close()
+    except: pass
+
     if not gui:                                 # clean up terminal
         try:
             output_text_type("none"); output_str(EOLN)
@@ -10739,6 +14169,14 @@ def cleanup():
         raw_output_file.close()
     except: pass
 
+    try:
+        process_fifo_thread.fifo.close_spill_file()
+    except: pass
+
+    try:
+        archive.close()
+    except: pass
+
     try:
         html_output_file.close()
     except: pass
@@ -10749,9 +14187,10 @@ def cleanup():
     except: pass
 
     debug("bye")
-    PortToFifoThread.quitted_event.wait(timeout=1) 
-    if not PortToFifoThread.quitted_event.isSet():
-        debug("PortToFifoThread timeout")
+    if globals().get("port_to_fifo_thread"):    # the main printer's reader (not the sessions')
+        port_to_fifo_thread.quitted_event.wait(timeout=1) 
+        if not port_to_fifo_thread.quitted_event.isSet():
+            debug("PortToFifoThread timeout")
     debug("bye")
 
 